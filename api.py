@@ -0,0 +1,309 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+
+import bulk_insert
+import db_to_list as dbl
+import key_pool
+import postimage
+
+# 画像のアップロードと、データの取得ができるREST API（webui.pyのFastAPIのアプリに /api として追加する）
+# スマホのアプリやスキャナーから、GradioのUIを経由せずに画像を送れる
+#
+# 使用例:
+#   curl -F "files=@a.jpg" -F "files=@b.jpg" http://localhost:8000/api/uploads
+#   curl -N http://localhost:8000/api/uploads/<バッチID>/events
+#   curl "http://localhost:8000/api/receipts?store=ローソン&limit=20"
+#   curl http://localhost:8000/api/keys
+
+# アップロードされた画像を解析するスレッドの数（すべてのバッチで共有する）
+API_MAX_WORKERS = postimage.DEFAULT_MAX_WORKERS
+# 1枚あたりの画像サイズの上限
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+# 1回にアップロードできる画像の最大枚数
+MAX_UPLOAD_FILES = 100
+# 保持するバッチの数（古いものから削除する）
+MAX_BATCHES = 100
+# Server-Sent Eventsで、結果がない間に接続を保つために送るコメントの間隔（秒）
+SSE_KEEPALIVE = 15
+# 一覧で1回に取得できる最大件数
+MAX_PAGE_SIZE = 500
+
+# 集計の種類と、取得する関数・列名
+SUMMARIES = {
+    "store": (dbl.get_store_summary, ["store", "total", "count"]),
+    "genre": (dbl.get_genre_summary, ["genre", "total", "count"]),
+    "month": (dbl.get_monthly_summary, ["month", "total"]),
+    "weekday": (dbl.get_weekday_summary, ["weekday", "total", "count"]),
+    "day": (dbl.get_daily_summary, ["date", "total", "count"]),
+}
+RECEIPT_COLUMNS = ["id", "store", "genre", "datetime", "total", "formatted_datetime"]
+ITEM_COLUMNS = ["id", "receipt_id", "name", "price"]
+
+router = APIRouter(prefix="/api")
+
+# アップロードされたバッチ
+# {バッチID: {"state": 状態, "total": 枚数, "done": 保存した枚数, "failed": 失敗した枚数,
+#             "events": 画像ごとの結果のリスト, "created_at": 受け付けた時刻, "waiters": SSEの接続の(イベントループ, イベント)}}
+_batches = OrderedDict()
+_batches_lock = threading.Lock()
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    with _batches_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=API_MAX_WORKERS, thread_name_prefix="api")
+        return _executor
+
+
+def _publish(batch_id, event):
+    # 画像1枚の結果を記録し、SSEで待っている接続に知らせる（解析のスレッドから呼ばれる）
+    with _batches_lock:
+        batch = _batches.get(batch_id)
+        if batch is None:
+            return
+        batch["events"].append(event)
+        if event["status"] == "ok":
+            batch["done"] += 1
+        else:
+            batch["failed"] += 1
+        if batch["done"] + batch["failed"] >= batch["total"]:
+            batch["state"] = "done"
+        waiters = list(batch["waiters"])
+    for loop, waiter in waiters:
+        try:
+            loop.call_soon_threadsafe(waiter.set)
+        except RuntimeError:
+            # イベントループが終了している（サーバーの停止中）
+            pass
+
+
+def _process_group(batch_id, model, group, batch_images):
+    # groupの画像 [(番号, ファイル名, 画像データ)] を解析し、1枚ずつ保存して結果を知らせる
+    responses = None
+    if len(group) > 1:
+        try:
+            responses = postimage.analyze_images(model, [image_data for _, _, image_data in group],
+                                                 max_images=batch_images)
+        except Exception:
+            # どの画像が原因かわからないので、1枚ずつ解析し直す（解析できた画像はキャッシュから返る）
+            responses = None
+
+    for position, (index, filename, image_data) in enumerate(group):
+        event = {"index": index, "filename": filename}
+        try:
+            response = responses[position] if responses else postimage.analyze_image(model, image_data)
+            if not bulk_insert.is_valid_response(response):
+                raise Exception("レシートの解析結果の形式が正しくありません")
+            result = postimage.save_to_db([response])
+            event.update(status="ok", receipt_id=result["first_id"], receipt=response)
+        except Exception as e:
+            event.update(status="error", error=str(e))
+        _publish(batch_id, event)
+
+
+def start_upload_batch(files, api_key="", batch_images=postimage.DEFAULT_BATCH_IMAGES) -> str:
+    """
+    アップロードされた画像の解析をバックグラウンドで開始する関数
+    結果はget_upload_batch、またはstream_upload_batchで取得する
+
+    Args:
+        files (list): (ファイル名, 画像データ) のリスト
+        api_key (str): APIキー（空の場合は環境変数から取得）
+        batch_images (int): 1リクエストにまとめる画像の最大枚数
+
+    Returns:
+        str: バッチID
+    """
+    model = postimage.get_model(api_key)
+    batch_id = uuid.uuid4().hex
+    with _batches_lock:
+        _batches[batch_id] = {"state": "running", "total": len(files), "done": 0, "failed": 0,
+                              "events": [], "created_at": time.time(), "waiters": set()}
+        while len(_batches) > MAX_BATCHES:
+            _batches.popitem(last=False)
+
+    batch_images = max(1, int(batch_images))
+    items = [(index, filename, image_data) for index, (filename, image_data) in enumerate(files)]
+    executor = _get_executor()
+    for start in range(0, len(items), batch_images):
+        executor.submit(_process_group, batch_id, model, items[start:start + batch_images], batch_images)
+    return batch_id
+
+
+def get_upload_batch(batch_id, since=0) -> Optional[dict]:
+    """
+    アップロードしたバッチの状態を取得する関数
+
+    Args:
+        batch_id (str): バッチID
+        since (int): この番号以降の結果だけを返す（SSEの続きを読む場合）
+
+    Returns:
+        dict: state（running / done）, total, done, failed, results（画像ごとの結果、終わった順）
+              （バッチがない場合はNone）
+    """
+    with _batches_lock:
+        batch = _batches.get(batch_id)
+        if batch is None:
+            return None
+        return {"batch_id": batch_id, "state": batch["state"], "total": batch["total"], "done": batch["done"],
+                "failed": batch["failed"], "results": list(batch["events"][since:])}
+
+
+async def stream_upload_batch(batch_id):
+    """
+    バッチの画像ごとの結果を、終わった順にServer-Sent Eventsの形式で返す非同期ジェネレータ
+    すでに終わった結果から送り、すべて終わったらdoneイベントを送って終了する
+    """
+    # 解析のスレッドから、この接続のイベントループで待っているイベントを起こしてもらう
+    waiter = (asyncio.get_running_loop(), asyncio.Event())
+    with _batches_lock:
+        if batch_id not in _batches:
+            return
+        _batches[batch_id]["waiters"].add(waiter)
+    sent = 0
+    try:
+        while True:
+            waiter[1].clear()
+            batch = get_upload_batch(batch_id, since=sent)
+            if batch is None:
+                return
+            for event in batch["results"]:
+                yield f"event: result\nid: {sent}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+                sent += 1
+            if batch["state"] == "done":
+                summary = {key: batch[key] for key in ("batch_id", "total", "done", "failed")}
+                yield f"event: done\ndata: {json.dumps(summary)}\n\n"
+                return
+            try:
+                await asyncio.wait_for(waiter[1].wait(), SSE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+    finally:
+        with _batches_lock:
+            if batch_id in _batches:
+                _batches[batch_id]["waiters"].discard(waiter)
+
+
+@router.post("/uploads", status_code=202)
+async def upload_images(files: List[UploadFile] = File(...), api_key: str = Form(""),
+                        batch_images: int = Form(postimage.DEFAULT_BATCH_IMAGES)):
+    # 画像を受け付けてバッチIDを返す（解析の完了は待たない）
+    if len(files) > MAX_UPLOAD_FILES:
+        raise HTTPException(413, f"1回にアップロードできる画像は{MAX_UPLOAD_FILES}枚までです")
+    uploaded = []
+    for file in files:
+        image_data = await file.read()
+        if len(image_data) > MAX_UPLOAD_BYTES:
+            raise HTTPException(413, f"画像が大きすぎます: {file.filename}")
+        if not image_data:
+            raise HTTPException(400, f"画像が空です: {file.filename}")
+        uploaded.append((file.filename, image_data))
+    batch_id = start_upload_batch(uploaded, api_key, batch_images)
+    return {"batch_id": batch_id, "images": len(uploaded),
+            "status_url": f"/api/uploads/{batch_id}", "events_url": f"/api/uploads/{batch_id}/events"}
+
+
+@router.get("/uploads/{batch_id}")
+def get_upload(batch_id: str):
+    batch = get_upload_batch(batch_id)
+    if batch is None:
+        raise HTTPException(404, "バッチがありません")
+    return batch
+
+
+@router.get("/uploads/{batch_id}/events")
+async def get_upload_events(batch_id: str):
+    if get_upload_batch(batch_id) is None:
+        raise HTTPException(404, "バッチがありません")
+    return StreamingResponse(stream_upload_batch(batch_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _parse_cursor(cursor):
+    # カーソルは前のページのnext_cursor（JSONの配列）
+    if not cursor:
+        return None
+    try:
+        value = json.loads(cursor)
+    except json.JSONDecodeError:
+        raise HTTPException(400, "カーソルの形式が正しくありません")
+    if not isinstance(value, list) or len(value) != 2:
+        raise HTTPException(400, "カーソルの形式が正しくありません")
+    return tuple(value)
+
+
+def _page(rows, columns, next_cursor, total):
+    return {"rows": [dict(zip(columns, row)) for row in rows],
+            "next_cursor": json.dumps(list(next_cursor), ensure_ascii=False) if next_cursor else None,
+            "total": total}
+
+
+@router.get("/receipts")
+def list_receipts(store: str = "", genre: str = "", date_from: str = "", date_to: str = "",
+                  min_total: Optional[float] = None, max_total: Optional[float] = None,
+                  sort: str = "ID", order: str = "desc", cursor: str = "", limit: int = dbl.PAGE_SIZE):
+    filters = dict(store=store, genre=genre, date_from=date_from, date_to=date_to,
+                   min_total=min_total, max_total=max_total)
+    rows, next_cursor = dbl.get_receipts_page(**filters, sort=sort, descending=(order == "desc"),
+                                              cursor=_parse_cursor(cursor), limit=max(1, min(limit, MAX_PAGE_SIZE)))
+    return _page(rows, RECEIPT_COLUMNS, next_cursor, dbl.count_receipts(**filters))
+
+
+@router.get("/receipts/{receipt_id}")
+def get_receipt(receipt_id: int):
+    rows, _ = dbl.get_receipts_page(receipt_id=receipt_id, limit=1)
+    if not rows:
+        raise HTTPException(404, "レシートがありません")
+    receipt = dict(zip(RECEIPT_COLUMNS, rows[0]))
+    items, cursor = [], None
+    while True:
+        page, cursor = dbl.get_items_page(receipt_id=receipt_id, cursor=cursor, limit=MAX_PAGE_SIZE)
+        items += [dict(zip(ITEM_COLUMNS, row)) for row in page]
+        if cursor is None:
+            break
+    receipt["items"] = items
+    return receipt
+
+
+@router.get("/items")
+def list_items(receipt_id: Optional[int] = None, store: str = "", genre: str = "", date_from: str = "",
+               date_to: str = "", min_price: Optional[float] = None, max_price: Optional[float] = None,
+               sort: str = "ID", order: str = "desc", cursor: str = "", limit: int = dbl.PAGE_SIZE):
+    filters = dict(receipt_id=receipt_id, store=store, genre=genre, date_from=date_from, date_to=date_to,
+                   min_price=min_price, max_price=max_price)
+    rows, next_cursor = dbl.get_items_page(**filters, sort=sort, descending=(order == "desc"),
+                                           cursor=_parse_cursor(cursor), limit=max(1, min(limit, MAX_PAGE_SIZE)))
+    return _page(rows, ITEM_COLUMNS, next_cursor, dbl.count_items(**filters))
+
+
+@router.get("/summary/{kind}")
+def get_summary(kind: str):
+    if kind not in SUMMARIES:
+        raise HTTPException(404, f"集計の種類は {', '.join(SUMMARIES)} のいずれかです")
+    get_rows, columns = SUMMARIES[kind]
+    return [dict(zip(columns, row)) for row in get_rows()]
+
+
+@router.get("/keys")
+def get_key_usage():
+    # APIキーごとの使用状況（キーは伏せ字）
+    return key_pool.get_usage()
+
+
+@router.get("/search")
+def search(q: str, prefix: bool = False, limit: int = dbl.SEARCH_LIMIT):
+    result = dbl.search_items(q, prefix=prefix, limit=max(1, min(limit, MAX_PAGE_SIZE)))
+    return {"rows": [dict(zip(["id", "receipt_id", "name", "price", "store", "datetime"], row)) for row in result["rows"]],
+            "count": result["count"], "total": result["total"]}
@@ -0,0 +1,410 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import bulk_insert
+import db
+import db_to_files
+import db_to_list as dbl
+import query_cache
+import synthetic_data
+
+# 一覧・集計・出力・保存の処理時間、メモリ使用量、処理件数を計測する
+# startupでは、モジュールの読み込み時間（起動の速さ）とモデルの作成時間を計測する
+# synthetic_data.pyで作ったデータベース（件数ごとにdata_dirに保存して使い回す）に対して実行し、結果をJSONで出力する
+# 変更前後の結果を compare で比べると、遅くなった処理がわかる
+#
+# 計測方法:
+#   seconds: repeat回実行したときの中央値（min_secondsは最小値）、一覧・集計のキャッシュは毎回削除する
+#   peak_memory: 別に1回実行し、tracemallocで計測したPythonのメモリ使用量の最大値（SQLite内部のメモリは含まない）
+#   rows_per_second: 処理した行数 / seconds
+#   保存の計測はトランザクションの最後にロールバックするので、データベースは変わらない
+
+# 既定の件数（レシート数）
+DEFAULT_SIZES = [1000, 10000, 100000]
+# 既定の実行回数
+DEFAULT_REPEAT = 3
+# 全件を一度に読み込む処理（get_receipts_listなど）は、この件数を超えると実行しない
+FULL_LOAD_LIMIT = 1000000
+# 保存の計測で挿入するレシートの数
+INSERT_COUNT = 10000
+# 1件ずつ保存する処理（postimage.insert_receipt）の計測で挿入するレシートの数
+INSERT_ROW_COUNT = 1000
+# compareで遅くなったとみなす割合
+DEFAULT_THRESHOLD = 0.2
+# compareで、差がこの秒数未満の場合は遅くなったとみなさない（短い処理は誤差が大きいため）
+MIN_DIFFERENCE = 0.001
+# 起動時間を計測するモジュール
+# （discord_bot.pyは読み込むとボットが起動するので含めない。起動時間はpostimageの読み込みでほぼ決まる）
+STARTUP_MODULES = ["db_to_list", "postimage", "api", "folder_watcher", "webui"]
+# 起動時に読み込まれていないか確認する、読み込みに時間がかかるライブラリ
+HEAVY_MODULES = ["google.generativeai", "PIL.Image", "xlsxwriter", "pandas", "gradio"]
+
+
+def _len(result):
+    # 戻り値から処理した行数を求める
+    if isinstance(result, dict):
+        rows = result.get("rows", 0)
+        return len(rows) if isinstance(rows, list) else rows
+    if isinstance(result, tuple):
+        return len(result[0])
+    if isinstance(result, list):
+        return len(result)
+    return 0
+
+
+def _rollback(func):
+    # トランザクションの中で実行して、最後にロールバックする
+    def wrapper():
+        conn = db.get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            return func()
+        finally:
+            conn.execute("ROLLBACK")
+    return wrapper
+
+
+def _deep_page(pages):
+    # カーソルをたどって、pagesページ目まで読む
+    def run():
+        cursor = None
+        rows = []
+        for _ in range(pages):
+            rows, cursor = dbl.get_receipts_page(sort="日時", descending=True, cursor=cursor)
+            if cursor is None:
+                break
+        return rows
+    return run
+
+
+def _bulk_insert(count):
+    # 解析結果をまとめて保存する（postimage.save_to_dbと同じ方法）
+    def run():
+        result = bulk_insert.insert_receipts(synthetic_data.generate_receipts(count, seed=0))
+        return {"rows": result["receipts"]}
+    return run
+
+
+def _insert_rows(count):
+    # 解析結果を1件ずつ保存する（job_queueと同じ方法）
+    def run():
+        # postimageはgoogle-generativeaiを読み込むので、使うときだけimportする
+        import postimage
+        with db.transaction() as conn:
+            cursor = conn.cursor()
+            for response in synthetic_data.generate_receipts(count, seed=0):
+                postimage.insert_receipt(cursor, response)
+            db.bump_data_version(conn)
+        return {"rows": count}
+    return run
+
+
+def _export_excel(output_dir):
+    def run():
+        # xlsxwriterはExcelの計測をするときだけ必要
+        import db_to_excels
+        db_to_excels.export_database_to_excel(os.path.join(output_dir, "bench.xlsx"))
+        conn = db.get_connection()
+        return {"rows": conn.execute("SELECT (SELECT COUNT(*) FROM receipts) + (SELECT COUNT(*) FROM items)").fetchone()[0]}
+    return run
+
+
+def _export_files(file_format, output_dir):
+    def run():
+        results = db_to_files.export_database(file_format, os.path.join(output_dir, file_format))
+        return {"rows": sum(result["rows"] for result in results)}
+    return run
+
+
+def get_benchmarks(size, output_dir) -> list:
+    """
+    計測する処理の一覧を取得する関数
+
+    Returns:
+        list: (グループ, 名前, 引数なしで呼ぶ関数) のリスト
+    """
+    store = synthetic_data.CATALOG["コンビニ"][0][0]
+    benchmarks = [
+        ("summary", "get_store_summary", dbl.get_store_summary),
+        ("summary", "get_genre_summary", dbl.get_genre_summary),
+        ("summary", "get_monthly_summary", dbl.get_monthly_summary),
+        ("summary", "get_weekday_summary", dbl.get_weekday_summary),
+        ("summary", "get_daily_summary", dbl.get_daily_summary),
+        ("summary", "get_store_names", dbl.get_store_names),
+        ("summary", "get_genre_names", dbl.get_genre_names),
+        ("list", "get_receipts_page", lambda: dbl.get_receipts_page()),
+        ("list", "get_receipts_page(sort=日時, store)", lambda: dbl.get_receipts_page(store=store, sort="日時", descending=True)),
+        ("list", "get_receipts_page(page=20)", _deep_page(20)),
+        ("list", "count_receipts(store)", lambda: [dbl.count_receipts(store=store)]),
+        ("list", "get_items_page(genre, sort=価格)", lambda: dbl.get_items_page(genre="スーパー", sort="価格", descending=True)),
+        ("list", "count_items(genre)", lambda: [dbl.count_items(genre="スーパー")]),
+        ("list", "search_items(コーヒー)", lambda: dbl.search_items("コーヒー")),
+        ("list", "search_items(パン)", lambda: dbl.search_items("パン")),
+        ("insert", f"bulk_insert.insert_receipts({INSERT_COUNT})", _rollback(_bulk_insert(INSERT_COUNT))),
+        ("insert", f"postimage.insert_receipt({INSERT_ROW_COUNT})", _rollback(_insert_rows(INSERT_ROW_COUNT))),
+        ("export", "db_to_files(csv)", _export_files("csv", output_dir)),
+        ("export", "db_to_files(jsonl)", _export_files("jsonl", output_dir)),
+        ("export", "db_to_files(parquet)", _export_files("parquet", output_dir)),
+        ("export", "export_database_to_excel", _export_excel(output_dir)),
+    ]
+    if size <= FULL_LOAD_LIMIT:
+        benchmarks += [
+            ("list", "get_receipts_list", dbl.get_receipts_list),
+            ("list", "get_items_detail", dbl.get_items_detail),
+        ]
+    return benchmarks
+
+
+def measure(func, repeat=DEFAULT_REPEAT) -> dict:
+    """
+    関数の処理時間とメモリ使用量を計測する関数
+
+    Returns:
+        dict: seconds, min_seconds, peak_memory, rows, rows_per_second
+    """
+    times = []
+    rows = 0
+    for _ in range(repeat):
+        query_cache.clear_cache()
+        start = time.perf_counter()
+        rows = _len(func())
+        times.append(time.perf_counter() - start)
+
+    # tracemallocを有効にすると遅くなるので、メモリは別に計測する
+    query_cache.clear_cache()
+    tracemalloc.start()
+    try:
+        func()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    seconds = statistics.median(times)
+    return {
+        "seconds": seconds,
+        "min_seconds": min(times),
+        "peak_memory": peak_memory,
+        "rows": rows,
+        "rows_per_second": rows / seconds if seconds > 0 else None,
+    }
+
+
+def _run_python(code, importtime=False):
+    # 新しいPythonのプロセスでcodeを実行し、(終了コード, 標準出力, 標準エラー出力, 経過秒数) を返す
+    command = [sys.executable, "-W", "ignore"] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    start = time.perf_counter()
+    process = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return process.returncode, process.stdout, process.stderr, time.perf_counter() - start
+
+
+def _import_seconds(stderr, module):
+    # -X importtime の出力から、moduleの読み込みにかかった時間（依存するモジュールを含む）を取り出す
+    for line in stderr.splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1e6
+    return None
+
+
+def measure_startup(modules=STARTUP_MODULES, repeat=DEFAULT_REPEAT) -> list:
+    """
+    モジュールの読み込み時間と、モデルの作成時間を新しいプロセスで計測する関数
+    （すでに読み込んだモジュールの影響を受けないように、毎回別のプロセスで実行する）
+
+    Returns:
+        list: 計測結果のリスト
+              import: seconds（読み込み時間の中央値）, process_seconds（プロセスの起動から終了まで）,
+                      heavy_modules（読み込まれた、時間のかかるライブラリ）
+              model: seconds（1回目の作成時間）, cached_seconds（2回目、使い回した場合）
+    """
+    results = []
+    for module in modules:
+        result = {"size": 0, "group": "startup", "name": f"import {module}"}
+        code = f"import sys, json; import {module}; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+        times, process_times = [], []
+        for _ in range(repeat):
+            returncode, stdout, stderr, seconds = _run_python(code, importtime=True)
+            if returncode != 0:
+                # discordなど、任意のライブラリがない場合は飛ばす
+                result["skipped"] = stderr.strip().splitlines()[-1] if stderr.strip() else f"終了コード {returncode}"
+                break
+            times.append(_import_seconds(stderr, module))
+            process_times.append(seconds)
+        if "skipped" not in result:
+            result.update(seconds=statistics.median(times), min_seconds=min(times),
+                          process_seconds=statistics.median(process_times),
+                          heavy_modules=json.loads(stdout.strip().splitlines()[-1]))
+        results.append(result)
+
+    # Geminiのモデルの作成（ライブラリの読み込みとクライアントの作成、通信はしない）
+    result = {"size": 0, "group": "startup", "name": "postimage.get_model"}
+    code = ("import json, time, postimage\n"
+            "postimage.set_model_backend('gemini')\n"
+            "start = time.perf_counter(); postimage.get_model('benchmark'); first = time.perf_counter() - start\n"
+            "start = time.perf_counter(); postimage.get_model('benchmark'); second = time.perf_counter() - start\n"
+            "print(json.dumps([first, second]))")
+    firsts, seconds = [], []
+    for _ in range(repeat):
+        returncode, stdout, stderr, _ = _run_python(code)
+        if returncode != 0:
+            result["skipped"] = stderr.strip().splitlines()[-1] if stderr.strip() else f"終了コード {returncode}"
+            break
+        first, second = json.loads(stdout.strip().splitlines()[-1])
+        firsts.append(first)
+        seconds.append(second)
+    if "skipped" not in result:
+        result.update(seconds=statistics.median(firsts), min_seconds=min(firsts),
+                      cached_seconds=statistics.median(seconds))
+    results.append(result)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _meta(repeat, seed=None) -> dict:
+    return {
+        "commit": _git_commit(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "seed": seed,
+    }
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=DEFAULT_REPEAT, data_dir="bench_data", seed=synthetic_data.DEFAULT_SEED,
+                   only=None) -> dict:
+    """
+    件数ごとにデータベースを作り（作成済みなら使い回す）、すべての処理を計測する関数
+
+    Args:
+        sizes (list): レシートの件数のリスト
+        repeat (int): 1つの処理を実行する回数
+        data_dir (str): データベースを保存するフォルダ
+        seed (int): データを作るときの乱数のシード
+        only (str): 指定した場合は、名前にこの文字列を含む処理だけを計測する
+
+    Returns:
+        dict: meta（実行環境）, results（処理ごとの計測結果のリスト）
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    report = {"meta": _meta(repeat, seed), "results": []}
+
+    for size in sizes:
+        path = os.path.join(data_dir, f"bench_{size}_{seed}.db")
+        build = synthetic_data.build_database(path, size, seed=seed)
+        if build["receipts"] > 0:
+            print(f"{path} を作成しました（{build['seconds']:.1f}秒）")
+            report["results"].append({"size": size, "group": "build", "name": "synthetic_data.build_database",
+                                      "seconds": build["seconds"], "rows": build["receipts"],
+                                      "rows_per_second": build["receipts"] / build["seconds"]})
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            for group, name, func in get_benchmarks(size, output_dir):
+                if only and only not in name:
+                    continue
+                result = {"size": size, "group": group, "name": name}
+                try:
+                    result.update(measure(func, repeat))
+                except ImportError as e:
+                    # pyarrow・xlsxwriterなど、任意のライブラリがない場合は飛ばす
+                    result["skipped"] = str(e)
+                report["results"].append(result)
+                if "skipped" in result:
+                    print(f"[{size:>9,}] {name}: スキップ（{result['skipped']}）")
+                else:
+                    print(f"[{size:>9,}] {name}: {result['seconds'] * 1000:.1f}ms"
+                          f" / {result['peak_memory'] / 1024 / 1024:.1f}MB / {result['rows']:,}行")
+        db.close_connection()
+    return report
+
+
+def compare(old_report, new_report, threshold=DEFAULT_THRESHOLD) -> list:
+    """
+    2つの計測結果を比べる関数
+
+    Returns:
+        list: (件数, 名前, 変更前の秒数, 変更後の秒数, 変化の割合, 印) のリスト
+              （threshold以上、かつMIN_DIFFERENCE秒以上遅くなったものは印が "遅くなった" になる）
+    """
+    old = {(r["size"], r["name"]): r for r in old_report["results"] if "seconds" in r}
+    rows = []
+    for r in new_report["results"]:
+        before = old.get((r["size"], r["name"]))
+        if before is None or "seconds" not in r or before["seconds"] == 0:
+            continue
+        change = r["seconds"] / before["seconds"] - 1
+        rows.append((r["size"], r["name"], before["seconds"], r["seconds"], change,
+                     "遅くなった" if change >= threshold and r["seconds"] - before["seconds"] >= MIN_DIFFERENCE else ""))
+    return rows
+
+
+if __name__ == "__main__":
+    # 使用例:
+    #   python benchmark.py run --sizes 1000 100000 1000000 --output results.json
+    #   python benchmark.py run --sizes 10000 --only page
+    #   python benchmark.py startup --repeat 5 --output startup.json
+    #   python benchmark.py compare before.json after.json
+    parser = argparse.ArgumentParser(description="一覧・集計・出力・保存の性能を計測する")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_run = subparsers.add_parser("run", help="計測してJSONで出力する")
+    parser_run.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="レシートの件数")
+    parser_run.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser_run.add_argument("--seed", type=int, default=synthetic_data.DEFAULT_SEED)
+    parser_run.add_argument("--data-dir", default="bench_data", help="作成したデータベースを保存するフォルダ")
+    parser_run.add_argument("--only", default=None, help="名前にこの文字列を含む処理だけを計測する")
+    parser_run.add_argument("--output", default=None, help="結果を保存するJSONファイル（省略時は標準出力）")
+
+    parser_startup = subparsers.add_parser("startup", help="モジュールの読み込み時間とモデルの作成時間を計測する")
+    parser_startup.add_argument("--modules", nargs="+", default=STARTUP_MODULES)
+    parser_startup.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser_startup.add_argument("--output", default=None, help="結果を保存するJSONファイル（省略時は標準出力）")
+
+    parser_compare = subparsers.add_parser("compare", help="2つの計測結果を比べる")
+    parser_compare.add_argument("before")
+    parser_compare.add_argument("after")
+    parser_compare.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="遅くなったとみなす割合")
+
+    args = parser.parse_args()
+    if args.command in ("run", "startup"):
+        if args.command == "run":
+            report = run_benchmarks(args.sizes, args.repeat, args.data_dir, args.seed, args.only)
+        else:
+            report = {"meta": _meta(args.repeat), "results": measure_startup(args.modules, args.repeat)}
+            for r in report["results"]:
+                if "skipped" in r:
+                    print(f"{r['name']}: スキップ（{r['skipped']}）")
+                else:
+                    print(f"{r['name']}: {r['seconds'] * 1000:.0f}ms {', '.join(r.get('heavy_modules', []))}")
+        text = json.dumps(report, indent=2, ensure_ascii=False)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(text)
+            print(f"結果を保存しました: {args.output}")
+        else:
+            print(text)
+    elif args.command == "compare":
+        with open(args.before, encoding="utf-8") as f:
+            before = json.load(f)
+        with open(args.after, encoding="utf-8") as f:
+            after = json.load(f)
+        for size, name, old_seconds, new_seconds, change, mark in compare(before, after, args.threshold):
+            print(f"[{size:>9,}] {name}: {old_seconds * 1000:.1f}ms → {new_seconds * 1000:.1f}ms ({change:+.0%}) {mark}")
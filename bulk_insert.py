@@ -0,0 +1,180 @@
+import argparse
+import json
+import time
+from itertools import islice
+
+import db
+import dimensions
+import rollups
+import stats
+
+# レシートをまとめてデータベースに保存する
+# 1件ずつINSERTせず、executemanyでバッチごとにまとめて挿入する
+# 入力はイテラブル（ジェネレータ）でよく、BATCH_SIZE件ずつ読み込むので全件をメモリに載せない
+# ロールアップ・全文検索のインデックスは1行ずつトリガーで更新せず、バッチごとにまとめて更新する
+
+# 1回のトランザクションで挿入するレシートの数
+BATCH_SIZE = 5000
+
+
+def _next_receipt_id(conn) -> int:
+    # AUTOINCREMENTのため、削除済みのIDも含めた最大値（sqlite_sequence）の次から使う
+    row = conn.execute('''
+        SELECT MAX(
+            COALESCE((SELECT MAX(id) FROM receipts), 0),
+            COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'receipts'), 0)
+        )
+    ''').fetchone()
+    return row[0] + 1
+
+
+def _insert_batch(conn, responses):
+    # 店舗名・ジャンル名は正規化してIDにする（ない名前はstores・genresに追加する）
+    responses = [dimensions.normalize_response(response) for response in responses]
+    store_ids = dimensions.get_ids(conn, "store", (response['store'] for response in responses))
+    genre_ids = dimensions.get_ids(conn, "genre", (response['genre'] for response in responses))
+
+    # 書き込みロックを取った後にIDを決めるので、他のプロセスと重複しない
+    receipt_id = _next_receipt_id(conn)
+    receipt_rows = []
+    item_rows = []
+    for response in responses:
+        receipt_rows.append((receipt_id, store_ids.get(response['store']), genre_ids.get(response['genre']),
+                             response['datetime'], response['datetime'], response['datetime'], response['total']))
+        item_rows.extend((receipt_id, item['name'], item['price']) for item in response['items'])
+        receipt_id += 1
+
+    # 挿入時のトリガーを止める（ロールアップ・全文検索のインデックスは最後にまとめて更新する）
+    conn.execute("INSERT OR IGNORE INTO bulk_load (id) VALUES (1)")
+
+    # 日付と年月は集計・検索用にdatetimeから切り出して保存する（insert_receiptと同じ）
+    conn.executemany('''
+        INSERT INTO receipts (id, store_id, genre_id, datetime, date, month, total)
+        VALUES (?, ?, ?, ?, substr(?, 1, 10), substr(?, 1, 7), ?)
+    ''', receipt_rows)
+    conn.executemany("INSERT INTO items (receipt_id, name, price) VALUES (?, ?, ?)", item_rows)
+
+    first_id, last_id = receipt_rows[0][0], receipt_id - 1
+    rollups.add_receipts(conn, first_id, last_id)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'items_fts'").fetchone() is not None:
+        conn.execute('''
+            INSERT INTO items_fts (rowid, name, store)
+            SELECT items.id, items.name, stores.name
+            FROM items
+            JOIN receipts ON receipts.id = items.receipt_id
+            LEFT JOIN stores ON stores.id = receipts.store_id
+            WHERE items.receipt_id BETWEEN ? AND ?
+        ''', (first_id, last_id))
+    conn.execute("DELETE FROM bulk_load")
+    stats.add_responses(conn, responses)
+
+    # 一覧・集計のキャッシュを無効にする
+    db.bump_data_version(conn)
+    return first_id, last_id, len(item_rows)
+
+
+def insert_receipts(responses, batch_size=BATCH_SIZE) -> dict:
+    """
+    レシートの解析結果をまとめてデータベースに保存する関数
+    batch_size件ごとに1つのトランザクションでコミットする
+    （すでにトランザクション中の場合は、その中で実行する）
+
+    Args:
+        responses (iterable): レシートの解析結果（dict）のリストまたはジェネレータ
+        batch_size (int): 1回のトランザクションで挿入するレシートの数
+
+    Returns:
+        dict: receipts（保存したレシートの数）, items（保存した商品の数）,
+              first_id, last_id（保存したレシートのIDの範囲、保存しなかった場合はNone）
+    """
+    result = {"receipts": 0, "items": 0, "first_id": None, "last_id": None}
+    iterator = iter(responses)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            break
+
+        with db.transaction() as conn:
+            first_id, last_id, items = _insert_batch(conn, batch)
+
+        if result["first_id"] is None:
+            result["first_id"] = first_id
+        result["last_id"] = last_id
+        result["receipts"] += len(batch)
+        result["items"] += items
+    return result
+
+
+def _is_amount(value) -> bool:
+    # 金額は数値またはNone（"1,280円"のような文字列は保存しない）
+    return value is None or (isinstance(value, (int, float)) and not isinstance(value, bool))
+
+
+def is_valid_response(response) -> bool:
+    """
+    レシートの解析結果として保存できる形式かどうかを判定する関数
+    itemsはリスト、合計金額・価格は数値またはNoneでなければならない
+    """
+    if not isinstance(response, dict):
+        return False
+    if any(key not in response for key in ("store", "genre", "datetime", "total", "items")):
+        return False
+    if not _is_amount(response["total"]) or not isinstance(response["items"], list):
+        return False
+    return all(isinstance(item, dict) and "name" in item and "price" in item and _is_amount(item["price"])
+               for item in response["items"])
+
+
+def read_responses(path):
+    """
+    保存しておいた解析結果をファイルから1件ずつ読み込むジェネレータ
+    JSON Lines（1行に1件または1行にリスト）は1行ずつ読むので、大きなファイルでもメモリを使わない
+    JSON（main_processの戻り値のようなリスト、または1件のdict）はファイル全体を読み込む
+    形式が正しくない解析結果は読み飛ばす
+
+    Args:
+        path (str): .jsonl または .json のファイルのパス
+
+    Yields:
+        dict: レシートの解析結果
+    """
+    def records():
+        if path.endswith(".jsonl"):
+            with open(path, encoding="utf-8") as f:
+                for line_number, line in enumerate(f, start=1):
+                    line = line.strip()
+                    if line == "":
+                        continue
+                    try:
+                        data = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        print(f"{path}:{line_number} を読み込めませんでした: {e}")
+                        continue
+                    yield from (data if isinstance(data, list) else [data])
+        else:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            yield from (data if isinstance(data, list) else [data])
+
+    for response in records():
+        if is_valid_response(response):
+            yield response
+        else:
+            print(f"形式が正しくない解析結果を読み飛ばしました: {str(response)[:100]}")
+
+
+if __name__ == "__main__":
+    # 使用例:
+    #   python bulk_insert.py responses.jsonl
+    #   python bulk_insert.py backfill/*.json --batch-size 10000
+    parser = argparse.ArgumentParser(description="保存しておいた解析結果（JSON / JSON Lines）をまとめてデータベースに取り込む")
+    parser.add_argument("files", nargs="+", help=".jsonl または .json のファイル")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="1回のトランザクションで挿入するレシートの数")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    for path in args.files:
+        result = insert_receipts(read_responses(path), batch_size=args.batch_size)
+        print(f"{path}: レシート{result['receipts']}件・商品{result['items']}件を保存しました"
+              f"（レシートID {result['first_id']}〜{result['last_id']}）")
+    print(f"{time.perf_counter() - start:.1f}秒")
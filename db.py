@@ -0,0 +1,135 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import migrations
+
+# データベースのパス（環境変数RECEIPTS_DBで変更できる）
+db_path = os.getenv("RECEIPTS_DB", "receipts.db")
+
+# ロックの解除を待つ最大秒数（これを超えると database is locked になる）
+BUSY_TIMEOUT = 30
+
+# 接続ごとに設定するPRAGMA
+# WALモードにすると、読み込みと書き込みが互いをブロックしない
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    # WALモードではNORMALでもデータベースが壊れることはない（電源断時に直前のコミットが失われる可能性のみ）
+    "PRAGMA synchronous = NORMAL",
+    # ページキャッシュ 64MB（負の値はKB単位）
+    "PRAGMA cache_size = -65536",
+    # 256MBまでメモリマップで読み込む
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+]
+
+_local = threading.local()
+_migrated_paths = set()
+_migrate_lock = threading.Lock()
+
+
+def set_db_path(path):
+    """
+    使用するデータベースのパスを変更する関数
+    以降に取得する接続は新しいパスに接続する
+    """
+    global db_path
+    db_path = path
+
+
+def _open(path):
+    # isolation_level=Noneで自動コミットにし、書き込みのトランザクションはtransaction()で明示的に管理する
+    # （読み込みは1文ごとの短いトランザクションになり、書き込みを待たせない）
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}")
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+
+    # スキーマの更新はプロセスごとに1回だけ行う
+    with _migrate_lock:
+        if path not in _migrated_paths:
+            migrations.migrate(conn)
+            _migrated_paths.add(path)
+    return conn
+
+
+def get_connection():
+    """
+    現在のスレッド用のデータベース接続を取得する関数
+    同じスレッドでは同じ接続を使い回す
+
+    Returns:
+        sqlite3.Connection: 自動コミットモードの接続
+    """
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = connections[db_path] = _open(db_path)
+    return conn
+
+
+def close_connection():
+    """
+    現在のスレッドの接続をすべて閉じる関数
+    """
+    connections = getattr(_local, "connections", {})
+    for conn in connections.values():
+        conn.close()
+    connections.clear()
+
+
+@contextmanager
+def transaction():
+    """
+    書き込み用のトランザクションを開始するコンテキストマネージャ
+    最初に書き込みロックを取る（BEGIN IMMEDIATE）ので、途中でロック待ちによる失敗が起きない
+    すでにトランザクション中の場合は、その中で実行する
+
+    使用例:
+        with db.transaction() as conn:
+            conn.execute("INSERT INTO ...")
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+
+
+def bump_data_version(conn):
+    """
+    データの更新回数を1増やす関数
+    receipts・itemsに書き込む処理は、同じトランザクションの中で必ず呼ぶ
+    （読み込み側のキャッシュを無効にするため）
+    """
+    conn.execute("UPDATE data_version SET version = version + 1 WHERE id = 1")
+
+
+def get_data_version() -> int:
+    """
+    データの更新回数を取得する関数
+    PRAGMA data_version（他の接続がコミットすると変わる）と、この接続の変更数が
+    前回から変わっていなければ、テーブルを読まずに前回の値を返す
+    """
+    conn = get_connection()
+    stamp = (db_path, conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes)
+
+    last = getattr(_local, "data_version", None)
+    if last is not None and last[0] == stamp:
+        return last[1]
+
+    version = conn.execute("SELECT version FROM data_version WHERE id = 1").fetchone()[0]
+    _local.data_version = (stamp, version)
+    return version
@@ -1,102 +1,224 @@
-import sqlite3
-import pandas as pd
+import threading
+import time
+import uuid
 from datetime import datetime
+import db
+import dimensions
+import metrics
+import rollups
+from db_to_list import format_datetime
 
-def export_database_to_excel(output_path=None):
+# 一度にデータベースから読み込む行数
+CHUNK_SIZE = 5000
+# 1つのシートに書き込める行数（xlsxの上限。見出しの行を含む）
+# 超える場合は「シート名 (2)」のような続きのシートに書き込む
+MAX_SHEET_ROWS = 1048576
+
+# バックグラウンドで実行中・実行済みのエクスポート
+# {ジョブID: {"state": 状態, "done": 出力済みの行数, "total": 全体の行数, "output_path": 出力先, "message": 結果}}
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def _write_rows(worksheet, start_row, rows, formats=None):
+    # 1行ずつシートに書き込む（constant_memoryモードでは上の行から順に書く必要がある）
+    # xlsxwriterは書き込めない行・列の場合に例外を発生させず-1を返すので、黙って欠けないようにエラーにする
+    for offset, row in enumerate(rows):
+        for col, value in enumerate(row):
+            if worksheet.write(start_row + offset, col, value, formats.get(col) if formats else None) == -1:
+                raise Exception(f"シート「{worksheet.name}」の{start_row + offset + 1}行目に書き込めません")
+    return start_row + len(rows)
+
+
+def _add_sheet(workbook, sheet_name, headers, header_format, widths):
+    # シートを追加して列の幅と見出しを設定する
+    worksheet = workbook.add_worksheet(sheet_name)
+    for first_col, last_col, width in widths:
+        worksheet.set_column(first_col, last_col, width)
+    for col, header in enumerate(headers):
+        worksheet.write(0, col, header, header_format)
+    return worksheet
+
+
+def _observe_stage(stage, start):
+    # 段階ごとの処理時間を記録して、次の段階の開始時刻を返す
+    now = time.perf_counter()
+    metrics.observe("excel_export_seconds", now - start, stage=stage)
+    return now
+
+
+def _write_query(workbook, sheet_name, query, header_format, headers, widths=(), convert=None, progress=None):
+    """
+    クエリの結果を少しずつ読み込みながらシートに書き込む関数
+    全件をメモリに載せないので、件数が多くても使用メモリは一定
+    シートの行数の上限（MAX_SHEET_ROWS）に達したら、「シート名 (2)」「シート名 (3)」…の続きのシートに書き込む
+
+    Returns:
+        int: 書き込んだシートの数
+    """
+    sheets = 1
+    worksheet = _add_sheet(workbook, sheet_name, headers, header_format, widths)
+    row_index = 1
+    cursor = db.get_connection().execute(query)
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        if convert is not None:
+            rows = [convert(row) for row in rows]
+        while rows:
+            if row_index >= MAX_SHEET_ROWS:
+                sheets += 1
+                worksheet = _add_sheet(workbook, f"{sheet_name} ({sheets})", headers, header_format, widths)
+                row_index = 1
+            count = MAX_SHEET_ROWS - row_index
+            written, rows = rows[:count], rows[count:]
+            row_index = _write_rows(worksheet, row_index, written)
+            metrics.inc("excel_export_rows_total", len(written))
+            if progress is not None:
+                progress(len(written))
+    return sheets
+
+
+@metrics.profiled
+def export_database_to_excel(output_path=None, progress=None):
     """
     SQLiteデータベースからデータを抽出し、Excelファイルに出力する関数
     ISO8601形式の日時データに対応
-    
+    データベースから少しずつ読み込み、xlsxwriterのconstant_memoryモードで書き込むので、件数が多くてもメモリを使わない
+
     Args:
-        db_path (str): SQLiteデータベースのパス
         output_path (str, optional): 出力するExcelファイルのパス。指定しない場合は現在の日時で自動生成
-    
+        progress (callable, optional): 出力した行数を受け取る関数（進捗の表示用）
+
     Returns:
         str: 出力されたExcelファイルのパス
     """
 
-    # データベースのパス
-    db_path = "receipts.db"
-
     # 出力パスが指定されていない場合は現在の日時を使用
     if output_path is None or output_path == "":
         current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_path = f"receipts_data_{current_time}.xlsx"
-    
-    # データベースに接続
-    conn = sqlite3.connect(db_path)
-    
-    # receiptsテーブルとitemsテーブルのデータを取得
-    receipts_df = pd.read_sql_query("SELECT * FROM receipts", conn)
-    items_df = pd.read_sql_query("SELECT * FROM items", conn)
-    
-    # ISO8601形式の日時を適切に処理
-    # 表示用に日時のフォーマットを変更（オリジナルデータは保持）
-    # 秒がないときの例外処理はISO8601をformatで指定することで対応
-    receipts_df['formatted_date'] = pd.to_datetime(receipts_df['datetime'], format='ISO8601').dt.strftime('%Y-%m-%d %H:%M:%S')
-    
-    # 集計データを作成
-    # 店舗ごとの合計金額
-    store_summary = receipts_df.groupby('store')['total'].agg(['sum', 'count']).reset_index()
-    store_summary.columns = ['店舗', '合計金額', '領収書数']
-    
-    # ジャンルごとの合計金額
-    genre_summary = receipts_df.groupby('genre')['total'].agg(['sum', 'count']).reset_index()
-    genre_summary.columns = ['ジャンル', '合計金額', '領収書数']
-    
-    # 月ごとの合計金額（ISO8601形式から年月を抽出）
-    receipts_df['month'] = pd.to_datetime(receipts_df['datetime']).dt.strftime('%Y-%m')
-    monthly_summary = receipts_df.groupby('month')['total'].sum().reset_index()
-    monthly_summary.columns = ['年月', '合計金額']
-    
-    # 曜日別の集計も追加
-    receipts_df['weekday'] = pd.to_datetime(receipts_df['datetime']).dt.day_name()
-    weekday_summary = receipts_df.groupby('weekday')['total'].agg(['sum', 'count']).reset_index()
-    weekday_summary.columns = ['曜日', '合計金額', '領収書数']
-    
-    # Excelファイルに出力
-    with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
-        # 各データフレームをシートに書き込み
-        # レシート一覧シートには整形された日付も含める
-        receipts_display = receipts_df.copy()
-        receipts_display['datetime_formatted'] = receipts_display['formatted_date']
-        receipts_display = receipts_display.drop(columns=['formatted_date', 'month', 'weekday'])
-        receipts_display.to_excel(writer, sheet_name='レシート一覧', index=False)
-        
-        items_df.to_excel(writer, sheet_name='商品詳細', index=False)
-        store_summary.to_excel(writer, sheet_name='店舗別集計', index=False)
-        genre_summary.to_excel(writer, sheet_name='ジャンル別集計', index=False)
-        monthly_summary.to_excel(writer, sheet_name='月別集計', index=False)
-        weekday_summary.to_excel(writer, sheet_name='曜日別集計', index=False)
-        
-        # シート内の列幅を調整
-        for sheet_name in writer.sheets:
-            worksheet = writer.sheets[sheet_name]
-            for i, col in enumerate(writer.sheets[sheet_name].name.split(',')):
-                # 各列の最大幅を計算
-                if sheet_name == 'レシート一覧':
-                    # 日時列は幅を固定
-                    if i == receipts_display.columns.get_loc('datetime_formatted') if 'datetime_formatted' in receipts_display.columns else -1:
-                        worksheet.set_column(i, i, 20)
-                    else:
-                        worksheet.set_column(i, i, 15)
-                else:
-                    worksheet.set_column(i, i, 15)
-                    
-        # フォーマットの設定
-        workbook = writer.book
-        money_format = workbook.add_format({'num_format': '¥#,##0'})
-        
+
+    conn = db.get_connection()
+
+    # xlsxwriterは出力するときだけ読み込む（WebUIの起動を速くするため）
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(output_path, {'constant_memory': True})
+    header_format = workbook.add_format({'bold': True, 'border': 1})
+    money_format = workbook.add_format({'num_format': '¥#,##0'})
+
+    # レシート一覧シート（整形された日付も含める）
+    stage_start = time.perf_counter()
+    _write_query(
+        workbook,
+        'レシート一覧',
+        f"SELECT receipts.id, stores.name, genres.name, receipts.datetime, receipts.total "
+        f"FROM receipts {dimensions.NAMES_JOIN_SQL} ORDER BY receipts.id",
+        header_format,
+        ['id', 'store', 'genre', 'datetime', 'total', 'datetime_formatted'],
+        # 日時列は幅を広めにする
+        widths=[(0, 4, 15), (5, 5, 20)],
+        convert=lambda row: list(row) + [format_datetime(row[3])],
+        progress=progress
+    )
+
+    stage_start = _observe_stage("receipts", stage_start)
+
+    # 商品詳細シート
+    _write_query(
+        workbook,
+        '商品詳細',
+        "SELECT id, receipt_id, name, price FROM items ORDER BY id",
+        header_format,
+        ['id', 'receipt_id', 'name', 'price'],
+        widths=[(0, 3, 15)],
+        progress=progress
+    )
+
+    stage_start = _observe_stage("items", stage_start)
+
+    # 集計シート（挿入時に集計済みのロールアップを読む）
+    summaries = [
+        ('店舗別集計', ['店舗', '合計金額', '領収書数'], rollups.get_name_summary(conn, "store")),
+        ('ジャンル別集計', ['ジャンル', '合計金額', '領収書数'], rollups.get_name_summary(conn, "genre")),
+        ('月別集計', ['年月', '合計金額'], conn.execute("SELECT month, total FROM rollup_month ORDER BY month").fetchall()),
+        ('曜日別集計', ['曜日', '合計金額', '領収書数'], rollups.get_weekday_summary(conn)),
+    ]
+    for sheet_name, headers, rows in summaries:
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.set_column(0, len(headers) - 1, 15)
         # 合計金額列に通貨フォーマットを適用
-        for sheet_name in ['店舗別集計', 'ジャンル別集計', '月別集計', '曜日別集計']:
-            worksheet = writer.sheets[sheet_name]
-            worksheet.set_column(1, 1, 15, money_format)  # 合計金額列
-    
-    conn.close()
+        worksheet.set_column(1, 1, 15, money_format)
+        for col, header in enumerate(headers):
+            worksheet.write(0, col, header, header_format)
+        _write_rows(worksheet, 1, rows, formats={1: money_format})
+
+    stage_start = _observe_stage("summaries", stage_start)
+
+    # ファイルへの書き出し（constant_memoryモードでも、最後にxlsx（zip）にまとめる処理がある）
+    workbook.close()
+    _observe_stage("close", stage_start)
     return f"Excelファイルが作成されました: {output_path}"
 
 
-# if __name__ == "__main__":
-#     # 使用例
-#     output_file = export_database_to_excel()
-#     print(output_file)
\ No newline at end of file
+def start_export_job(output_path=None) -> str:
+    """
+    Excelへの出力をバックグラウンドで開始する関数
+    進捗はget_export_jobで確認する
+
+    Args:
+        output_path (str, optional): 出力するExcelファイルのパス
+
+    Returns:
+        str: ジョブID
+    """
+    if output_path is None or output_path == "":
+        current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_path = f"receipts_data_{current_time}.xlsx"
+
+    conn = db.get_connection()
+    total = (conn.execute("SELECT COUNT(*) FROM receipts").fetchone()[0]
+             + conn.execute("SELECT COUNT(*) FROM items").fetchone()[0])
+
+    job_id = uuid.uuid4().hex
+    with _jobs_lock:
+        _jobs[job_id] = {"state": "running", "done": 0, "total": total, "output_path": output_path, "message": ""}
+
+    def progress(rows):
+        with _jobs_lock:
+            _jobs[job_id]["done"] += rows
+
+    def run():
+        try:
+            message = export_database_to_excel(output_path, progress=progress)
+            state = "done"
+        except Exception as e:
+            message = f"Excelファイルの作成に失敗しました: {e}"
+            state = "failed"
+        finally:
+            # 別スレッドの接続を閉じる
+            db.close_connection()
+        with _jobs_lock:
+            _jobs[job_id].update(state=state, message=message)
+
+    threading.Thread(target=run, daemon=True).start()
+    return job_id
+
+
+def get_export_job(job_id) -> dict:
+    """
+    バックグラウンドの出力の状態を取得する関数
+
+    Returns:
+        dict: state（running / done / failed）, done, total, output_path, message（ジョブがない場合はNone）
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+
+if __name__ == "__main__":
+    # 使用例
+    output_file = export_database_to_excel()
+    print(output_file)
@@ -0,0 +1,206 @@
+import argparse
+import csv
+import json
+import os
+import time
+import db
+import dimensions
+
+# receipts・itemsをCSV / JSON Lines / Parquet形式で出力する
+# 分析用に毎晩取り込む場合は incremental=True にすると、前回出力した行より後に追加された行だけを出力する
+# （前回どこまで出力したか（ウォーターマーク）は、出力先・形式・テーブルごとにexport_watermarksテーブルに保存する）
+
+# 出力できる形式
+FORMATS = ("csv", "jsonl", "parquet")
+
+# 一度にデータベースから読み込む行数
+CHUNK_SIZE = 10000
+
+# テーブルごとの出力する列とクエリ
+# monthはParquetの分割（パーティション）に使う
+TABLES = {
+    "receipts": (
+        ["id", "store", "genre", "datetime", "date", "month", "total"],
+        f'''
+            SELECT receipts.id, stores.name, genres.name, receipts.datetime, receipts.date, receipts.month, receipts.total
+            FROM receipts {dimensions.NAMES_JOIN_SQL}
+            WHERE receipts.id > ? AND receipts.id <= ?
+            ORDER BY receipts.id
+        ''',
+    ),
+    "items": (
+        ["id", "receipt_id", "name", "price", "month"],
+        '''
+            SELECT items.id, items.receipt_id, items.name, items.price, receipts.month
+            FROM items LEFT JOIN receipts ON receipts.id = items.receipt_id
+            WHERE items.id > ? AND items.id <= ?
+            ORDER BY items.id
+        ''',
+    ),
+}
+
+
+def _watermark_name(output_dir, file_format, table):
+    return f"{os.path.abspath(output_dir)}|{file_format}|{table}"
+
+
+def get_watermark(output_dir, file_format, table) -> int:
+    """
+    前回出力した最後の行のIDを取得する関数（出力したことがない場合は0）
+    """
+    row = db.get_connection().execute(
+        "SELECT last_id FROM export_watermarks WHERE name = ?",
+        (_watermark_name(output_dir, file_format, table),)
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def _save_watermark(output_dir, file_format, table, last_id):
+    with db.transaction() as conn:
+        conn.execute(
+            '''
+                INSERT INTO export_watermarks (name, last_id, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET last_id = excluded.last_id, updated_at = excluded.updated_at
+            ''',
+            (_watermark_name(output_dir, file_format, table), last_id, time.time())
+        )
+
+
+def _iter_chunks(query, params):
+    # クエリの結果をCHUNK_SIZE行ずつ返す
+    cursor = db.get_connection().execute(query, params)
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        yield rows
+
+
+def _write_csv(path, columns, chunks):
+    rows_written = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for rows in chunks:
+            writer.writerows(rows)
+            rows_written += len(rows)
+    return rows_written, [path]
+
+
+def _write_jsonl(path, columns, chunks):
+    rows_written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for rows in chunks:
+            for row in rows:
+                f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                f.write("\n")
+            rows_written += len(rows)
+    return rows_written, [path]
+
+
+def _write_parquet(table_dir, file_name, columns, chunks):
+    # pyarrowはParquetで出力する場合にだけ必要
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("Parquet形式で出力するにはpyarrowをインストールしてください")
+
+    # 列の型（値がすべてNULLのチャンクがあっても型が変わらないように固定する）
+    types = {"id": pa.int64(), "receipt_id": pa.int64(), "total": pa.float64(), "price": pa.float64()}
+    schema = pa.schema([(column, types.get(column, pa.string())) for column in columns])
+
+    # 年月ごとにフォルダを分けて出力する（month=YYYY-MM/）
+    month_index = columns.index("month")
+    writers = {}
+    rows_written = 0
+    try:
+        for rows in chunks:
+            partitions = {}
+            for row in rows:
+                partitions.setdefault(row[month_index] or "unknown", []).append(row)
+
+            for month, partition_rows in partitions.items():
+                batch = pa.Table.from_pylist([dict(zip(columns, row)) for row in partition_rows], schema=schema)
+                if month not in writers:
+                    partition_dir = os.path.join(table_dir, f"month={month}")
+                    os.makedirs(partition_dir, exist_ok=True)
+                    path = os.path.join(partition_dir, f"{file_name}.parquet")
+                    writers[month] = (pq.ParquetWriter(path, schema), path)
+                writers[month][0].write_table(batch)
+            rows_written += len(rows)
+    finally:
+        for writer, _ in writers.values():
+            writer.close()
+    return rows_written, [path for _, path in writers.values()]
+
+
+def export_table(table, file_format="csv", output_dir="exports", incremental=False) -> dict:
+    """
+    テーブルを1つ、指定した形式でファイルに出力する関数
+    データベースから少しずつ読み込みながら書き込むので、件数が多くても使用メモリは一定
+
+    Args:
+        table (str): テーブル名（receipts or items）
+        file_format (str): 出力形式（csv / jsonl / parquet）
+        output_dir (str): 出力先のフォルダ（テーブルごとにサブフォルダを作る）
+        incremental (bool): Trueの場合は前回出力した行より後に追加された行だけを出力する
+
+    Returns:
+        dict: table, rows（出力した行数）, files（出力したファイル）, last_id（出力した最後の行のID）
+    """
+    if table not in TABLES:
+        raise Exception(f"出力できないテーブルです: {table}")
+    if file_format not in FORMATS:
+        raise Exception(f"出力できない形式です: {file_format}")
+
+    columns, query = TABLES[table]
+    first_id = get_watermark(output_dir, file_format, table) if incremental else 0
+    # 出力中に追加された行は次回に回す（ウォーターマークを正確にするため）
+    last_id = db.get_connection().execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+
+    if last_id <= first_id:
+        return {"table": table, "rows": 0, "files": [], "last_id": first_id}
+
+    table_dir = os.path.join(output_dir, table)
+    os.makedirs(table_dir, exist_ok=True)
+    # ファイル名には出力した行のIDの範囲を入れる
+    file_name = f"{table}_{first_id + 1}-{last_id}"
+    chunks = _iter_chunks(query, (first_id, last_id))
+
+    if file_format == "csv":
+        rows, files = _write_csv(os.path.join(table_dir, f"{file_name}.csv"), columns, chunks)
+    elif file_format == "jsonl":
+        rows, files = _write_jsonl(os.path.join(table_dir, f"{file_name}.jsonl"), columns, chunks)
+    else:
+        rows, files = _write_parquet(table_dir, file_name, columns, chunks)
+
+    # 書き込みがすべて成功してからウォーターマークを進める
+    _save_watermark(output_dir, file_format, table, last_id)
+    return {"table": table, "rows": rows, "files": files, "last_id": last_id}
+
+
+def export_database(file_format="csv", output_dir="exports", incremental=False) -> list:
+    """
+    receiptsとitemsを指定した形式でファイルに出力する関数
+
+    Returns:
+        list: テーブルごとのexport_tableの結果
+    """
+    return [export_table(table, file_format, output_dir, incremental) for table in TABLES]
+
+
+if __name__ == "__main__":
+    # 使用例:
+    #   python db_to_files.py --format parquet --output exports
+    #   python db_to_files.py --format jsonl --output exports --incremental  # 毎晩の差分出力
+    parser = argparse.ArgumentParser(description="receipts・itemsをCSV / JSON Lines / Parquet形式で出力する")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--output", default="exports", help="出力先のフォルダ")
+    parser.add_argument("--incremental", action="store_true", help="前回の出力より後に追加された行だけを出力する")
+    args = parser.parse_args()
+
+    for result in export_database(args.format, args.output, args.incremental):
+        print(f"{result['table']}: {result['rows']}行を出力しました（最後のID: {result['last_id']}）")
+        for path in result["files"]:
+            print(f"  {path}")
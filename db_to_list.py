@@ -1,6 +1,23 @@
-import sqlite3
-import pandas as pd
 from datetime import datetime
+import db
+import dimensions
+import query_cache
+import rollups
+
+# 以下の関数の結果は、データが更新されるまでquery_cacheにキャッシュされる
+# （タブを切り替えるたびに同じクエリを実行しないため）
+# 全件を返す関数（get_receipts_list, get_items_detail）はメモリを使いすぎるのでキャッシュしない
+# （WebUIの一覧はページ単位の関数を使う）
+
+def format_datetime(value):
+    """
+    ISO8601形式の日時を読みやすい形式（YYYY-MM-DD HH:MM:SS）に変換する関数
+    変換できない場合はそのまま返す
+    """
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M:%S')
+    except (AttributeError, ValueError):
+        return value
 
 def get_receipts_list():
     """
@@ -9,18 +26,15 @@ def get_receipts_list():
     Returns:
         list: レシート一覧の二次元配列（ヘッダーなし）
     """
-    db_path = "receipts.db"
-    conn = sqlite3.connect(db_path)
-    receipts_df = pd.read_sql_query("SELECT * FROM receipts", conn)
-    
-    # ISO8601形式の日時を読みやすい形式に変換
-    receipts_df['datetime_formatted'] = pd.to_datetime(receipts_df['datetime'], format='ISO8601').dt.strftime('%Y-%m-%d %H:%M:%S')
-    
-    # データのみを二次元配列として取得
-    result = receipts_df[['id', 'store', 'genre', 'datetime', 'total', 'datetime_formatted']].values.tolist()
+    conn = db.get_connection()
+    rows = conn.execute(f'''
+        SELECT receipts.id, stores.name, genres.name, receipts.datetime, receipts.total
+        FROM receipts {dimensions.NAMES_JOIN_SQL}
+        ORDER BY receipts.id
+    ''').fetchall()
     
-    conn.close()
-    return result
+    # ISO8601形式の日時を読みやすい形式に変換したものを末尾に追加
+    return [list(row) + [format_datetime(row[3])] for row in rows]
 
 def get_items_detail():
     """
@@ -29,16 +43,11 @@ def get_items_detail():
     Returns:
         list: 商品詳細の二次元配列（ヘッダーなし）
     """
-    db_path = "receipts.db"
-    conn = sqlite3.connect(db_path)
-    items_df = pd.read_sql_query("SELECT * FROM items", conn)
-    
-    # データのみを二次元配列として取得
-    result = items_df.values.tolist()
-    
-    conn.close()
-    return result
+    conn = db.get_connection()
+    rows = conn.execute("SELECT id, receipt_id, name, price FROM items ORDER BY id").fetchall()
+    return [list(row) for row in rows]
 
+@query_cache.cached
 def get_store_summary():
     """
     店舗別集計を二次元配列として取得する関数
@@ -46,19 +55,12 @@ def get_store_summary():
     Returns:
         list: 店舗別集計の二次元配列（ヘッダーなし）
     """
-    db_path = "receipts.db"
-    conn = sqlite3.connect(db_path)
-    receipts_df = pd.read_sql_query("SELECT * FROM receipts", conn)
-    
-    # 店舗ごとの合計金額と件数を集計
-    store_summary = receipts_df.groupby('store')['total'].agg(['sum', 'count']).reset_index()
-    
-    # データのみを二次元配列として取得
-    result = store_summary.values.tolist()
+    conn = db.get_connection()
     
-    conn.close()
-    return result
+    # 店舗ごとの合計金額と件数（挿入時に集計済みのロールアップを読む）
+    return rollups.get_name_summary(conn, "store")
 
+@query_cache.cached
 def get_genre_summary():
     """
     ジャンル別集計を二次元配列として取得する関数
@@ -66,19 +68,12 @@ def get_genre_summary():
     Returns:
         list: ジャンル別集計の二次元配列（ヘッダーなし）
     """
-    db_path = "receipts.db"
-    conn = sqlite3.connect(db_path)
-    receipts_df = pd.read_sql_query("SELECT * FROM receipts", conn)
-    
-    # ジャンルごとの合計金額と件数を集計
-    genre_summary = receipts_df.groupby('genre')['total'].agg(['sum', 'count']).reset_index()
-    
-    # データのみを二次元配列として取得
-    result = genre_summary.values.tolist()
+    conn = db.get_connection()
     
-    conn.close()
-    return result
+    # ジャンルごとの合計金額と件数（挿入時に集計済みのロールアップを読む）
+    return rollups.get_name_summary(conn, "genre")
 
+@query_cache.cached
 def get_monthly_summary():
     """
     月別集計を二次元配列として取得する関数
@@ -86,22 +81,316 @@ def get_monthly_summary():
     Returns:
         list: 月別集計の二次元配列（ヘッダーなし）
     """
-    db_path = "receipts.db"
-    conn = sqlite3.connect(db_path)
-    receipts_df = pd.read_sql_query("SELECT * FROM receipts", conn)
-    
-    # ISO8601形式の日時から年月を抽出
-    receipts_df['month'] = pd.to_datetime(receipts_df['datetime'], format='ISO8601').dt.strftime('%Y-%m')
+    conn = db.get_connection()
     
-    # 月ごとの合計金額を集計
-    monthly_summary = receipts_df.groupby('month')['total'].sum().reset_index()
+    # 月ごとの合計金額（挿入時に集計済みのロールアップを読む）
+    rows = conn.execute("SELECT month, total FROM rollup_month ORDER BY month").fetchall()
     
-    # データのみを二次元配列として取得
-    result = monthly_summary.values.tolist()
+    return [list(row) for row in rows]
+
+@query_cache.cached
+def get_weekday_summary():
+    """
+    曜日別集計を二次元配列として取得する関数
     
-    conn.close()
+    Returns:
+        list: 曜日別集計の二次元配列（ヘッダーなし）
+    """
+    conn = db.get_connection()
+    result = rollups.get_weekday_summary(conn)
     return result
 
+@query_cache.cached
+def get_daily_summary():
+    """
+    日別集計を二次元配列として取得する関数
+    
+    Returns:
+        list: 日別集計の二次元配列（ヘッダーなし）
+    """
+    conn = db.get_connection()
+    rows = conn.execute("SELECT date, total, count FROM rollup_day ORDER BY date").fetchall()
+    return [list(row) for row in rows]
+
+# 以下、ページ単位での取得（WebUIの一覧表示用）
+# 全件を返すとブラウザに送るデータが膨大になるため、条件の絞り込みと並び替えをSQLで行い、1ページ分だけ返す
+# ページ送りはOFFSETではなく「前のページの最後の行の値」から続きを読む方式（キーセットページネーション）なので、
+# 後ろのページでも読み飛ばしが発生しない
+
+# 1ページあたりの件数
+PAGE_SIZE = 50
+
+# 並び替えに使える列（表示名: 列）
+RECEIPT_SORTS = {"ID": "receipts.id", "日時": "receipts.datetime", "合計金額": "receipts.total"}
+ITEM_SORTS = {"ID": "items.id", "価格": "items.price"}
+
+def _receipt_conditions(store="", genre="", date_from="", date_to="", min_total=None, max_total=None, receipt_id=None):
+    """
+    レシートの絞り込み条件をSQLのWHERE句の条件とパラメータに変換する関数
+    空の条件は無視する
+    """
+    conditions = []
+    params = []
+    if receipt_id not in (None, ""):
+        conditions.append("receipts.id = ?")
+        params.append(int(receipt_id))
+    # 店舗名・ジャンル名は保存時と同じく正規化し、IDで絞り込む
+    if store:
+        conditions.append("receipts.store_id = (SELECT id FROM stores WHERE name = ?)")
+        params.append(dimensions.normalize_store(store))
+    if genre:
+        conditions.append("receipts.genre_id = (SELECT id FROM genres WHERE name = ?)")
+        params.append(dimensions.normalize_genre(genre))
+    if date_from:
+        conditions.append("receipts.date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("receipts.date <= ?")
+        params.append(date_to)
+    if min_total not in (None, ""):
+        conditions.append("receipts.total >= ?")
+        params.append(float(min_total))
+    if max_total not in (None, ""):
+        conditions.append("receipts.total <= ?")
+        params.append(float(max_total))
+    return conditions, params
+
+def _item_conditions(receipt_id=None, store="", genre="", date_from="", date_to="", min_price=None, max_price=None):
+    """
+    商品の絞り込み条件をSQLのWHERE句の条件とパラメータに変換する関数
+    店舗・ジャンル・日付で絞り込む場合はreceiptsテーブルを結合する
+
+    Returns:
+        tuple: (FROM句, 条件のリスト, パラメータのリスト)
+    """
+    conditions, params = _receipt_conditions(store=store, genre=genre, date_from=date_from, date_to=date_to)
+    from_sql = "items JOIN receipts ON receipts.id = items.receipt_id" if conditions else "items"
+
+    if receipt_id not in (None, ""):
+        conditions.append("items.receipt_id = ?")
+        params.append(int(receipt_id))
+    if min_price not in (None, ""):
+        conditions.append("items.price >= ?")
+        params.append(float(min_price))
+    if max_price not in (None, ""):
+        conditions.append("items.price <= ?")
+        params.append(float(max_price))
+    return from_sql, conditions, params
+
+def _keyset_condition(sort_column, id_column, descending, cursor):
+    """
+    前のページの最後の行 (並び替えの値, ID) より後ろの行だけを取得する条件を作る関数
+    SQLiteではNULLは昇順で先頭、降順で末尾に並ぶので、それに合わせる
+    """
+    last_value, last_id = cursor
+    if sort_column == id_column:
+        return (f"{id_column} < ?", [last_id]) if descending else (f"{id_column} > ?", [last_id])
+
+    if not descending:
+        if last_value is None:
+            return f"(({sort_column} IS NULL AND {id_column} > ?) OR {sort_column} IS NOT NULL)", [last_id]
+        return f"({sort_column} > ? OR ({sort_column} = ? AND {id_column} > ?))", [last_value, last_value, last_id]
+
+    if last_value is None:
+        return f"({sort_column} IS NULL AND {id_column} < ?)", [last_id]
+    return (f"({sort_column} < ? OR ({sort_column} = ? AND {id_column} < ?) OR {sort_column} IS NULL)",
+            [last_value, last_value, last_id])
+
+def _fetch_page(select_sql, from_sql, conditions, params, sort_column, id_column, descending, cursor, limit):
+    """
+    1ページ分の行と、次のページのカーソルを取得する関数
+
+    Returns:
+        tuple: (行のリスト, 次のページのカーソル（最後のページの場合はNone）)
+    """
+    conditions = list(conditions)
+    params = list(params)
+    if cursor is not None:
+        condition, condition_params = _keyset_condition(sort_column, id_column, descending, cursor)
+        conditions.append(condition)
+        params += condition_params
+
+    where_sql = "WHERE " + " AND ".join(conditions) if conditions else ""
+    direction = "DESC" if descending else "ASC"
+    order_sql = f"ORDER BY {id_column} {direction}" if sort_column == id_column else f"ORDER BY {sort_column} {direction}, {id_column} {direction}"
+
+    # 次のページがあるかを判定するため、1件多く取得する
+    rows = db.get_connection().execute(
+        f"SELECT {select_sql}, {sort_column} FROM {from_sql} {where_sql} {order_sql} LIMIT ?",
+        params + [limit + 1]
+    ).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        # 最後の行の (並び替えの値, ID) を次のページのカーソルにする
+        next_cursor = (rows[-1][-1], rows[-1][0])
+    return [list(row[:-1]) for row in rows], next_cursor
+
+@query_cache.cached
+def _count(from_sql, conditions, params):
+    """
+    条件に合う件数を取得する関数
+    同じ条件で、データが変わっていなければキャッシュした件数を返す
+    """
+    where_sql = "WHERE " + " AND ".join(conditions) if conditions else ""
+    return db.get_connection().execute(f"SELECT COUNT(*) FROM {from_sql} {where_sql}", params).fetchone()[0]
+
+@query_cache.cached
+def get_receipts_page(store="", genre="", date_from="", date_to="", min_total=None, max_total=None, receipt_id=None,
+                      sort="ID", descending=False, cursor=None, limit=PAGE_SIZE):
+    """
+    絞り込み・並び替えをしたレシート一覧を1ページ分取得する関数
+    
+    Args:
+        store, genre (str): 店舗名・ジャンル名（完全一致）
+        date_from, date_to (str): 日付の範囲（YYYY-MM-DD）
+        min_total, max_total (float): 合計金額の範囲
+        receipt_id (int): レシートID
+        sort (str): 並び替える列（RECEIPT_SORTSのキー）
+        descending (bool): 降順にするかどうか
+        cursor (tuple): 前のページの戻り値のカーソル（最初のページはNone）
+        limit (int): 1ページあたりの件数
+    
+    Returns:
+        tuple: (レシート一覧の二次元配列, 次のページのカーソル)
+    """
+    conditions, params = _receipt_conditions(store, genre, date_from, date_to, min_total, max_total, receipt_id)
+    rows, next_cursor = _fetch_page(
+        "receipts.id, (SELECT name FROM stores WHERE id = receipts.store_id), "
+        "(SELECT name FROM genres WHERE id = receipts.genre_id), receipts.datetime, receipts.total",
+        "receipts", conditions, params,
+        RECEIPT_SORTS.get(sort, "receipts.id"), "receipts.id", descending, cursor, limit
+    )
+    return [row + [format_datetime(row[3])] for row in rows], next_cursor
+
+def count_receipts(store="", genre="", date_from="", date_to="", min_total=None, max_total=None, receipt_id=None):
+    """
+    条件に合うレシートの件数を取得する関数
+    """
+    conditions, params = _receipt_conditions(store, genre, date_from, date_to, min_total, max_total, receipt_id)
+    return _count("receipts", tuple(conditions), tuple(params))
+
+@query_cache.cached
+def get_items_page(receipt_id=None, store="", genre="", date_from="", date_to="", min_price=None, max_price=None,
+                   sort="ID", descending=False, cursor=None, limit=PAGE_SIZE):
+    """
+    絞り込み・並び替えをした商品詳細を1ページ分取得する関数
+    
+    Args:
+        receipt_id (int): レシートID
+        store, genre (str): 店舗名・ジャンル名（完全一致）
+        date_from, date_to (str): レシートの日付の範囲（YYYY-MM-DD）
+        min_price, max_price (float): 価格の範囲
+        sort (str): 並び替える列（ITEM_SORTSのキー）
+        descending (bool): 降順にするかどうか
+        cursor (tuple): 前のページの戻り値のカーソル（最初のページはNone）
+        limit (int): 1ページあたりの件数
+    
+    Returns:
+        tuple: (商品詳細の二次元配列, 次のページのカーソル)
+    """
+    from_sql, conditions, params = _item_conditions(receipt_id, store, genre, date_from, date_to, min_price, max_price)
+    return _fetch_page(
+        "items.id, items.receipt_id, items.name, items.price",
+        from_sql, conditions, params,
+        ITEM_SORTS.get(sort, "items.id"), "items.id", descending, cursor, limit
+    )
+
+def count_items(receipt_id=None, store="", genre="", date_from="", date_to="", min_price=None, max_price=None):
+    """
+    条件に合う商品の件数を取得する関数
+    """
+    from_sql, conditions, params = _item_conditions(receipt_id, store, genre, date_from, date_to, min_price, max_price)
+    return _count(from_sql, tuple(conditions), tuple(params))
+
+@query_cache.cached
+def get_store_names():
+    """
+    店舗名の一覧を取得する関数（絞り込みの選択肢用）
+    """
+    return [row[0] for row in rollups.get_name_summary(db.get_connection(), "store")]
+
+@query_cache.cached
+def get_genre_names():
+    """
+    ジャンル名の一覧を取得する関数（絞り込みの選択肢用）
+    """
+    return [row[0] for row in rollups.get_name_summary(db.get_connection(), "genre")]
+
+# 以下、商品の検索
+
+# 検索結果の最大件数の既定値
+SEARCH_LIMIT = 100
+
+# trigramトークナイザーで検索できる最短の文字数（これより短い場合はLIKEで検索する）
+FTS_MIN_LENGTH = 3
+
+def _has_fts():
+    row = db.get_connection().execute("SELECT 1 FROM sqlite_master WHERE name = 'items_fts'").fetchone()
+    return row is not None
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+@query_cache.cached
+def search_items(query, prefix=False, limit=SEARCH_LIMIT):
+    """
+    商品名・店舗名で商品を検索する関数
+    全文検索のインデックス（items_fts）を使うので、件数が多くても全件を読まずに検索できる
+    
+    Args:
+        query (str): 検索する文字列（部分一致）
+        prefix (bool): Trueの場合は商品名の前方一致で検索する
+        limit (int): 返す件数の上限（関連度の高い順）
+    
+    Returns:
+        dict: rows（[商品ID, レシートID, 商品名, 価格, 店舗, 日時] の二次元配列）,
+              count（該当する商品の件数）, total（該当する商品の合計金額）
+    """
+    query = (query or "").strip()
+    if query == "":
+        return {"rows": [], "count": 0, "total": 0}
+
+    conn = db.get_connection()
+    select_sql = '''
+        SELECT items.id, items.receipt_id, items.name, items.price, stores.name, receipts.datetime
+    '''
+    like_pattern = _escape_like(query) + "%" if prefix else "%" + _escape_like(query) + "%"
+
+    if _has_fts() and len(query) >= FTS_MIN_LENGTH:
+        # フレーズとして検索する（"は""にエスケープする）
+        match = '"' + query.replace('"', '""') + '"'
+        from_sql = '''
+            FROM items_fts
+            JOIN items ON items.id = items_fts.rowid
+            LEFT JOIN receipts ON receipts.id = items.receipt_id
+            LEFT JOIN stores ON stores.id = receipts.store_id
+            WHERE items_fts MATCH ?
+        '''
+        params = [match]
+        if prefix:
+            from_sql += " AND items_fts.name LIKE ? ESCAPE '\\'"
+            params.append(like_pattern)
+        order_sql = "ORDER BY items_fts.rank"
+    else:
+        # 短い文字列はインデックスを使えないので、LIKEで検索する
+        from_sql = '''
+            FROM items
+            LEFT JOIN receipts ON receipts.id = items.receipt_id
+            LEFT JOIN stores ON stores.id = receipts.store_id
+            WHERE items.name LIKE ? ESCAPE '\\'
+        '''
+        params = [like_pattern]
+        if not prefix:
+            from_sql += " OR stores.name LIKE ? ESCAPE '\\'"
+            params.append(like_pattern)
+        order_sql = "ORDER BY items.id DESC"
+
+    rows = conn.execute(f"{select_sql} {from_sql} {order_sql} LIMIT ?", params + [int(limit)]).fetchall()
+    count, total = conn.execute(f"SELECT COUNT(*), COALESCE(SUM(items.price), 0) {from_sql}", params).fetchone()
+    return {"rows": [list(row) for row in rows], "count": count, "total": total}
+
 def export_all_data():
     """
     すべてのデータを取得し、辞書形式で返す関数
@@ -0,0 +1,95 @@
+import re
+import unicodedata
+
+# 店舗名・ジャンル名をstores・genresテーブルに1回だけ保存し、receiptsには整数のID（store_id, genre_id）を保存する
+# 同じ名前を何度も保存しないのでデータベースが小さくなり、集計も文字列ではなく整数で比較できる
+# AIが出力する名前は表記が揺れる（全角・半角、空白、「食品」と「食料品」など）ので、保存する前に正規化する
+
+# 正規化した後の名前 → 統一する名前
+# 表記が揺れる名前を見つけたら追加する（追加しても保存済みのデータは変わらない）
+GENRE_ALIASES = {
+    "食料品": "食品",
+    "食料": "食品",
+    "食べ物": "食品",
+    "生鮮食品": "食品",
+    "飲み物": "飲料",
+    "ドリンク": "飲料",
+    "本": "書籍",
+    "雑誌": "書籍",
+    "家電製品": "家電",
+    "電化製品": "家電",
+    "衣類": "衣料品",
+    "洋服": "衣料品",
+    "衣料": "衣料品",
+    "外食": "飲食",
+    "飲食店": "飲食",
+    "レストラン": "飲食",
+}
+STORE_ALIASES = {}
+
+# (テーブル名, receiptsの列名, 別名の辞書)
+DIMENSIONS = {
+    "store": ("stores", "store_id", STORE_ALIASES),
+    "genre": ("genres", "genre_id", GENRE_ALIASES),
+}
+
+# receiptsに店舗名・ジャンル名（stores.name, genres.name）を結合するFROM句の続き（表示・出力用）
+NAMES_JOIN_SQL = "LEFT JOIN stores ON stores.id = receipts.store_id LEFT JOIN genres ON genres.id = receipts.genre_id"
+
+
+def normalize_name(name, aliases=None):
+    """
+    店舗名・ジャンル名を正規化する関数
+    全角英数字・半角カナをNFKCで統一し、前後の空白を除いて連続する空白を1つにした後、別名を統一する
+
+    Returns:
+        str: 正規化した名前（空の場合はNone）
+    """
+    if name is None:
+        return None
+    name = re.sub(r"\s+", " ", unicodedata.normalize("NFKC", str(name))).strip()
+    if name == "":
+        return None
+    return (aliases or {}).get(name, name)
+
+
+def normalize_store(name):
+    return normalize_name(name, STORE_ALIASES)
+
+
+def normalize_genre(name):
+    return normalize_name(name, GENRE_ALIASES)
+
+
+def normalize_response(response) -> dict:
+    """
+    解析結果の店舗名・ジャンル名を正規化したコピーを返す関数（元の辞書は変更しない）
+    """
+    return dict(response, store=normalize_store(response.get("store")), genre=normalize_genre(response.get("genre")))
+
+
+def get_ids(conn, kind, names) -> dict:
+    """
+    正規化した名前のIDを取得する関数（ない名前はテーブルに追加する）
+    レシートを保存するトランザクションの中で呼ぶ
+
+    Args:
+        conn: トランザクション中の接続
+        kind (str): "store" または "genre"
+        names (iterable): 正規化した名前（Noneは無視する）
+
+    Returns:
+        dict: {名前: ID}
+    """
+    table = DIMENSIONS[kind][0]
+    names = list({name for name in names if name is not None})
+    if not names:
+        return {}
+    conn.executemany(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", [(name,) for name in names])
+    ids = {}
+    # SQLiteのパラメータ数の上限を超えないように分けて取得する
+    for start in range(0, len(names), 500):
+        chunk = names[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        ids.update(conn.execute(f"SELECT name, id FROM {table} WHERE name IN ({placeholders})", chunk).fetchall())
+    return ids
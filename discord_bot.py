@@ -1,8 +1,8 @@
-import tempfile
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import discord
-from postimage import main_process
+from postimage import main_process_data
 import json
-import os
 
 
 # 設定ファイルの読み込み なんかうまくいかないので修正する
@@ -12,15 +12,71 @@ with open("config.json", 'r') as config_file:
 TOKEN = config["discord_bot_token"]
 # 接続するチャンネルID
 CHANNEL_ID = config["discord_channel_id"]
+# 同時に解析する画像の最大枚数
+MAX_WORKERS = config.get("discord_max_workers", 4)
+# 解析待ちにできる画像の最大枚数（これを超えると受け付けない）
+QUEUE_SIZE = config.get("discord_queue_size", 20)
+
+# discordのメッセージの最大文字数
+MESSAGE_LIMIT = 2000
 
 intents = discord.Intents.default()
 intents.message_content = True
 client = discord.Client(intents=intents)
 
+# 解析待ちの画像のキュー（(添付ファイル, 処理中メッセージ)を入れる）
+job_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+# 解析（同期処理）を実行するスレッドプール
+# イベントループ上で実行するとその間ボット全体が止まってしまうため、別スレッドで実行する
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+workers = []
+
+
+async def send_result(ack_message, text):
+    """
+    処理中メッセージを結果で書き換える関数
+    2000文字を超える場合は、残りを続けて送信する
+    """
+    await ack_message.edit(content=text[:MESSAGE_LIMIT])
+    for i in range(MESSAGE_LIMIT, len(text), MESSAGE_LIMIT):
+        await ack_message.channel.send(text[i:i+MESSAGE_LIMIT])
+
+
+async def worker():
+    """
+    キューから画像を取り出して解析するワーカー
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        attachment, ack_message = await job_queue.get()
+        try:
+            # 画像のdl
+            image_data = await attachment.read()
+
+            # 画像をメモリ上のままAIに投げて結果を取得（一時ファイルは作らない）
+            result = await loop.run_in_executor(executor, main_process_data, image_data, "")
+            text = "**分析結果**\n" + result
+        except Exception as e:
+            text = f"**分析に失敗しました**\n{e}"
+
+        try:
+            await send_result(ack_message, text)
+        except discord.HTTPException as e:
+            print(f"結果の送信に失敗しました: {e}")
+        finally:
+            job_queue.task_done()
+
+
 @client.event
 async def on_ready():
     # ログインしたらターミナルにログイン通知が表示される
     print("ログインしました")
+
+    # ワーカーを起動する（再接続でon_readyが複数回呼ばれても1回だけ）
+    if not workers:
+        for _ in range(MAX_WORKERS):
+            workers.append(asyncio.create_task(worker()))
+
     channel = client.get_channel(CHANNEL_ID)
     await channel.send('botが起動しました')
 
@@ -36,29 +92,14 @@ async def on_message(message):
         if len(message.attachments) > 0:
             for index, attachment in enumerate(message.attachments, start=1):
                 # 画像の場合
-                if attachment.content_type.startswith("image"):
-                    # 画像のdl
-                    image_data = await attachment.read()
-
-                    # 一時ファイルに保存
-                    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tf:
-                        tf.write(image_data)
-                        image_path = tf.name
-
-                        # 画像をAIに投げて結果を取得
-                        response = "**分析結果**\n" + main_process(image_path, "", is_discord=True)
-                        
-                        # 結果をチャンネルに送信
-                        if len(response) > 2000:
-                            # 2000文字以上の場合は分割して送信
-                            for i in range(0, len(response), 2000):
-                                await message.channel.send(response[i:i+2000])
-
-                        await message.channel.send(response)
-                        
-                    # 画像を削除する
-                    os.remove(image_path)
+                if (attachment.content_type or "").startswith("image"):
+                    # 処理中であることを通知し、解析はワーカーに任せてすぐに戻る
+                    ack_message = await message.reply(f"画像{index}を解析しています…")
+                    try:
+                        job_queue.put_nowait((attachment, ack_message))
+                    except asyncio.QueueFull:
+                        # キューがいっぱいの場合は受け付けない
+                        await ack_message.edit(content=f"混雑しているため画像{index}を受け付けられませんでした。しばらくしてから再度送信してください")
 
 # botを起動する
 client.run(TOKEN)
-
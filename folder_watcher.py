@@ -0,0 +1,307 @@
+import argparse
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import bulk_insert
+import metrics
+import postimage
+
+# フォルダを監視して、新しく置かれた画像を順次解析・保存する（常駐用）
+# スキャナーやスマホの同期で置かれた画像を数秒で取り込み、まとめて置かれた場合も少しずつ処理する
+#
+# ファイルの検知:
+#   watchdogがインストールされている場合は、OSの通知（Linuxはinotify）で検知する
+#   インストールされていない場合や、通知を使えない場合はPOLL_INTERVAL秒ごとにフォルダを確認する
+# 書き込み途中の画像を読まないように、サイズと更新時刻がSETTLE_SECONDS秒変わらなくなってから処理する
+# 成功した画像はsuccessフォルダに、失敗した画像は理由（.error.txt）と一緒にquarantineフォルダに移動する
+
+# 処理する画像の拡張子
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+# 書き込み途中のファイル（同期アプリやブラウザが使う一時ファイル）は処理しない
+TEMP_SUFFIXES = (".tmp", ".part", ".crdownload", ".partial")
+# サイズと更新時刻がこの秒数変わらなければ、書き込みが終わったとみなす
+SETTLE_SECONDS = 2.0
+# ポーリングでフォルダを確認する間隔（秒）
+POLL_INTERVAL = 1.0
+# OSの通知を使う場合も、取りこぼしに備えてこの間隔（秒）でフォルダを確認する
+RESCAN_INTERVAL = 30.0
+# 失敗した画像の移動先
+QUARANTINE_FOLDER = postimage.QUARANTINE_FOLDER
+
+
+def _is_image(path) -> bool:
+    name = os.path.basename(path).lower()
+    if name.startswith(".") or name.endswith(TEMP_SUFFIXES):
+        return False
+    return name.endswith(IMAGE_EXTENSIONS)
+
+
+def _start_observer(folder_path, on_change):
+    # watchdogでフォルダの変更を通知する（使えない場合はNoneを返し、ポーリングにする）
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.is_directory:
+                return
+            # 移動の場合は移動先（同期アプリが一時ファイルを名前変更する場合など）
+            on_change(getattr(event, "dest_path", "") or event.src_path)
+
+    observer = Observer()
+    try:
+        observer.schedule(Handler(), folder_path, recursive=False)
+        observer.start()
+    except OSError as e:
+        # inotifyの監視数の上限などで使えない場合
+        print(f"フォルダの変更の通知を使えないため、ポーリングで監視します: {e}")
+        return None
+    return observer
+
+
+class FolderWatcher:
+    """
+    フォルダを監視して、新しい画像を解析・保存するクラス
+    run()を呼ぶとstop()が呼ばれるまで処理を続ける
+
+    Args:
+        folder_path (str): 監視するフォルダ（空の場合はimages）
+        api_key (str): APIキー（空の場合は環境変数から取得）
+        max_workers (int): 同時に処理するリクエストの最大数
+        batch_images (int): 1リクエストにまとめる画像の最大枚数（postimage.analyze_imagesを使う）
+        settle_seconds (float): 書き込みが終わったとみなすまでの秒数
+        poll_interval (float): ポーリングの間隔（秒）
+        use_events (bool): watchdogがある場合にOSの通知を使うかどうか（Falseの場合は常にポーリング）
+        success_folder (str): 成功した画像の移動先
+        quarantine_folder (str): 失敗した画像の移動先
+    """
+
+    def __init__(self, folder_path="", api_key="", max_workers=postimage.DEFAULT_MAX_WORKERS,
+                 batch_images=postimage.DEFAULT_BATCH_IMAGES, settle_seconds=SETTLE_SECONDS,
+                 poll_interval=POLL_INTERVAL, use_events=True, success_folder=postimage.SUCCESS_FOLDER,
+                 quarantine_folder=QUARANTINE_FOLDER):
+        self.folder_path = folder_path or "images"
+        self.api_key = api_key
+        self.max_workers = max(1, int(max_workers))
+        self.batch_images = max(1, int(batch_images))
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.use_events = use_events
+        self.success_folder = success_folder
+        self.quarantine_folder = quarantine_folder
+
+        # 書き込みが終わるのを待っている画像 {パス: ((サイズ, 更新時刻), 変化がなくなった時刻, 見つけた時刻)}
+        self._candidates = {}
+        # 処理中の画像
+        self._in_flight = set()
+        # 移動できなかったため、再び処理しない画像
+        self._ignored = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.stats = {"success": 0, "quarantine": 0}
+
+    def stop(self):
+        """
+        監視を終了する（処理中の画像は最後まで処理する）
+        """
+        self._stop.set()
+        self._wake.set()
+
+    def _notify(self, path):
+        # ファイルが作成・変更された（通知のスレッドから呼ばれる）
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.folder_path) and _is_image(path):
+            with self._lock:
+                if path not in self._in_flight and path not in self._ignored:
+                    self._candidates.setdefault(path, (None, 0.0, time.monotonic()))
+            self._wake.set()
+
+    def _scan(self):
+        try:
+            entries = list(os.scandir(self.folder_path))
+        except FileNotFoundError:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for entry in entries:
+                if entry.is_file() and _is_image(entry.path) and entry.path not in self._in_flight \
+                        and entry.path not in self._ignored:
+                    self._candidates.setdefault(entry.path, (None, 0.0, now))
+
+    def _take_ready(self, limit) -> list:
+        # サイズと更新時刻がsettle_seconds秒変わっていない画像を、最大limit枚取り出す
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, (signature, since, found) in list(self._candidates.items()):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # 処理前に削除・移動された
+                    del self._candidates[path]
+                    continue
+                current = (stat.st_size, stat.st_mtime_ns)
+                if current != signature:
+                    self._candidates[path] = (current, now, found)
+                elif stat.st_size > 0 and now - since >= self.settle_seconds and len(ready) < limit:
+                    del self._candidates[path]
+                    self._in_flight.add(path)
+                    ready.append((path, found))
+        return ready
+
+    def _process(self, model, group):
+        # groupの画像を解析して保存し、成功した画像をsuccessフォルダに、失敗した画像をquarantineフォルダに移動する
+        paths = [path for path, _ in group]
+        try:
+            image_data_list = []
+            for path in paths:
+                with metrics.timer("receipt_stage_seconds", stage="read"):
+                    with open(path, "rb") as image_file:
+                        image_data_list.append(image_file.read())
+
+            if len(paths) > 1:
+                try:
+                    responses = postimage.analyze_images(model, image_data_list, max_images=self.batch_images)
+                except Exception:
+                    # どの画像が原因かわからないので、1枚ずつ解析し直す（解析できた画像はキャッシュから返る）
+                    responses = [self._analyze_one(model, image_data) for image_data in image_data_list]
+            else:
+                responses = [self._analyze_one(model, image_data_list[0])]
+
+            saved = []
+            for (path, found), response in zip(group, responses):
+                if isinstance(response, Exception):
+                    self._quarantine(path, response)
+                elif not bulk_insert.is_valid_response(response):
+                    self._quarantine(path, Exception(f"レシートの解析結果の形式が正しくありません: {response}"))
+                else:
+                    saved.append((path, found, response))
+
+            if saved:
+                postimage.save_to_db([response for _, _, response in saved])
+            for path, found, _ in saved:
+                with metrics.timer("receipt_stage_seconds", stage="move"):
+                    postimage.move_unique(path, self.success_folder)
+                metrics.inc("receipt_watch_files_total", result="success")
+                metrics.observe("receipt_watch_delay_seconds", time.monotonic() - found)
+                with self._lock:
+                    self.stats["success"] += 1
+        except Exception as e:
+            # 保存や移動の失敗
+            traceback.print_exc()
+            for path in paths:
+                if os.path.exists(path):
+                    self._quarantine(path, e)
+        finally:
+            with self._lock:
+                self._in_flight.difference_update(paths)
+            self._wake.set()
+
+    def _analyze_one(self, model, image_data):
+        # 失敗した場合は例外を返す（他の画像の処理は続ける）
+        try:
+            return postimage.analyze_image(model, image_data)
+        except Exception as e:
+            return e
+
+    def _quarantine(self, path, error):
+        try:
+            postimage.quarantine_image(path, error, self.quarantine_folder)
+        except OSError as e:
+            print(f"画像を移動できませんでした（{path}）: {e}")
+            with self._lock:
+                self._ignored.add(path)
+        metrics.inc("receipt_watch_files_total", result="quarantine")
+        with self._lock:
+            self.stats["quarantine"] += 1
+
+    def run(self) -> dict:
+        """
+        stop()が呼ばれるまでフォルダを監視して、画像を処理する
+
+        Returns:
+            dict: {"success": 保存した画像の数, "quarantine": 失敗した画像の数}
+        """
+        os.makedirs(self.folder_path, exist_ok=True)
+        model = postimage.get_model(self.api_key)
+        observer = _start_observer(self.folder_path, self._notify) if self.use_events else None
+        print(f"{self.folder_path} を監視しています（{'OSの通知' if observer else 'ポーリング'}）")
+
+        # 同時に処理中にする画像の上限（多くの画像がまとめて置かれても、少しずつ処理する）
+        max_in_flight = self.max_workers * self.batch_images
+        # 書き込み待ちの画像を確認する間隔
+        check_interval = min(self.poll_interval, self.settle_seconds / 2) if self.settle_seconds > 0 else self.poll_interval
+        rescan_interval = RESCAN_INTERVAL if observer else self.poll_interval
+        last_scan = None
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                while not self._stop.is_set():
+                    now = time.monotonic()
+                    if last_scan is None or now - last_scan >= rescan_interval:
+                        self._scan()
+                        last_scan = now
+
+                    with self._lock:
+                        room = max_in_flight - len(self._in_flight)
+                    ready = self._take_ready(room) if room > 0 else []
+                    for start in range(0, len(ready), self.batch_images):
+                        executor.submit(self._process, model, ready[start:start + self.batch_images])
+
+                    self._wake.wait(check_interval)
+                    self._wake.clear()
+        finally:
+            if observer:
+                observer.stop()
+                observer.join()
+        return dict(self.stats)
+
+
+def watch_folder(folder_path="", api_key="", max_workers=postimage.DEFAULT_MAX_WORKERS,
+                 batch_images=postimage.DEFAULT_BATCH_IMAGES, settle_seconds=SETTLE_SECONDS,
+                 poll_interval=POLL_INTERVAL, use_events=True) -> dict:
+    """
+    フォルダを監視して、新しい画像を解析・保存する関数（Ctrl+Cで終了する）
+    引数はFolderWatcherと同じ
+
+    Returns:
+        dict: {"success": 保存した画像の数, "quarantine": 失敗した画像の数}
+    """
+    watcher = FolderWatcher(folder_path, api_key, max_workers, batch_images, settle_seconds,
+                            poll_interval, use_events)
+    thread = threading.Thread(target=watcher.run, daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            thread.join(0.5)
+    except KeyboardInterrupt:
+        print("監視を終了します（処理中の画像を待っています）")
+        watcher.stop()
+        thread.join()
+    return dict(watcher.stats)
+
+
+if __name__ == "__main__":
+    # 使用例:
+    #   python folder_watcher.py images
+    #   python folder_watcher.py images --workers 8 --batch-images 4 --settle 3
+    #   python folder_watcher.py images --polling --poll-interval 5
+    parser = argparse.ArgumentParser(description="フォルダを監視して、新しく置かれたレシート画像を解析・保存する")
+    parser.add_argument("folder", nargs="?", default="", help="監視するフォルダ（省略時はimages）")
+    parser.add_argument("--api-key", default="")
+    parser.add_argument("--workers", type=int, default=postimage.DEFAULT_MAX_WORKERS, help="同時に処理するリクエストの最大数")
+    parser.add_argument("--batch-images", type=int, default=postimage.DEFAULT_BATCH_IMAGES, help="1リクエストにまとめる画像の最大枚数")
+    parser.add_argument("--settle", type=float, default=SETTLE_SECONDS, help="書き込みが終わったとみなすまでの秒数")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="ポーリングの間隔（秒）")
+    parser.add_argument("--polling", action="store_true", help="OSの通知を使わず、常にポーリングで監視する")
+    args = parser.parse_args()
+
+    result = watch_folder(args.folder, args.api_key, args.workers, args.batch_images, args.settle,
+                          args.poll_interval, use_events=not args.polling)
+    print(f"保存: {result['success']}枚、失敗: {result['quarantine']}枚")
@@ -1,42 +1,30 @@
-import sqlite3
+import argparse
 import datetime
 import random
+import bulk_insert
+import db
 
-def insert_sample_data():
+def insert_sample_data(count=10, clear=True):
     """
     receipts.dbにサンプルデータを挿入する関数
-    10個のレシートと関連する商品データを作成
+    count個のレシートと関連する商品データを作成
+
+    Args:
+        count (int): 作成するレシートの数
+        clear (bool): Trueの場合は既存のデータを削除してから挿入する
+
+    Returns:
+        dict: bulk_insert.insert_receiptsの結果
     """
-    # データベースに接続
-    conn = sqlite3.connect("receipts.db")
-    cursor = conn.cursor()
-    
-    # テーブルがなければ作成
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS receipts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            store TEXT,
-            genre TEXT,
-            datetime TEXT,
-            total REAL
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            receipt_id TEXT,
-            name TEXT,
-            price REAL,
-            FOREIGN KEY (receipt_id) REFERENCES receipts (id)
-        )
-    ''')
-    
-    # 既存のデータをクリア（必要に応じてコメントアウト）
-    cursor.execute("DELETE FROM items")
-    cursor.execute("DELETE FROM receipts")
-    cursor.execute("DELETE FROM sqlite_sequence WHERE name='items' OR name='receipts'")
-    
+    # データベースに接続（テーブルの作成・更新も行われる）
+    if clear:
+        with db.transaction() as conn:
+            # 既存のデータをクリア
+            conn.execute("DELETE FROM items")
+            conn.execute("DELETE FROM receipts")
+            conn.execute("DELETE FROM sqlite_sequence WHERE name='items' OR name='receipts'")
+            db.bump_data_version(conn)
+
     # サンプルデータ - 店舗
     stores = ["セブンイレブン", "ファミリーマート", "ローソン", "イオン", "ユニクロ", "無印良品", "スターバックス", "マクドナルド", "吉野家", "すき家"]
     
@@ -95,45 +83,34 @@ def insert_sample_data():
                                                        minutes=random.randint(0, 59))
         return random_date.strftime("%Y-%m-%dT%H:%M:%S")
     
-    # レシートデータの作成と挿入
-    receipt_ids = []
-    for i in range(10):
-        store = random.choice(stores)
-        genre = store_to_genre[store]
-        
-        # レシートの日時（ISO8601形式）
-        receipt_datetime = random_datetime_iso8601()
+    # レシートデータを1件ずつ作るジェネレータ（件数が多くても全件をメモリに載せない）
+    def generate_receipts():
+        for i in range(count):
+            store = random.choice(stores)
+            genre = store_to_genre[store]
         
-        # レシートに含まれる商品の生成
-        num_items = random.randint(1, 5)  # 1~5個の商品
-        receipt_items = []
+            # レシートの日時（ISO8601形式）
+            receipt_datetime = random_datetime_iso8601()
         
-        # ジャンルに合った商品をランダムに選択
-        for _ in range(num_items):
-            item_name, item_price = random.choice(items_by_store[genre])
-            receipt_items.append((item_name, item_price))
+            # レシートに含まれる商品の生成
+            num_items = random.randint(1, 5)  # 1~5個の商品
+            receipt_items = []
         
-        # 合計金額の計算
-        total_amount = sum(item[1] for item in receipt_items)
+            # ジャンルに合った商品をランダムに選択
+            for _ in range(num_items):
+                item_name, item_price = random.choice(items_by_store[genre])
+                receipt_items.append({"name": item_name, "price": item_price})
         
-        # レシートの挿入
-        cursor.execute(
-            "INSERT INTO receipts (store, genre, datetime, total) VALUES (?, ?, ?, ?)",
-            (store, genre, receipt_datetime, total_amount)
-        )
+            # 合計金額の計算
+            total_amount = sum(item["price"] for item in receipt_items)
         
-        receipt_id = cursor.lastrowid
-        receipt_ids.append(receipt_id)
-        
-        # 商品の挿入
-        for item_name, item_price in receipt_items:
-            cursor.execute(
-                "INSERT INTO items (receipt_id, name, price) VALUES (?, ?, ?)",
-                (receipt_id, item_name, item_price)
-            )
-    
-    # コミットして変更を保存
-    conn.commit()
+            yield {"store": store, "genre": genre, "datetime": receipt_datetime,
+                   "total": total_amount, "items": receipt_items}
+
+    # executemanyでまとめて挿入する
+    result = bulk_insert.insert_receipts(generate_receipts())
+
+    cursor = db.get_connection().cursor()
     
     # 基本的な情報を表示
     cursor.execute("SELECT COUNT(*) FROM receipts")
@@ -142,13 +119,14 @@ def insert_sample_data():
     cursor.execute("SELECT COUNT(*) FROM items")
     item_count = cursor.fetchone()[0]
     
-    # 挿入したデータの概要を取得
-    cursor.execute("SELECT id, store, total FROM receipts")
+    # 挿入したデータの概要を取得（最初の10件）
+    cursor.execute('''
+        SELECT receipts.id, stores.name, receipts.total
+        FROM receipts LEFT JOIN stores ON stores.id = receipts.store_id
+        WHERE receipts.id >= ? ORDER BY receipts.id LIMIT 10
+    ''', (result["first_id"] or 0,))
     receipt_summary = cursor.fetchall()
     
-    # データベース接続を閉じる
-    conn.close()
-    
     print(f"サンプルデータの挿入が完了しました。")
     print(f"レシート数: {receipt_count}")
     print(f"商品数: {item_count}")
@@ -156,7 +134,14 @@ def insert_sample_data():
     for r in receipt_summary:
         print(f"ID: {r[0]}, 店舗: {r[1]}, 合計: {r[2]}円")
     
-    return receipt_ids
+    return result
 
 if __name__ == "__main__":
-    insert_sample_data()
\ No newline at end of file
+    # 使用例:
+    #   python insert_sampledata.py
+    #   python insert_sampledata.py --count 100000 --append
+    parser = argparse.ArgumentParser(description="receipts.dbにサンプルデータを挿入する")
+    parser.add_argument("--count", type=int, default=10, help="作成するレシートの数")
+    parser.add_argument("--append", action="store_true", help="既存のデータを削除せずに追加する")
+    args = parser.parse_args()
+    insert_sample_data(args.count, clear=not args.append)
\ No newline at end of file
@@ -0,0 +1,295 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+
+import db
+import postimage
+import stats
+
+# 1枚の画像を何回まで試すか（超えたらdeadにして諦める）
+MAX_ATTEMPTS = 3
+# 失敗後に再試行するまでの初期待ち時間（秒）、失敗するたびに倍になる
+RETRY_BACKOFF = 30
+# runningのまま、この秒数が経過したジョブは中断されたとみなして再実行する
+LEASE_SECONDS = 600
+# ジョブがないときに待つ秒数
+POLL_INTERVAL = 2
+
+# ジョブの状態
+# pending: 処理待ち（再試行待ちを含む）
+# running: 処理中
+# done: 完了（結果はreceiptsテーブルに保存済み）
+# dead: 規定回数失敗したため諦めた
+STATES = ("pending", "running", "done", "dead")
+
+
+def _file_hash(image_path) -> str:
+    h = hashlib.sha256()
+    with open(image_path, "rb") as image_file:
+        for chunk in iter(lambda: image_file.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def enqueue_folder(folder_path="") -> int:
+    """
+    フォルダ内の画像をジョブとして登録する関数
+    同じ内容の画像がすでに登録されている場合は登録しない
+
+    Args:
+        folder_path (str): 画像フォルダのパス（空の場合はimages）
+
+    Returns:
+        int: 新しく登録したジョブの数
+    """
+    if folder_path == "":
+        folder_path = "images"
+
+    image_list = sorted(glob.glob(os.path.join(folder_path, "*.jpg")))
+    now = time.time()
+
+    # ハッシュの計算は書き込みロックの外で行う
+    rows = [(image_path, _file_hash(image_path), now, now) for image_path in image_list]
+
+    added = 0
+    with db.transaction() as conn:
+        for row in rows:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO jobs (image_path, image_hash, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                row
+            )
+            added += cursor.rowcount
+    return added
+
+
+def claim_job(worker_id, lease_seconds=LEASE_SECONDS):
+    """
+    処理待ちのジョブを1件取得して処理中にする関数
+    中断されたまま期限が切れたジョブも再取得する
+    BEGIN IMMEDIATEで書き込みロックを取るため、複数プロセスから呼んでも同じジョブを重複して取得しない
+
+    Returns:
+        tuple | None: (ジョブID, 画像パス)、ジョブがない場合はNone
+    """
+    now = time.time()
+    with db.transaction() as conn:
+        row = conn.execute('''
+            SELECT id, image_path FROM jobs
+            WHERE (state = 'pending' AND next_attempt_at <= ?)
+               OR (state = 'running' AND claimed_at < ?)
+            ORDER BY id
+            LIMIT 1
+        ''', (now, now - lease_seconds)).fetchone()
+
+        if row is None:
+            return None
+
+        conn.execute('''
+            UPDATE jobs
+            SET state = 'running', worker = ?, claimed_at = ?, attempts = attempts + 1, updated_at = ?
+            WHERE id = ?
+        ''', (worker_id, now, now, row[0]))
+    return row
+
+
+def complete_job(job_id, response, worker_id) -> int:
+    """
+    解析結果をreceiptsテーブルに保存し、ジョブを完了にする関数
+    保存と状態の更新は同じトランザクションで行う
+    期限切れで他のワーカーに再取得されたジョブは保存しない（同じレシートを二重に保存しない）
+
+    Args:
+        worker_id (str): claim_jobに渡したワーカーの識別名
+
+    Returns:
+        int | None: 保存したレシートのID（ジョブを持っていなかった場合はNone）
+    """
+    with db.transaction() as conn:
+        # 先にジョブを完了にし、このワーカーが処理中のジョブだった場合だけ保存する
+        cursor = conn.execute('''
+            UPDATE jobs
+            SET state = 'done', result = ?, last_error = NULL, updated_at = ?
+            WHERE id = ? AND state = 'running' AND worker = ?
+        ''', (json.dumps(response, ensure_ascii=False), time.time(), job_id, worker_id))
+        if cursor.rowcount == 0:
+            return None
+
+        receipt_id = postimage.insert_receipt(conn.cursor(), response)
+        stats.add_responses(conn, [response])
+        db.bump_data_version(conn)
+        conn.execute("UPDATE jobs SET receipt_id = ? WHERE id = ?", (receipt_id, job_id))
+    return receipt_id
+
+
+def fail_job(job_id, error, worker_id, max_attempts=MAX_ATTEMPTS) -> bool:
+    """
+    ジョブを失敗として記録する関数
+    試行回数がmax_attemptsに達した場合はdeadにし、それ以外は時間をおいて再試行する
+    期限切れで他のワーカーに再取得されたジョブは変更しない
+
+    Returns:
+        bool: 記録した場合はTrue（ジョブを持っていなかった場合はFalse）
+    """
+    now = time.time()
+    with db.transaction() as conn:
+        row = conn.execute("SELECT attempts FROM jobs WHERE id = ? AND state = 'running' AND worker = ?",
+                           (job_id, worker_id)).fetchone()
+        if row is None:
+            return False
+        attempts = row[0]
+        if attempts >= max_attempts:
+            state, next_attempt_at = "dead", 0
+        else:
+            state, next_attempt_at = "pending", now + RETRY_BACKOFF * (2 ** (attempts - 1))
+        conn.execute('''
+            UPDATE jobs
+            SET state = ?, last_error = ?, next_attempt_at = ?, updated_at = ?
+            WHERE id = ?
+        ''', (state, str(error), next_attempt_at, now, job_id))
+    return True
+
+
+def retry_dead_jobs() -> int:
+    """
+    deadになったジョブを処理待ちに戻す関数
+
+    Returns:
+        int: 戻したジョブの数
+    """
+    with db.transaction() as conn:
+        cursor = conn.execute('''
+            UPDATE jobs SET state = 'pending', attempts = 0, next_attempt_at = 0, updated_at = ?
+            WHERE state = 'dead'
+        ''', (time.time(),))
+    return cursor.rowcount
+
+
+def get_job_status() -> dict:
+    """
+    状態ごとのジョブ数を取得する関数
+
+    Returns:
+        dict: {状態: 件数}
+    """
+    rows = db.get_connection().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+
+    status = {state: 0 for state in STATES}
+    status.update(dict(rows))
+    return status
+
+
+def run_worker(api_key="", worker_id=None, stop_when_empty=True, max_attempts=MAX_ATTEMPTS) -> int:
+    """
+    ジョブを1件ずつ取得して解析し、結果をすぐにデータベースに保存するワーカー
+    途中で止まっても、保存済みの結果は失われず、次回は続きから処理する
+
+    Args:
+        api_key (str): APIキー（空の場合は環境変数から取得）
+        worker_id (str): ワーカーの識別名（省略時はホスト名とプロセスID）
+        stop_when_empty (bool): ジョブがなくなったら終了するかどうか
+        max_attempts (int): 1枚の画像を何回まで試すか
+
+    Returns:
+        int: 完了したジョブの数
+    """
+    if worker_id is None:
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+    model = postimage.get_model(api_key)
+    done = 0
+
+    while True:
+        job = claim_job(worker_id)
+        if job is None:
+            if stop_when_empty:
+                # 再試行待ちのジョブが残っている場合は待つ
+                if get_job_status()["pending"] == 0:
+                    break
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        job_id, image_path = job
+        try:
+            with open(image_path, "rb") as image_file:
+                image_data = image_file.read()
+            response = postimage.analyze_image(model, image_data)
+            receipt_id = complete_job(job_id, response, worker_id)
+        except Exception as e:
+            print(f"ジョブ{job_id}が失敗しました（{image_path}）: {e}")
+            fail_job(job_id, e, worker_id, max_attempts=max_attempts)
+            continue
+
+        if receipt_id is None:
+            # 処理に時間がかかり、期限切れで他のワーカーに再取得された（保存は再取得したワーカーが行う）
+            print(f"ジョブ{job_id}は他のワーカーが処理しているため保存しません（{image_path}）")
+            continue
+
+        done += 1
+        print(f"ジョブ{job_id}を完了しました: レシートID {receipt_id}")
+
+        # 処理が成功した画像を別フォルダに移動する（同じ名前のファイルがある場合は名前に番号を付ける）
+        # 保存は完了しているので、移動に失敗してもワーカーは止めずに次のジョブを処理する
+        if os.path.exists(image_path):
+            try:
+                postimage.move_unique(image_path, postimage.SUCCESS_FOLDER)
+            except OSError as e:
+                print(f"ジョブ{job_id}の画像を移動できませんでした（{image_path}）: {e}")
+
+    return done
+
+
+def run_workers(api_key="", threads=1, stop_when_empty=True) -> int:
+    """
+    ワーカーを複数スレッドで実行する関数
+
+    Returns:
+        int: 完了したジョブの数
+    """
+    results = []
+
+    def target():
+        results.append(run_worker(api_key, stop_when_empty=stop_when_empty))
+
+    thread_list = [threading.Thread(target=target) for _ in range(threads)]
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+    return sum(results)
+
+
+if __name__ == "__main__":
+    # 使用例:
+    #   python job_queue.py enqueue images
+    #   python job_queue.py work --threads 4
+    #   python job_queue.py status
+    #   python job_queue.py retry-dead
+    parser = argparse.ArgumentParser(description="レシート画像の解析ジョブを管理する")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_enqueue = subparsers.add_parser("enqueue", help="フォルダ内の画像をジョブとして登録する")
+    parser_enqueue.add_argument("folder", nargs="?", default="")
+
+    parser_work = subparsers.add_parser("work", help="ジョブを処理する")
+    parser_work.add_argument("--api-key", default="")
+    parser_work.add_argument("--threads", type=int, default=1)
+    parser_work.add_argument("--forever", action="store_true", help="ジョブがなくなっても終了せずに待ち続ける")
+
+    subparsers.add_parser("status", help="状態ごとのジョブ数を表示する")
+    subparsers.add_parser("retry-dead", help="deadのジョブを処理待ちに戻す")
+
+    args = parser.parse_args()
+    if args.command == "enqueue":
+        print(f"{enqueue_folder(args.folder)}件のジョブを登録しました")
+    elif args.command == "work":
+        done = run_workers(args.api_key, threads=args.threads, stop_when_empty=not args.forever)
+        print(f"{done}件のジョブを完了しました")
+    elif args.command == "status":
+        print(json.dumps(get_job_status(), indent=4, ensure_ascii=False))
+    elif args.command == "retry-dead":
+        print(f"{retry_dead_jobs()}件のジョブを処理待ちに戻しました")
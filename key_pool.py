@@ -0,0 +1,268 @@
+import os
+import threading
+import time
+
+import metrics
+
+# 複数のAPIキーを使い分けて、レート制限（429）にかからないようにリクエストを送る
+# postimage.get_modelで、APIキーが複数ある場合（カンマ・改行区切り、または環境変数GEMINI_API_KEYS）や、
+# 環境変数GEMINI_RPM・GEMINI_TPMで上限を指定した場合に使われる
+#
+# APIキーごとに、1分あたりのリクエスト数（RPM）とトークン数（TPM）のトークンバケットを持ち、
+# 送信のたびに余裕が一番大きいキーを選ぶ（すべてのキーに余裕がない場合は、空くまで待つ）
+# 429が返ったキーはしばらく使わない（クールダウン、続けて429になるたびに倍になる）
+
+# 1分あたりの上限の既定値（0は無制限）
+DEFAULT_RPM = int(os.getenv("GEMINI_RPM", "0"))
+DEFAULT_TPM = int(os.getenv("GEMINI_TPM", "0"))
+# 429が返ったキーを使わない秒数の初期値と上限
+COOLDOWN_SECONDS = 30
+MAX_COOLDOWN_SECONDS = 600
+# 送信前に見積もるトークン数（画像1枚あたりの入力と、1件あたりの出力）
+# 実際のトークン数は応答のusage_metadataで精算する
+IMAGE_TOKENS = 258
+OUTPUT_TOKENS = 400
+# キーが空くまで待つ最大の秒数（超えた場合は429と同じ例外にして、呼び出し側の再試行に任せる）
+MAX_WAIT_SECONDS = 60
+
+
+def split_keys(api_key) -> list:
+    """
+    カンマ・改行区切りのAPIキーをリストにする関数（空の場合は環境変数GEMINI_API_KEYS・GEMINI_API_KEYから取得する）
+    """
+    if not (api_key or "").strip():
+        api_key = os.getenv("GEMINI_API_KEYS") or os.getenv("GEMINI_API_KEY") or ""
+    keys = [key.strip() for key in api_key.replace("\n", ",").split(",")]
+    # 重複を除く（順番は保つ）
+    return list(dict.fromkeys(key for key in keys if key))
+
+
+def mask_key(api_key) -> str:
+    """
+    APIキーを表示用に伏せ字にする関数（先頭4文字と末尾4文字だけ残す）
+    """
+    if len(api_key) <= 8:
+        return "*" * len(api_key)
+    return f"{api_key[:4]}...{api_key[-4:]}"
+
+
+def _is_quota_error(error) -> bool:
+    from google.api_core import exceptions as google_exceptions
+    return isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests))
+
+
+def _estimate_tokens(contents) -> int:
+    # 画像の数と文字数からおおよそのトークン数を見積もる
+    images = sum(1 for part in contents if isinstance(part, dict))
+    text = sum(len(part) for part in contents if isinstance(part, str))
+    return images * (IMAGE_TOKENS + OUTPUT_TOKENS) + text // 2
+
+
+class _Bucket:
+    # 1分あたりrate個まで使えるトークンバケット（rateが0の場合は無制限）
+    def __init__(self, rate):
+        self.rate = rate
+        self.available = float(rate)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.rate:
+            self.available = min(float(self.rate), self.available + (now - self.updated) * self.rate / 60)
+        self.updated = now
+
+    def headroom(self) -> float:
+        # 残りの割合（無制限の場合は1）
+        return self.available / self.rate if self.rate else 1.0
+
+    def wait_seconds(self, amount) -> float:
+        # amount個使えるようになるまでの秒数
+        if not self.rate or self.available >= amount:
+            return 0.0
+        return (amount - self.available) * 60 / self.rate
+
+
+class _Key:
+    def __init__(self, api_key, model, rpm, tpm):
+        self.api_key = api_key
+        self.label = mask_key(api_key)
+        self.model = model
+        self.requests = _Bucket(rpm)
+        self.tokens = _Bucket(tpm)
+        self.cooldown_until = 0.0
+        self.quota_errors_in_row = 0
+        self.usage = {"requests": 0, "tokens": 0, "quota_errors": 0, "errors": 0, "in_flight": 0}
+
+
+class KeyPool:
+    """
+    複数のAPIキーのモデルをまとめて、レート制限に合わせて振り分けるクラス
+    generate_contentはGenerativeModelと同じ呼び出し方ができる
+
+    Args:
+        api_keys (list): APIキーのリスト
+        create_model (callable): APIキーを受け取ってモデルを返す関数（postimage.BACKENDSの値）
+        rpm (int | dict): 1分あたりのリクエスト数の上限（キーごとに変える場合は {APIキー: 上限}、省略時はDEFAULT_RPM）
+        tpm (int | dict): 1分あたりのトークン数の上限（同上、省略時はDEFAULT_TPM）
+        cache_name (str): 解析結果のキャッシュのキーに使うモデル名
+    """
+
+    def __init__(self, api_keys, create_model, rpm=None, tpm=None, cache_name=None):
+        if not api_keys:
+            raise Exception("APIキーがありません")
+        rpm = DEFAULT_RPM if rpm is None else rpm
+        tpm = DEFAULT_TPM if tpm is None else tpm
+        self._keys = []
+        for api_key in api_keys:
+            model = create_model(api_key)
+            key_rpm = rpm.get(api_key, 0) if isinstance(rpm, dict) else rpm
+            key_tpm = tpm.get(api_key, 0) if isinstance(tpm, dict) else tpm
+            self._keys.append(_Key(api_key, model, key_rpm, key_tpm))
+        self.cache_name = cache_name or getattr(self._keys[0].model, "cache_name", None)
+        self._lock = threading.Lock()
+
+    def _acquire(self, tokens, max_wait):
+        # 余裕が一番大きいキーを選び、リクエスト1回とトークンを差し引く
+        # 使えるキーがない場合は、空くまで待つ
+        deadline = time.monotonic() + max_wait
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                best, best_headroom, wait = None, -1.0, None
+                for key in self._keys:
+                    key.requests.refill(now)
+                    key.tokens.refill(now)
+                    if key.cooldown_until > now:
+                        key_wait = key.cooldown_until - now
+                    else:
+                        key_wait = max(key.requests.wait_seconds(1), key.tokens.wait_seconds(min(tokens, key.tokens.rate or tokens)))
+                    if key_wait > 0:
+                        wait = key_wait if wait is None else min(wait, key_wait)
+                        continue
+                    # リクエスト数・トークン数のうち、余裕が少ない方をキーの余裕とする（同じ場合は処理中が少ないキー）
+                    headroom = min(key.requests.headroom(), key.tokens.headroom()) - key.usage["in_flight"] * 1e-6
+                    if headroom > best_headroom:
+                        best, best_headroom = key, headroom
+                if best is not None:
+                    if best.requests.rate:
+                        best.requests.available -= 1
+                    if best.tokens.rate:
+                        best.tokens.available -= tokens
+                    best.usage["in_flight"] += 1
+                    return best
+            if now + wait > deadline:
+                from google.api_core import exceptions as google_exceptions
+                raise google_exceptions.ResourceExhausted(
+                    f"すべてのAPIキーが上限に達しています（{wait:.0f}秒後に空きます）")
+            time.sleep(min(wait, 1.0))
+
+    def generate_content(self, contents, request_options=None):
+        """
+        余裕が一番大きいキーのモデルでgenerate_contentを呼ぶ
+        429が返った場合はそのキーをクールダウンにして、他のキーで送り直す
+        """
+        estimate = _estimate_tokens(contents)
+        last_error = None
+        for _ in range(len(self._keys)):
+            start = time.perf_counter()
+            key = self._acquire(estimate, MAX_WAIT_SECONDS)
+            metrics.observe("receipt_key_wait_seconds", time.perf_counter() - start)
+            try:
+                response = key.model.generate_content(contents, request_options=request_options)
+            except Exception as e:
+                self._release(key, estimate, e)
+                if _is_quota_error(e) and len(self._keys) > 1:
+                    # 他のキーで送り直す
+                    last_error = e
+                    continue
+                raise
+            usage = getattr(response, "usage_metadata", None)
+            used = getattr(usage, "total_token_count", None) or estimate
+            self._release(key, estimate, None, used)
+            return response
+        # すべてのキーで429になった
+        raise last_error
+
+    def _release(self, key, estimate, error, used=0):
+        with self._lock:
+            key.usage["in_flight"] -= 1
+            if error is None:
+                # 見積もりとの差を精算する（多く使った場合はマイナスになり、その分だけ次の送信が遅れる）
+                if key.tokens.rate:
+                    key.tokens.available -= used - estimate
+                key.usage["requests"] += 1
+                key.usage["tokens"] += used
+                key.quota_errors_in_row = 0
+            elif _is_quota_error(error):
+                key.quota_errors_in_row += 1
+                key.usage["quota_errors"] += 1
+                cooldown = min(COOLDOWN_SECONDS * 2 ** (key.quota_errors_in_row - 1), MAX_COOLDOWN_SECONDS)
+                key.cooldown_until = time.monotonic() + cooldown
+                print(f"APIキー {key.label} が上限に達したため、{cooldown}秒間使いません")
+            else:
+                key.usage["errors"] += 1
+        if error is None:
+            metrics.inc("receipt_key_requests_total", key=key.label)
+            metrics.inc("receipt_key_tokens_total", used, key=key.label)
+        elif _is_quota_error(error):
+            metrics.inc("receipt_key_quota_errors_total", key=key.label)
+
+    def get_usage(self) -> list:
+        """
+        APIキーごとの使用状況を取得する関数
+
+        Returns:
+            list: key（伏せ字）, requests, tokens, quota_errors, errors, in_flight,
+                  requests_available・tokens_available（今使える数、無制限の場合はNone）, cooldown（残りの秒数）
+        """
+        with self._lock:
+            now = time.monotonic()
+            usage = []
+            for key in self._keys:
+                key.requests.refill(now)
+                key.tokens.refill(now)
+                usage.append(dict(
+                    key.usage, key=key.label,
+                    rpm=key.requests.rate or None, tpm=key.tokens.rate or None,
+                    requests_available=int(key.requests.available) if key.requests.rate else None,
+                    tokens_available=int(key.tokens.available) if key.tokens.rate else None,
+                    cooldown=max(0.0, round(key.cooldown_until - now, 1)),
+                ))
+            return usage
+
+
+# 作成したプール {(バックエンド, APIキー...): KeyPool}
+# 上限の残りとクールダウンを呼び出しをまたいで引き継ぐため、同じキーの組み合わせでは同じプールを使う
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name, api_keys, create_model, rpm=None, tpm=None, cache_name=None) -> KeyPool:
+    """
+    APIキーの組み合わせごとのプールを取得する関数（ない場合は作成する）
+
+    Args:
+        name (str): バックエンドの名前（バックエンドごとに別のプールにする）
+        その他の引数はKeyPoolと同じ
+    """
+    with _pools_lock:
+        pool = _pools.get((name, *api_keys))
+        if pool is None:
+            pool = _pools[(name, *api_keys)] = KeyPool(api_keys, create_model, rpm, tpm, cache_name)
+        return pool
+
+
+def get_usage() -> list:
+    """
+    すべてのプールの、APIキーごとの使用状況を取得する関数（KeyPool.get_usageに backend を加えたもの）
+    """
+    with _pools_lock:
+        pools = list(_pools.items())
+    return [dict(usage, backend=key[0]) for key, pool in pools for usage in pool.get_usage()]
+
+
+def clear_pools():
+    """
+    作成したプールをすべて破棄する関数（上限の残りとクールダウンも消える）
+    """
+    with _pools_lock:
+        _pools.clear()
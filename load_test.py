@@ -0,0 +1,305 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw
+
+import db
+import key_pool
+import metrics
+import postimage
+import simulated_model
+
+# 模擬モデル（simulated_model.py）を使って、画像の解析から保存までの処理に負荷をかける
+# Gemini APIの利用枠もネットワークも使わないので、同時実行数や再試行の設定をオフラインで調整できる
+#
+# 経路:
+#   main_process: フォルダの画像をまとめて解析・保存する（batch_size枚ずつ1フォルダにして呼ぶ）
+#   webui: WebUIのRunボタンと同じ処理（webui.run_main_process、再試行の設定はWebUIの既定値）
+#   discord: discord botと同じく、1枚ずつmain_process_dataをスレッドプールで実行する
+#
+# 結果のlatencyは1枚ごとの時間（main_process・webuiは解析の開始から終了まで、discordは受け付けから保存まで）
+# images_per_requestを2以上にすると、main_process・webuiで複数の画像を1リクエストにまとめて解析する
+# （latencyはまとめたリクエストの時間を、その中の画像それぞれの時間とする）
+# データベースと画像は一時フォルダに作るので、普段使っているデータベースは変わらない
+
+PATHS = ("main_process", "webui", "discord")
+
+
+def _percentiles(values) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def percentile(p):
+        # 最近接順位法
+        return values[min(len(values) - 1, max(0, int(len(values) * p / 100 + 0.5) - 1))]
+
+    return {"p50": percentile(50), "p95": percentile(95), "p99": percentile(99), "max": values[-1]}
+
+
+def make_image(index, size=(600, 900)) -> bytes:
+    """
+    負荷試験用のレシート風の画像を作る関数（番号を書き込むので、画像ごとに内容が異なる）
+    """
+    rng = random.Random(index)
+    image = Image.new("RGB", size, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    draw.text((20, 20), f"RECEIPT #{index}", fill=(0, 0, 0))
+    for line in range(1, size[1] // 40):
+        draw.text((20, 20 + line * 35), f"ITEM {rng.randrange(1000):>4}  {rng.randrange(100, 3000):>6}", fill=(0, 0, 0))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class _Recorder:
+    # 1枚ごとの時間と成否を記録する
+    def __init__(self):
+        self.latencies = []
+        self.errors = Counter()
+        self.succeeded = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, error=None):
+        with self._lock:
+            self.latencies.append(seconds)
+            if error is None:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+                self.errors[f"{type(error).__name__}: {str(error)[:80]}"] += 1
+
+
+@contextlib.contextmanager
+def _record_analyze_image(recorder):
+    # main_process・webuiでは1枚ごとの結果が返らないので、analyze_image・analyze_imagesを計測用に置き換える
+    originals = {name: getattr(postimage, name) for name in ("analyze_image", "analyze_images")}
+
+    def timed(original, count):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = original(*args, **kwargs)
+            except Exception as e:
+                for _ in range(count(args, kwargs)):
+                    recorder.record(time.perf_counter() - start, e)
+                raise
+            for _ in range(count(args, kwargs)):
+                recorder.record(time.perf_counter() - start)
+            return result
+        return wrapper
+
+    postimage.analyze_image = timed(originals["analyze_image"], lambda args, kwargs: 1)
+    postimage.analyze_images = timed(originals["analyze_images"], lambda args, kwargs: len(args[1]))
+    try:
+        yield
+    finally:
+        for name, original in originals.items():
+            setattr(postimage, name, original)
+
+
+def _run_batches(path, images, work_dir, api_key, workers, batch_size, max_retries, backoff, images_per_request, recorder):
+    # batch_size枚ずつフォルダに書き出して、main_process（またはwebui.run_main_process）を呼ぶ
+    if path == "webui":
+        import webui
+        run = lambda folder: webui.run_main_process(folder, api_key, workers, images_per_request)
+    else:
+        run = lambda folder: postimage.main_process(folder, api_key, max_workers=workers, max_retries=max_retries,
+                                                    backoff=backoff, batch_images=images_per_request)
+
+    batch_latencies = []
+    failed_batches = 0
+    with _record_analyze_image(recorder):
+        for start in range(0, len(images), batch_size):
+            folder = os.path.join(work_dir, f"batch_{start}")
+            os.makedirs(folder)
+            for index, image_data in enumerate(images[start:start + batch_size], start=start):
+                with open(os.path.join(folder, f"{index}.jpg"), "wb") as f:
+                    f.write(image_data)
+
+            batch_start = time.perf_counter()
+            try:
+                run(folder)
+            except Exception:
+                # 失敗した画像はquarantineに移動して処理を続けるので、ここに来るのはフォルダ全体の失敗のみ
+                failed_batches += 1
+            batch_latencies.append(time.perf_counter() - batch_start)
+    return {"batches": len(batch_latencies), "failed_batches": failed_batches,
+            "batch_latency": _percentiles(batch_latencies)}
+
+
+def _run_discord(images, api_key, workers, max_retries, backoff, recorder):
+    # discord botと同じく、1枚ずつスレッドプールで解析・保存する
+    def process(image_data, submitted):
+        try:
+            postimage.main_process_data(image_data, api_key, max_retries=max_retries, backoff=backoff)
+        except Exception as e:
+            recorder.record(time.perf_counter() - submitted, e)
+            return
+        recorder.record(time.perf_counter() - submitted)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for image_data in images:
+            executor.submit(process, image_data, time.perf_counter())
+    return {}
+
+
+def run_load_test(path="main_process", images=1000, workers=postimage.DEFAULT_MAX_WORKERS, batch_size=100,
+                  max_retries=postimage.DEFAULT_MAX_RETRIES, backoff=postimage.DEFAULT_BACKOFF,
+                  images_per_request=postimage.DEFAULT_BATCH_IMAGES, keys=1, key_rpm=0,
+                  model_options=None, verbose=False) -> dict:
+    """
+    模擬モデルを使って負荷試験を行う関数
+
+    Args:
+        path (str): 試験する経路（PATHSのいずれか）
+        images (int): 処理する画像の枚数
+        workers (int): 同時に解析する画像の最大枚数
+        batch_size (int): main_process・webuiで1回に処理する画像の枚数
+        max_retries (int): 一時的なエラー時の再試行回数
+        backoff (float): 再試行の初期待ち時間（秒）
+        images_per_request (int): main_process・webuiで1リクエストにまとめる画像の最大枚数
+        keys (int): 使うAPIキーの数（2以上の場合はkey_poolで振り分ける。模擬モデルのrpmはキーごとの上限になる）
+        key_rpm (int): key_poolで1キーあたりに送る1分あたりのリクエスト数の上限（0で無制限）
+        model_options (dict): 模擬モデルの設定（simulated_model.configureに渡す）
+        verbose (bool): 処理中の出力を表示するかどうか
+
+    Returns:
+        dict: 設定と結果（throughput: 1秒あたりに保存できた枚数、latency: 1枚ごとの時間の分位点など）
+    """
+    if path not in PATHS:
+        raise Exception(f"試験できない経路です: {path}")
+
+    simulated_model.configure(**(model_options or {}))
+    simulated_model.reset_stats()
+    previous_backend = postimage.model_backend
+    previous_db_path = db.db_path
+    previous_cwd = os.getcwd()
+    previous_rpm = key_pool.DEFAULT_RPM
+    postimage.set_model_backend("simulated")
+    key_pool.DEFAULT_RPM = key_rpm
+    key_pool.clear_pools()
+    api_key = ",".join(f"simulated-key-{index}" for index in range(keys)) if keys > 1 else ""
+
+    image_list = [make_image(index) for index in range(images)]
+    recorder = _Recorder()
+    retries_before = metrics.get("receipt_model_retries_total")
+    fallback_before = sum(metrics.get("receipt_batch_fallback_total", reason=reason) for reason in ("request", "invalid"))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        db.set_db_path(os.path.join(work_dir, "loadtest.db"))
+        # 成功した画像はカレントディレクトリのsuccessフォルダに移動されるので、一時フォルダで実行する
+        os.chdir(work_dir)
+        output = open(os.devnull, "w") if not verbose else None
+        try:
+            with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+                start = time.perf_counter()
+                if path == "discord":
+                    extra = _run_discord(image_list, api_key, workers, max_retries, backoff, recorder)
+                else:
+                    extra = _run_batches(path, image_list, work_dir, api_key, workers, batch_size, max_retries, backoff,
+                                         images_per_request, recorder)
+                seconds = time.perf_counter() - start
+            saved = db.get_connection().execute("SELECT COUNT(*) FROM receipts").fetchone()[0]
+            quarantine_folder = os.path.join(work_dir, postimage.QUARANTINE_FOLDER)
+            quarantined = len([name for name in os.listdir(quarantine_folder) if not name.endswith(".error.txt")]) \
+                if os.path.isdir(quarantine_folder) else 0
+        finally:
+            if output:
+                output.close()
+            db.close_connection()
+            os.chdir(previous_cwd)
+            db.set_db_path(previous_db_path)
+            postimage.set_model_backend(previous_backend)
+            key_pool.DEFAULT_RPM = previous_rpm
+            key_usage = key_pool.get_usage()
+            key_pool.clear_pools()
+
+    model_stats = simulated_model.get_stats()
+    return {
+        "path": path,
+        "images": images,
+        "workers": workers,
+        "batch_size": batch_size if path != "discord" else None,
+        "images_per_request": images_per_request if path != "discord" else None,
+        "keys": keys,
+        "key_rpm": key_rpm,
+        "max_retries": max_retries,
+        "backoff": backoff,
+        "model_options": simulated_model.get_options(),
+        "seconds": seconds,
+        "saved": saved,
+        "throughput": saved / seconds if seconds > 0 else None,
+        "succeeded": recorder.succeeded,
+        "failed": recorder.failed,
+        # 失敗してquarantineに移動した画像の枚数と、保存も移動もされなかった枚数
+        "quarantined": quarantined,
+        "not_attempted": images - saved - quarantined if path != "discord" else images - recorder.succeeded - recorder.failed,
+        "latency": _percentiles(recorder.latencies),
+        # 再試行を含めたモデルの呼び出し回数と、結果ごとの回数
+        "model_calls": model_stats,
+        "retries": metrics.get("receipt_model_retries_total") - retries_before,
+        # まとめて解析できず、1枚ずつ解析し直した画像の数
+        "batch_fallbacks": sum(metrics.get("receipt_batch_fallback_total", reason=reason)
+                               for reason in ("request", "invalid")) - fallback_before,
+        "errors": dict(recorder.errors.most_common()),
+        # APIキーごとの使用状況（key_poolを使った場合）
+        "key_usage": key_usage,
+        **extra,
+    }
+
+
+if __name__ == "__main__":
+    # 使用例:
+    #   python load_test.py --images 2000 --workers 8
+    #   python load_test.py --path discord --images 1000 --rate-429 0.05 --rpm 600 --backoff 0.5
+    #   python load_test.py --latency 0.2 --sigma 0.8 --rate-malformed 0.01 --output result.json
+    #   python load_test.py --images 1000 --images-per-request 8 --rate-malformed 0.05
+    #   python load_test.py --path discord --images 500 --keys 3 --rpm 60 --key-rpm 55
+    parser = argparse.ArgumentParser(description="模擬モデルを使って、画像の解析から保存までの処理に負荷をかける")
+    parser.add_argument("--path", choices=PATHS, default="main_process", help="試験する経路")
+    parser.add_argument("--images", type=int, default=1000, help="処理する画像の枚数")
+    parser.add_argument("--workers", type=int, default=postimage.DEFAULT_MAX_WORKERS, help="同時に解析する画像の最大枚数")
+    parser.add_argument("--batch-size", type=int, default=100, help="main_process・webuiで1回に処理する画像の枚数")
+    parser.add_argument("--images-per-request", type=int, default=postimage.DEFAULT_BATCH_IMAGES,
+                        help="main_process・webuiで1リクエストにまとめる画像の最大枚数")
+    parser.add_argument("--keys", type=int, default=1, help="使うAPIキーの数（模擬モデルのrpmはキーごとの上限）")
+    parser.add_argument("--key-rpm", type=int, default=0, help="1キーあたりに送る1分あたりのリクエスト数の上限（0で無制限）")
+    parser.add_argument("--max-retries", type=int, default=postimage.DEFAULT_MAX_RETRIES)
+    parser.add_argument("--backoff", type=float, default=postimage.DEFAULT_BACKOFF, help="再試行の初期待ち時間（秒）")
+    parser.add_argument("--latency", type=float, default=0.5, help="模擬モデルの応答時間の中央値（秒）")
+    parser.add_argument("--sigma", type=float, default=0.4, help="応答時間のばらつき（対数正規分布）")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="429を返す確率")
+    parser.add_argument("--rate-500", type=float, default=0.0, help="500を返す確率")
+    parser.add_argument("--rate-malformed", type=float, default=0.0, help="JSONとして読めない応答を返す確率")
+    parser.add_argument("--rpm", type=int, default=0, help="1分あたりのリクエスト数の上限（0で無制限）")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default=None, help="結果を保存するJSONファイル")
+    parser.add_argument("--verbose", action="store_true", help="処理中の出力を表示する")
+    args = parser.parse_args()
+
+    result = run_load_test(
+        args.path, args.images, args.workers, args.batch_size, args.max_retries, args.backoff,
+        args.images_per_request, args.keys, args.key_rpm, model_options={
+            "latency": {"distribution": "lognormal", "median": args.latency, "sigma": args.sigma},
+            "error_rates": {"429": args.rate_429, "500": args.rate_500, "malformed": args.rate_malformed},
+            "rpm": args.rpm,
+            "seed": args.seed,
+        },
+        verbose=args.verbose,
+    )
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
@@ -0,0 +1,221 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# 処理時間・データサイズ・エラー数などをプロセス内で集計し、Prometheusのテキスト形式で出力する
+# webui.pyの /metrics で公開する
+#
+# 使用例:
+#   with metrics.timer("receipt_stage_seconds", stage="model"):
+#       ...
+#   metrics.observe("receipt_image_bytes", len(image_data), kind="original")
+#   metrics.inc("receipt_errors_total", stage="model", error="ResourceExhausted")
+
+# ヒストグラムのバケット（上限値）
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000)
+ROWS_BUCKETS = (1, 10, 50, 100, 1000, 10000, 100000, 1000000)
+
+# 集計する値の定義 {名前: (種類, 説明, バケット)}
+METRICS = {
+    "receipt_stage_seconds": ("histogram", "画像1枚の解析・保存の段階ごとの処理時間（秒）", DURATION_BUCKETS),
+    "receipt_image_bytes": ("histogram", "画像のサイズ（original: 元の画像, processed: 前処理後, encoded: base64）", BYTES_BUCKETS),
+    "receipt_preprocess_saved_bytes_total": ("counter", "前処理で削減した画像のバイト数の合計", None),
+    "receipt_preprocess_saved_ratio": ("histogram", "前処理で削減した割合（画像ごと、1 - 前処理後 / 元の画像）", (0, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99)),
+    "receipt_model_tokens": ("histogram", "モデルの1リクエストあたりのトークン数", TOKEN_BUCKETS),
+    "receipt_errors_total": ("counter", "段階ごとのエラー数", None),
+    "receipt_batch_images": ("histogram", "1リクエストにまとめた画像の枚数", (1, 2, 4, 8, 16, 32)),
+    "receipt_batch_fallback_total": ("counter", "まとめて解析できず、1枚ずつ解析し直した画像の数（reason: request / invalid）", None),
+    "receipt_model_retries_total": ("counter", "モデルへのリクエストを再試行した回数", None),
+    "receipt_key_requests_total": ("counter", "APIキーごとの成功したリクエストの数", None),
+    "receipt_key_tokens_total": ("counter", "APIキーごとの使用したトークン数", None),
+    "receipt_key_quota_errors_total": ("counter", "APIキーごとの429（上限超過）の数", None),
+    "receipt_key_wait_seconds": ("histogram", "APIキーの上限に余裕ができるまで待った時間（秒）", DURATION_BUCKETS),
+    "receipt_cache_total": ("counter", "解析結果のキャッシュのヒット・ミスの回数", None),
+    "receipt_files_total": ("counter", "main_processで処理した画像の数（result: success / quarantine）", None),
+    "receipt_watch_files_total": ("counter", "フォルダの監視で処理した画像の数（result: success / quarantine）", None),
+    "receipt_watch_delay_seconds": ("histogram", "フォルダの監視で画像を見つけてから保存するまでの時間（秒）", DURATION_BUCKETS),
+    "receipts_saved_total": ("counter", "データベースに保存したレシートの数", None),
+    "db_list_seconds": ("histogram", "一覧・集計の取得にかかった時間（秒）", DURATION_BUCKETS),
+    "db_list_rows": ("histogram", "一覧・集計で取得した行数（キャッシュにない場合のみ）", ROWS_BUCKETS),
+    "excel_export_seconds": ("histogram", "Excelへの出力の段階ごとの処理時間（秒）", DURATION_BUCKETS),
+    "excel_export_rows_total": ("counter", "Excelに出力した行数", None),
+}
+
+# {(名前, ラベル): 値} ヒストグラムの値は [バケットごとの件数..., 合計, 件数]
+_values = {}
+_lock = threading.Lock()
+
+# プロファイル（cProfile）の設定と、直近の結果
+# 環境変数RECEIPT_PROFILE=1で、起動時から有効にする
+PROFILE_HISTORY = 20
+_profiling = os.getenv("RECEIPT_PROFILE", "") == "1"
+_profiles = deque(maxlen=PROFILE_HISTORY)
+# cProfileは同時に1つしか動かせないので、他のスレッドでプロファイル中の場合は飛ばす
+_profile_lock = threading.Lock()
+
+
+def _key(name, labels):
+    if name not in METRICS:
+        raise Exception(f"定義されていない値です: {name}")
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """
+    カウンターを増やす関数
+    """
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """
+    ヒストグラムに値を1つ加える関数
+    """
+    key = _key(name, labels)
+    buckets = METRICS[name][2]
+    with _lock:
+        counts = _values.get(key)
+        if counts is None:
+            counts = _values[key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    withの中の処理時間（秒）をヒストグラムに加えるコンテキストマネージャ
+    例外が発生した場合も記録する
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels:
+        value = value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def render() -> str:
+    """
+    集計した値をPrometheusのテキスト形式で出力する関数
+
+    Returns:
+        str: text/plain; version=0.0.4 の本文
+    """
+    with _lock:
+        values = {key: (list(value) if isinstance(value, list) else value) for key, value in _values.items()}
+
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for (key_name, labels), value in sorted(values.items()):
+            if key_name != name:
+                continue
+            if metric_type == "counter":
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            # バケットは累積の件数で出力する（observeで上限値以下のバケットすべてに加えている）
+            for bound, count in zip(buckets, value):
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', repr(float(bound)))])} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {value[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+def get(name, **labels):
+    """
+    カウンターの現在の値を取得する関数（まだ記録していない場合は0）
+    """
+    key = _key(name, labels)
+    with _lock:
+        return _values.get(key, 0)
+
+
+def reset():
+    """
+    集計した値をすべて削除する関数
+    """
+    with _lock:
+        _values.clear()
+
+
+def set_profiling(enabled):
+    """
+    プロファイル（cProfile）を有効・無効にする関数（実行中に切り替えられる）
+    """
+    global _profiling
+    _profiling = bool(enabled)
+
+
+def is_profiling() -> bool:
+    return _profiling
+
+
+def get_profiles() -> list:
+    """
+    直近のプロファイルの結果を取得する関数（新しい順）
+
+    Returns:
+        list: {"name": 関数名, "started_at": 開始時刻, "seconds": 処理時間, "stats": 累積時間の上位の表} のリスト
+    """
+    return list(reversed(_profiles))
+
+
+def profiled(func):
+    """
+    プロファイルが有効な場合に、呼び出しごとにcProfileで計測するデコレータ
+    結果はget_profilesで取得する（直近PROFILE_HISTORY件）
+    計測するのは呼び出したスレッドの処理だけ（ThreadPoolExecutorの中の処理は含まれない）
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _profiling or not _profile_lock.acquire(blocking=False):
+            return func(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 他のプロファイラが動いている場合は計測しない
+            _profile_lock.release()
+            return func(*args, **kwargs)
+
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            _profile_lock.release()
+            seconds = time.perf_counter() - start
+            output = io.StringIO()
+            pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(30)
+            _profiles.append({"name": func.__qualname__, "started_at": started_at,
+                              "seconds": seconds, "stats": output.getvalue()})
+
+    return wrapper
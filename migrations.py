@@ -0,0 +1,501 @@
+import sqlite3
+import sys
+
+# データベースのスキーマをバージョン管理する
+# バージョンはPRAGMA user_versionに保存し、未適用のマイグレーションだけを順番に実行する
+# 新しい変更は、MIGRATIONSの末尾に関数を追加する（既存の関数は変更しない）
+
+
+def _migration_1_create_tables(cursor):
+    # 初期のテーブル（以前のinit_dbと同じもの）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS receipts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            store TEXT,
+            genre TEXT,
+            datetime TEXT,
+            total REAL
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            receipt_id TEXT,
+            name TEXT,
+            price REAL,
+            FOREIGN KEY (receipt_id) REFERENCES receipts (id)
+        )
+    ''')
+
+
+def _migration_2_types_and_indexes(cursor):
+    # items.receipt_idをTEXTからINTEGERに変更する
+    # SQLiteは列の型を変更できないので、テーブルを作り直してデータをコピーする
+    cursor.execute('''
+        CREATE TABLE items_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            receipt_id INTEGER,
+            name TEXT,
+            price REAL,
+            FOREIGN KEY (receipt_id) REFERENCES receipts (id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO items_new (id, receipt_id, name, price)
+        SELECT id, CAST(receipt_id AS INTEGER), name, price FROM items
+    ''')
+    cursor.execute("DROP TABLE items")
+    cursor.execute("ALTER TABLE items_new RENAME TO items")
+
+    # 日付（YYYY-MM-DD）と年月（YYYY-MM）を保存する列を追加し、既存のデータを埋める
+    cursor.execute("ALTER TABLE receipts ADD COLUMN date TEXT")
+    cursor.execute("ALTER TABLE receipts ADD COLUMN month TEXT")
+    cursor.execute("UPDATE receipts SET date = substr(datetime, 1, 10), month = substr(datetime, 1, 7)")
+
+    # インデックスの作成
+    cursor.execute("CREATE INDEX idx_items_receipt_id ON items (receipt_id)")
+    cursor.execute("CREATE INDEX idx_receipts_datetime ON receipts (datetime)")
+    cursor.execute("CREATE INDEX idx_receipts_month ON receipts (month)")
+    cursor.execute("CREATE INDEX idx_receipts_store ON receipts (store)")
+    cursor.execute("CREATE INDEX idx_receipts_genre ON receipts (genre)")
+
+
+def _migration_3_rollups(cursor):
+    # 集計済みの値を保存するテーブル（ロールアップ）を作成する
+    # receiptsへの挿入・削除・更新時にトリガーで差分を反映するので、集計時に全件を読む必要がない
+    # (テーブル名, キー列, キーの型, キーを求める式) ※{row}はNEWまたはOLDに置き換える
+    rollups = [
+        ("rollup_store", "store", "TEXT", "{row}.store"),
+        ("rollup_genre", "genre", "TEXT", "{row}.genre"),
+        ("rollup_month", "month", "TEXT", "{row}.month"),
+        ("rollup_day", "date", "TEXT", "{row}.date"),
+        # 0: 日曜日 ~ 6: 土曜日
+        ("rollup_weekday", "weekday", "INTEGER", "CAST(strftime('%w', {row}.date) AS INTEGER)"),
+    ]
+
+    add_statements = []
+    remove_statements = []
+    for table, key, key_type, expression in rollups:
+        cursor.execute(f'''
+            CREATE TABLE {table} (
+                {key} {key_type} PRIMARY KEY,
+                total REAL NOT NULL DEFAULT 0,
+                count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        # 既存のデータから集計する
+        source = expression.format(row="receipts")
+        cursor.execute(f'''
+            INSERT INTO {table} ({key}, total, count)
+            SELECT {source}, COALESCE(SUM(total), 0), COUNT(*)
+            FROM receipts
+            WHERE {source} IS NOT NULL
+            GROUP BY {source}
+        ''')
+
+        new_key = expression.format(row="NEW")
+        old_key = expression.format(row="OLD")
+        add_statements.append(f'''
+                INSERT INTO {table} ({key}, total, count)
+                SELECT {new_key}, COALESCE(NEW.total, 0), 1
+                WHERE {new_key} IS NOT NULL
+                ON CONFLICT ({key}) DO UPDATE SET
+                    total = total + excluded.total,
+                    count = count + 1;
+        ''')
+        remove_statements.append(f'''
+                UPDATE {table} SET total = total - COALESCE(OLD.total, 0), count = count - 1
+                WHERE {key} = {old_key};
+                DELETE FROM {table} WHERE {key} = {old_key} AND count <= 0;
+        ''')
+
+    add_sql = "".join(add_statements)
+    remove_sql = "".join(remove_statements)
+    cursor.execute(f"CREATE TRIGGER trg_receipts_rollup_insert AFTER INSERT ON receipts BEGIN {add_sql} END")
+    cursor.execute(f"CREATE TRIGGER trg_receipts_rollup_delete AFTER DELETE ON receipts BEGIN {remove_sql} END")
+    cursor.execute(f'''
+        CREATE TRIGGER trg_receipts_rollup_update
+        AFTER UPDATE OF store, genre, date, month, total ON receipts
+        BEGIN {remove_sql} {add_sql} END
+    ''')
+
+
+def _migration_4_cache_and_jobs(cursor):
+    # 以前はresponse_cache.py・job_queue.pyがそれぞれ作成していたテーブル
+    # 作成済みのデータベースもあるのでIF NOT EXISTSを付ける
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT,
+            created_at REAL,
+            last_used_at REAL,
+            hit_count INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_response_cache_last_used_at
+        ON response_cache (last_used_at)
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_path TEXT,
+            image_hash TEXT UNIQUE,
+            state TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            last_error TEXT,
+            result TEXT,
+            receipt_id INTEGER,
+            worker TEXT,
+            claimed_at REAL,
+            next_attempt_at REAL DEFAULT 0,
+            created_at REAL,
+            updated_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, next_attempt_at)
+    ''')
+
+
+def _migration_5_browse_indexes(cursor):
+    # WebUIの一覧での絞り込み・並び替え用のインデックス
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_date ON receipts (date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_total ON receipts (total)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_items_price ON items (price)")
+
+
+def _migration_6_data_version(cursor):
+    # データの更新回数（書き込むたびに1増やす）
+    # 読み込み側のキャッシュは、この値が変わったら結果を捨てる
+    cursor.execute('''
+        CREATE TABLE data_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT INTO data_version (id, version) VALUES (1, 0)")
+
+
+def _migration_7_export_watermarks(cursor):
+    # ファイル出力（db_to_files.py）で、前回どこまで出力したかを保存する
+    cursor.execute('''
+        CREATE TABLE export_watermarks (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            updated_at REAL
+        )
+    ''')
+
+
+def _migration_8_items_fts(cursor):
+    # 商品名・店舗名の全文検索用のインデックス（FTS5）
+    # trigramトークナイザーは3文字ずつに区切って索引を作るので、日本語でも部分一致で検索できる
+    # SQLiteがFTS5に対応していない場合は作成しない（検索はLIKEで行う）
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE items_fts USING fts5(name, store, tokenize='trigram')")
+    except sqlite3.OperationalError as e:
+        print(f"全文検索のインデックスを作成できませんでした: {e}")
+        return
+
+    # rowidはitems.idと同じにする
+    cursor.execute('''
+        INSERT INTO items_fts (rowid, name, store)
+        SELECT items.id, items.name, receipts.store
+        FROM items LEFT JOIN receipts ON receipts.id = items.receipt_id
+    ''')
+
+    # items・receiptsの変更をインデックスに反映するトリガー
+    cursor.execute('''
+        CREATE TRIGGER trg_items_fts_insert AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts (rowid, name, store)
+            VALUES (NEW.id, NEW.name, (SELECT store FROM receipts WHERE id = NEW.receipt_id));
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_items_fts_delete AFTER DELETE ON items BEGIN
+            DELETE FROM items_fts WHERE rowid = OLD.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_items_fts_update AFTER UPDATE OF name, receipt_id ON items BEGIN
+            UPDATE items_fts
+            SET name = NEW.name, store = (SELECT store FROM receipts WHERE id = NEW.receipt_id)
+            WHERE rowid = NEW.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_receipts_fts_update AFTER UPDATE OF store ON receipts BEGIN
+            UPDATE items_fts SET store = NEW.store
+            WHERE rowid IN (SELECT id FROM items WHERE receipt_id = NEW.id);
+        END
+    ''')
+
+
+def _migration_9_bulk_load(cursor):
+    # まとめて挿入する間（bulk_insert）は、挿入時のトリガーでロールアップ・全文検索のインデックスを1行ずつ更新せず、
+    # バッチの最後にまとめて更新する
+    # bulk_loadに行がある間はトリガーを実行しない（行を入れるのは挿入するトランザクションの中だけなので、
+    # 他の接続からは常に空に見える）
+    cursor.execute("CREATE TABLE bulk_load (id INTEGER PRIMARY KEY)")
+
+    # 挿入時のトリガーに条件を追加して作り直す
+    for name, table in [("trg_receipts_rollup_insert", "receipts"), ("trg_items_fts_insert", "items")]:
+        row = cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)).fetchone()
+        if row is None:
+            # 全文検索に対応していない場合はトリガーがない
+            continue
+        sql = row[0].replace(
+            f"AFTER INSERT ON {table} BEGIN",
+            f"AFTER INSERT ON {table} WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN", 1
+        )
+        cursor.execute(f"DROP TRIGGER {name}")
+        cursor.execute(sql)
+
+
+def _migration_10_stats_state(cursor):
+    # 概要タブの統計（stats.py）を保存するテーブル
+    # 挿入時はstats.add_responsesで差分を加える。削除・更新時は差分を求められない統計（最小値・分位点など）があるので、
+    # トリガーで保存した統計を削除し、次に読むときに作り直す
+    cursor.execute('''
+        CREATE TABLE stats_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            state TEXT NOT NULL
+        )
+    ''')
+    for name, event in [
+        ("trg_receipts_stats_delete", "AFTER DELETE ON receipts"),
+        ("trg_receipts_stats_update", "AFTER UPDATE OF store, datetime, date, total ON receipts"),
+        ("trg_items_stats_delete", "AFTER DELETE ON items"),
+        ("trg_items_stats_update", "AFTER UPDATE OF name, price ON items"),
+    ]:
+        cursor.execute(f"CREATE TRIGGER {name} {event} BEGIN DELETE FROM stats_state; END")
+
+
+def _migration_11_dimensions(cursor):
+    # 店舗名・ジャンル名をstores・genresテーブルに分け、receiptsには整数のID（store_id, genre_id）を保存する
+    # 既存の名前はdimensions.pyで正規化してから登録する（表記揺れは同じIDにまとまる）
+    import dimensions
+
+    for table in ("stores", "genres"):
+        cursor.execute(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+
+    # 元の名前 → ID の対応表を一時テーブルに作る
+    for kind, (table, _, aliases) in dimensions.DIMENSIONS.items():
+        names = [row[0] for row in cursor.execute(f"SELECT DISTINCT {kind} FROM receipts WHERE {kind} IS NOT NULL")]
+        normalized = {name: dimensions.normalize_name(name, aliases) for name in names}
+        cursor.executemany(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)",
+                           [(name,) for name in sorted(set(normalized.values()) - {None})])
+        ids = dict(cursor.execute(f"SELECT name, id FROM {table}").fetchall())
+        cursor.execute(f"CREATE TEMP TABLE {kind}_map (name TEXT PRIMARY KEY, id INTEGER)")
+        cursor.executemany(f"INSERT INTO temp.{kind}_map (name, id) VALUES (?, ?)",
+                           [(name, ids[value]) for name, value in normalized.items() if value is not None])
+
+    # receiptsを作り直す（SQLiteは列の型を変更できないので、migration 2と同じくコピーする）
+    # receiptsを参照するitemsのトリガーは、作り直した後に作成し直す
+    row = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'receipts'").fetchone()
+    sequence = row[0] if row is not None else 0
+    for name in ("trg_items_fts_insert", "trg_items_fts_update"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+    cursor.execute('''
+        CREATE TABLE receipts_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            store_id INTEGER REFERENCES stores (id),
+            genre_id INTEGER REFERENCES genres (id),
+            datetime TEXT,
+            date TEXT,
+            month TEXT,
+            total REAL
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO receipts_new (id, store_id, genre_id, datetime, date, month, total)
+        SELECT receipts.id, store_map.id, genre_map.id, receipts.datetime, receipts.date, receipts.month, receipts.total
+        FROM receipts
+        LEFT JOIN temp.store_map ON store_map.name = receipts.store
+        LEFT JOIN temp.genre_map ON genre_map.name = receipts.genre
+    ''')
+    cursor.execute("DROP TABLE receipts")
+    cursor.execute("ALTER TABLE receipts_new RENAME TO receipts")
+    cursor.execute("DROP TABLE temp.store_map")
+    cursor.execute("DROP TABLE temp.genre_map")
+
+    # 削除済みのIDを使わないように、AUTOINCREMENTの値を引き継ぐ
+    cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'receipts'", (sequence,))
+    if sequence and cursor.rowcount == 0:
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('receipts', ?)", (sequence,))
+
+    cursor.execute("CREATE INDEX idx_receipts_datetime ON receipts (datetime)")
+    cursor.execute("CREATE INDEX idx_receipts_date ON receipts (date)")
+    cursor.execute("CREATE INDEX idx_receipts_month ON receipts (month)")
+    cursor.execute("CREATE INDEX idx_receipts_total ON receipts (total)")
+    cursor.execute("CREATE INDEX idx_receipts_store_id ON receipts (store_id)")
+    cursor.execute("CREATE INDEX idx_receipts_genre_id ON receipts (genre_id)")
+
+    # 店舗別・ジャンル別のロールアップはIDごとに集計し直す
+    cursor.execute("DROP TABLE rollup_store")
+    cursor.execute("DROP TABLE rollup_genre")
+    for table, key in (("rollup_store", "store_id"), ("rollup_genre", "genre_id")):
+        cursor.execute(f'''
+            CREATE TABLE {table} (
+                {key} INTEGER PRIMARY KEY,
+                total REAL NOT NULL DEFAULT 0,
+                count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute(f'''
+            INSERT INTO {table} ({key}, total, count)
+            SELECT {key}, COALESCE(SUM(total), 0), COUNT(*)
+            FROM receipts
+            WHERE {key} IS NOT NULL
+            GROUP BY {key}
+        ''')
+
+    # receiptsのトリガーはテーブルと一緒に削除されたので作り直す（migration 3, 9, 10と同じ内容で、店舗・ジャンルはIDにする）
+    # (テーブル名, キー列, キーを求める式) ※{row}はNEWまたはOLDに置き換える
+    rollups = [
+        ("rollup_store", "store_id", "{row}.store_id"),
+        ("rollup_genre", "genre_id", "{row}.genre_id"),
+        ("rollup_month", "month", "{row}.month"),
+        ("rollup_day", "date", "{row}.date"),
+        ("rollup_weekday", "weekday", "CAST(strftime('%w', {row}.date) AS INTEGER)"),
+    ]
+    add_statements = []
+    remove_statements = []
+    for table, key, expression in rollups:
+        new_key = expression.format(row="NEW")
+        old_key = expression.format(row="OLD")
+        add_statements.append(f'''
+                INSERT INTO {table} ({key}, total, count)
+                SELECT {new_key}, COALESCE(NEW.total, 0), 1
+                WHERE {new_key} IS NOT NULL
+                ON CONFLICT ({key}) DO UPDATE SET
+                    total = total + excluded.total,
+                    count = count + 1;
+        ''')
+        remove_statements.append(f'''
+                UPDATE {table} SET total = total - COALESCE(OLD.total, 0), count = count - 1
+                WHERE {key} = {old_key};
+                DELETE FROM {table} WHERE {key} = {old_key} AND count <= 0;
+        ''')
+    add_sql = "".join(add_statements)
+    remove_sql = "".join(remove_statements)
+    cursor.execute(f'''
+        CREATE TRIGGER trg_receipts_rollup_insert AFTER INSERT ON receipts WHEN NOT EXISTS (SELECT 1 FROM bulk_load)
+        BEGIN {add_sql} END
+    ''')
+    cursor.execute(f"CREATE TRIGGER trg_receipts_rollup_delete AFTER DELETE ON receipts BEGIN {remove_sql} END")
+    cursor.execute(f'''
+        CREATE TRIGGER trg_receipts_rollup_update
+        AFTER UPDATE OF store_id, genre_id, date, month, total ON receipts
+        BEGIN {remove_sql} {add_sql} END
+    ''')
+    for name, event in [
+        ("trg_receipts_stats_delete", "AFTER DELETE ON receipts"),
+        ("trg_receipts_stats_update", "AFTER UPDATE OF store_id, datetime, date, total ON receipts"),
+    ]:
+        cursor.execute(f"CREATE TRIGGER {name} {event} BEGIN DELETE FROM stats_state; END")
+    # 統計の店舗名も正規化した名前で作り直す
+    cursor.execute("DELETE FROM stats_state")
+
+    # 全文検索のインデックスの店舗名は、正規化した名前で入れ直す
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'items_fts'").fetchone() is None:
+        return
+    cursor.execute("DELETE FROM items_fts")
+    cursor.execute('''
+        INSERT INTO items_fts (rowid, name, store)
+        SELECT items.id, items.name, stores.name
+        FROM items
+        LEFT JOIN receipts ON receipts.id = items.receipt_id
+        LEFT JOIN stores ON stores.id = receipts.store_id
+    ''')
+    store_sql = "(SELECT stores.name FROM receipts JOIN stores ON stores.id = receipts.store_id WHERE receipts.id = NEW.receipt_id)"
+    cursor.execute(f'''
+        CREATE TRIGGER trg_items_fts_insert AFTER INSERT ON items WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+            INSERT INTO items_fts (rowid, name, store) VALUES (NEW.id, NEW.name, {store_sql});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER trg_items_fts_update AFTER UPDATE OF name, receipt_id ON items BEGIN
+            UPDATE items_fts SET name = NEW.name, store = {store_sql} WHERE rowid = NEW.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_receipts_fts_update AFTER UPDATE OF store_id ON receipts BEGIN
+            UPDATE items_fts SET store = (SELECT name FROM stores WHERE id = NEW.store_id)
+            WHERE rowid IN (SELECT id FROM items WHERE receipt_id = NEW.id);
+        END
+    ''')
+
+
+# (バージョン, マイグレーション関数) のリスト
+MIGRATIONS = [
+    (1, _migration_1_create_tables),
+    (2, _migration_2_types_and_indexes),
+    (3, _migration_3_rollups),
+    (4, _migration_4_cache_and_jobs),
+    (5, _migration_5_browse_indexes),
+    (6, _migration_6_data_version),
+    (7, _migration_7_export_watermarks),
+    (8, _migration_8_items_fts),
+    (9, _migration_9_bulk_load),
+    (10, _migration_10_stats_state),
+    (11, _migration_11_dimensions),
+]
+
+
+def get_version(conn) -> int:
+    """
+    データベースの現在のスキーマバージョンを取得する関数
+    """
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn) -> int:
+    """
+    未適用のマイグレーションを順番に実行する関数
+    各マイグレーションは1つのトランザクションで実行するので、途中で失敗しても中途半端な状態にはならない
+
+    Args:
+        conn: sqlite3のコネクション
+
+    Returns:
+        int: 実行後のスキーマバージョン
+    """
+    # 途中でコミットされないように、トランザクションは自分で管理する
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for version, migration in MIGRATIONS:
+            if get_version(conn) >= version:
+                continue
+
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # 他のプロセスが先に適用した場合は何もしない
+                if get_version(conn) >= version:
+                    cursor.execute("COMMIT")
+                    continue
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {version}")
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            print(f"データベースをバージョン{version}に更新しました")
+    finally:
+        conn.isolation_level = isolation_level
+
+    return get_version(conn)
+
+
+if __name__ == "__main__":
+    # 使用例: python migrations.py [データベースのパス]
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "receipts.db"
+    conn = sqlite3.connect(db_path)
+    print(f"スキーマバージョン: {migrate(conn)}")
+    conn.close()
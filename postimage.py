@@ -1,48 +1,612 @@
 import base64
+import io
 import json
 import os
-import google.generativeai as genai
-from PIL import Image
-import sqlite3
 import glob
 import shutil
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import response_cache
+import bulk_insert
+import db
+import dimensions
+import key_pool
+import metrics
 
-# 画像をリサイズする いらない？
-def resize_image(image_path):
-    image = Image.open(image_path)
-    (width, height) = (image.width, image.height)
+# 使用するモデル名
+MODEL_NAME = "gemini-2.0-flash"
 
-    # 画像が大きい場合はリサイズする
-    if width >= 1200 or height >= 1200:
+# google.generativeai（約0.8秒）・PIL・google.api_coreは読み込みに時間がかかるので、使うときに読み込む
+# （webui.pyやdiscord_bot.pyの起動時には読み込まない）
 
-        # 画像の縦横比を保ったまま、長辺が1200pxになるようにリサイズする
-        if width > height:
-            new_width = 1200
-            new_height = int((new_width / width) * height)
-        else:
-            new_height = 1200
-            new_width = int((new_height / height) * width)
+# 同時実行の既定値
+DEFAULT_MAX_WORKERS = 4
+# 画像の前処理の既定値
+# max_edge: 長辺の最大ピクセル数（これより大きい画像は縮小する）
+# grayscale: グレースケールに変換するかどうか
+# image_format: 再エンコードする形式（JPEG or WEBP）
+# quality: 再エンコードの品質（1~100）
+PREPROCESS_OPTIONS = {
+    "max_edge": 1600,
+    "grayscale": False,
+    "image_format": "JPEG",
+    "quality": 85,
+}
 
-        image = image.resize((new_width, new_height))
+# 1リクエストあたりのタイムアウト（秒）
+DEFAULT_TIMEOUT = 60
+# 一時的なエラー時の再試行回数
+DEFAULT_MAX_RETRIES = 3
+# 再試行の初期待ち時間（秒）、失敗するたびに倍になる
+DEFAULT_BACKOFF = 1.0
 
-        # リサイズした画像を保存する
-        image.save(image_path)
+# 複数の画像をまとめて解析する場合（analyze_images）の、1リクエストあたりの画像の最大枚数
+# 1の場合はまとめずに1枚ずつ解析する
+DEFAULT_BATCH_IMAGES = 1
+# 1リクエストにまとめる画像の合計サイズ（base64変換後）の上限
+# （Gemini APIの1リクエストの上限は20MBなので、余裕をもたせる）
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+# ストラクチャアウトプット(AIにjson形式で出力させる)
+# iso8601
+# 小計（税抜き）
+# 税金
+# 合計
+# 店名
+# 個数
+# 長いレシートはどうする？とりま一枚で行けるか検証
+# 大まかなジャンルも出力するとよいかもしれない
+PROMPT = """画像にはレシートが含まれています。レシートの内容をjson形式で出力してください\n
+                    また、genreには商品やサービスの内容から判断して、適切なジャンル名を出力してください\n
+                例：\n
+                {   
+                    "store": "店名",
+                    "genre": "ジャンル名（食品、書籍、家電etc...）",
+                    "datetime": "iso8601の日時",
+                    "total": （税込みの）合計金額,
+                    "items": [
+                        {"name": "item1", "price": 500},
+                        {"name": "item2", "price": 500}
+                    ]
+                }
+                もし画像にレシートが含まれていない場合は、その旨を出力してください\n
+                例：\n  レシートが含まれていません\n
+
+                """
+
+# 複数の画像をまとめて解析する場合のプロンプト（{count}: 画像の枚数, {last}: 最後の画像の番号）
+BATCH_PROMPT = """{count}枚の画像（画像0〜画像{last}）には、それぞれレシートが1枚ずつ含まれています。
+                画像ごとにレシートの内容を読み取り、画像と同じ順番のjsonの配列で出力してください\n
+                indexには画像の番号を出力してください。genreには商品やサービスの内容から判断して、適切なジャンル名を出力してください\n
+                例：\n
+                [
+                    {{
+                        "index": 0,
+                        "store": "店名",
+                        "genre": "ジャンル名（食品、書籍、家電etc...）",
+                        "datetime": "iso8601の日時",
+                        "total": （税込みの）合計金額,
+                        "items": [
+                            {{"name": "item1", "price": 500}},
+                            {{"name": "item2", "price": 500}}
+                        ]
+                    }}
+                ]
+                レシートが含まれていない画像は {{"index": 番号, "error": "レシートが含まれていません"}} を出力してください\n
+                """
+
+
+def preprocess_image(image_data, max_edge=1600, grayscale=False, image_format="JPEG", quality=85):
+    """
+    画像をメモリ上で前処理する関数（ファイルには書き込まない）
+    EXIFの回転情報を反映し、長辺がmax_edgeになるように縮小して再エンコードする
+
+    Args:
+        image_data (bytes): 元の画像データ
+        max_edge (int): 長辺の最大ピクセル数
+        grayscale (bool): グレースケールに変換するかどうか
+        image_format (str): 再エンコードする形式（JPEG or WEBP）
+        quality (int): 再エンコードの品質（1~100）
+
+    Returns:
+        tuple: (前処理後の画像データ, MIMEタイプ)
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        # EXIFの向き情報に従って回転する（スマホの写真対策）
+        image = ImageOps.exif_transpose(image)
+    except (OSError, SyntaxError):
+        raise Exception("画像を読み込めません")
+
+    # 画像の縦横比を保ったまま、長辺がmax_edgeになるように縮小する
+    if max(image.width, image.height) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    if grayscale:
+        image = image.convert("L")
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    image_format = image_format.upper()
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=quality)
+    processed = buffer.getvalue()
+    mime_type = "image/webp" if image_format == "WEBP" else "image/jpeg"
+
+    # 削減できたバイト数と削減率をメトリクスに記録する（画像ごとに表示すると大量に出力されるため）
+    # 削減率は画像ごとにヒストグラムに記録する（大きくなった画像は負の値になる）
+    saved = len(image_data) - len(processed)
+    metrics.inc("receipt_preprocess_saved_bytes_total", max(saved, 0))
+    metrics.observe("receipt_preprocess_saved_ratio", saved / len(image_data) if image_data else 0.0)
+
+    return processed, mime_type
+
+
+def _is_retryable(error) -> bool:
+    """
+    再試行すべき一時的なエラーかどうかを判定する関数
+    （429: レート制限、5xx: サーバーエラー、タイムアウト）
+    """
+    from google.api_core import exceptions as google_exceptions
+
+    if isinstance(error, (google_exceptions.ResourceExhausted,
+                          google_exceptions.TooManyRequests,
+                          google_exceptions.InternalServerError,
+                          google_exceptions.ServiceUnavailable,
+                          google_exceptions.DeadlineExceeded,
+                          TimeoutError,
+                          ConnectionError)):
+        return True
+    return False
+
+
+def _get_cached(model, image_data, preprocess):
+    # キャッシュのキーと、キャッシュされた解析結果（ない場合はNone）を返す
+    # 前処理の設定が変わると送信する画像も変わるので、キーに含める
+    with metrics.timer("receipt_stage_seconds", stage="cache"):
+        prompt_version = PROMPT + (repr(sorted(PREPROCESS_OPTIONS.items())) if preprocess else "")
+        cache_key = response_cache.make_cache_key(image_data, prompt_version, getattr(model, "cache_name", MODEL_NAME))
+        cached = response_cache.get_cached_response(cache_key)
+    metrics.inc("receipt_cache_total", result="hit" if cached is not None else "miss")
+    return cache_key, cached
+
+
+def _encode_image(image_data, preprocess):
+    # 送信する画像を前処理してbase64に変換する
+    metrics.observe("receipt_image_bytes", len(image_data), kind="original")
+    if preprocess:
+        try:
+            with metrics.timer("receipt_stage_seconds", stage="preprocess"):
+                image_data, mime_type = preprocess_image(image_data, **PREPROCESS_OPTIONS)
+        except Exception as e:
+            metrics.inc("receipt_errors_total", stage="preprocess", error=type(e).__name__)
+            raise
+        metrics.observe("receipt_image_bytes", len(image_data), kind="processed")
+    else:
+        mime_type = "image/jpeg"
+    with metrics.timer("receipt_stage_seconds", stage="encode"):
+        encoded_image = base64.b64encode(image_data).decode('utf-8')
+    metrics.observe("receipt_image_bytes", len(encoded_image), kind="encoded")
+    return {'mime_type': mime_type, 'data': encoded_image}
+
+
+def _generate(model, contents, timeout, max_retries, backoff):
+    # モデルにリクエストを送る
+    # 一時的なエラーの場合は指数バックオフで再試行する
+    for attempt in range(max_retries + 1):
+        try:
+            with metrics.timer("receipt_stage_seconds", stage="model"):
+                response = model.generate_content(contents, request_options={"timeout": timeout})
+            break
+        except Exception as e:
+            metrics.inc("receipt_errors_total", stage="model", error=type(e).__name__)
+            if attempt >= max_retries or not _is_retryable(e):
+                raise
+            # 待ち時間を倍々にしつつ、同時に再試行が集中しないように揺らぎを加える
+            wait = backoff * (2 ** attempt) * (1 + random.random())
+            print(f"一時的なエラーのため{wait:.1f}秒後に再試行します: {e}")
+            metrics.inc("receipt_model_retries_total")
+            time.sleep(wait)
+
+    # トークン数（レスポンスにusage_metadataがある場合）
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        for kind, attribute in (("prompt", "prompt_token_count"), ("output", "candidates_token_count"),
+                                ("total", "total_token_count")):
+            count = getattr(usage, attribute, None)
+            if count is not None:
+                metrics.observe("receipt_model_tokens", count, kind=kind)
+    return response
+
+
+def _parse_response(response):
+    # レスポンスの整形
+    try:
+        with metrics.timer("receipt_stage_seconds", stage="parse"):
+            json_str = response.text.strip('```json\n').strip('```')
+            print(json_str)
+            return json.loads(json_str)
+    except json.JSONDecodeError:
+        metrics.inc("receipt_errors_total", stage="parse", error="JSONDecodeError")
+        raise Exception("レシートが含まれていません")
+
+
+def analyze_image(model, image_data, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF, use_cache=True, preprocess=True) -> dict:
+    """
+    画像1枚をAIに投げて、解析結果を辞書として返す関数
+    一時的なエラーの場合は指数バックオフで再試行する
+    同じ画像を解析したことがある場合は、AIに投げずにキャッシュの結果を返す
+    preprocessがTrueの場合は、PREPROCESS_OPTIONSに従って縮小・再エンコードしてから送信する
+
+    Args:
+        model: GenerativeModel
+        image_data (bytes): 画像データ
+        timeout (float): 1リクエストあたりのタイムアウト（秒）
+        max_retries (int): 再試行回数
+        backoff (float): 再試行の初期待ち時間（秒）
+        use_cache (bool): キャッシュを使うかどうか
+        preprocess (bool): 送信前に画像を前処理するかどうか
+
+    Returns:
+        dict: レシートの解析結果
+    """
+    if use_cache:
+        cache_key, cached = _get_cached(model, image_data, preprocess)
+        if cached is not None:
+            return cached
+
+    image_part = _encode_image(image_data, preprocess)
+    result = _parse_response(_generate(model, [image_part, PROMPT], timeout, max_retries, backoff))
+
+    if use_cache:
+        response_cache.put_cached_response(cache_key, result)
+    return result
+
+
+def _plan_batches(sizes, max_images, max_bytes) -> list:
+    # 画像を送信する順に、1リクエストにまとめる画像の番号のリストに分ける
+    # 枚数がmax_images、合計のサイズがmax_bytesを超えないようにする（1枚でmax_bytesを超える画像は1枚で送る）
+    batches = []
+    current, current_bytes = [], 0
+    for index, size in enumerate(sizes):
+        if current and (len(current) >= max_images or current_bytes + size > max_bytes):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(index)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _analyze_batch(model, image_parts, timeout, max_retries, backoff) -> list:
+    # 複数の画像を1リクエストで解析し、画像ごとの解析結果（正しくない場合はNone）のリストを返す
+    contents = []
+    for index, image_part in enumerate(image_parts):
+        contents += [f"画像{index}:", image_part]
+    contents.append(BATCH_PROMPT.format(count=len(image_parts), last=len(image_parts) - 1))
+
+    response = _generate(model, contents, timeout, max_retries, backoff)
+    entries = _parse_response(response)
+    if not isinstance(entries, list):
+        raise Exception("複数の画像の解析結果が配列ではありません")
+
+    results = [None] * len(image_parts)
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        index = entry.pop("index", None)
+        if isinstance(index, int) and 0 <= index < len(results) and results[index] is None \
+                and bulk_insert.is_valid_response(entry):
+            results[index] = entry
+    return results
+
+
+def analyze_images(model, image_data_list, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF,
+                   use_cache=True, preprocess=True, max_images=DEFAULT_BATCH_IMAGES, max_bytes=MAX_BATCH_BYTES) -> list:
+    """
+    複数の画像をまとめてAIに投げて、解析結果のリストを返す関数
+    1リクエストに最大max_images枚の画像を入れ、画像ごとの解析結果をJSONの配列で受け取るので、
+    リクエストの回数と、毎回送るプロンプトのトークン数を減らせる
+    1リクエストにまとめる枚数は、画像のサイズの合計がmax_bytesを超えないように減らす
+    解析結果が正しくない画像と、まとめたリクエストが失敗した場合は、1枚ずつ（analyze_image）解析し直す
+
+    Args:
+        model: GenerativeModel
+        image_data_list (list): 画像データ(bytes)のリスト
+        max_images (int): 1リクエストにまとめる画像の最大枚数
+        max_bytes (int): 1リクエストにまとめる画像の合計サイズ（base64変換後）の上限
+        その他の引数はanalyze_imageと同じ
+
+    Returns:
+        list: 解析結果のリスト（image_data_listと同じ順番）
+    """
+    results = [None] * len(image_data_list)
+    cache_keys = {}
+    pending = []
+    for index, image_data in enumerate(image_data_list):
+        if use_cache:
+            cache_keys[index], results[index] = _get_cached(model, image_data, preprocess)
+        if results[index] is None:
+            pending.append(index)
+
+    # 前処理でエラーになる画像は、最後に1枚ずつ解析するときにエラーにする
+    image_parts = {}
+    for index in pending:
+        try:
+            image_parts[index] = _encode_image(image_data_list[index], preprocess)
+        except Exception:
+            pass
+    encodable = [index for index in pending if index in image_parts]
+
+    sizes = [len(image_parts[index]["data"]) for index in encodable]
+    for batch in _plan_batches(sizes, max(1, int(max_images)), max_bytes):
+        batch = [encodable[i] for i in batch]
+        metrics.observe("receipt_batch_images", len(batch))
+        if len(batch) == 1:
+            # 1枚だけの場合は通常のプロンプトで解析する
+            continue
+        try:
+            batch_results = _analyze_batch(model, [image_parts[index] for index in batch], timeout, max_retries, backoff)
+        except Exception as e:
+            print(f"{len(batch)}枚まとめての解析に失敗したため、1枚ずつ解析します: {e}")
+            metrics.inc("receipt_batch_fallback_total", len(batch), reason="request")
+            continue
+        for index, result in zip(batch, batch_results):
+            if result is None:
+                metrics.inc("receipt_batch_fallback_total", reason="invalid")
+                continue
+            results[index] = result
+            if use_cache:
+                response_cache.put_cached_response(cache_keys[index], result)
+
+    # まとめて解析できなかった画像は1枚ずつ解析する
+    for index in pending:
+        if results[index] is not None:
+            continue
+        # 前処理でエラーになった画像は、ここでもう一度前処理してエラーを発生させる
+        image_part = image_parts.get(index) or _encode_image(image_data_list[index], preprocess)
+        results[index] = _parse_response(_generate(model, [image_part, PROMPT], timeout, max_retries, backoff))
+        if use_cache:
+            response_cache.put_cached_response(cache_keys[index], results[index])
+    return results
+
+
+class _GeminiModel:
+    """
+    APIキーごとのGeminiのモデル（GenerativeModelと同じく generate_content(contents, request_options=...) で呼ぶ）
+    genai.configureはプロセス全体の設定を書き換えるので使わず、APIキーごとに公開されているクライアント
+    （google.ai.generativelanguage.GenerativeServiceClient）を作成する（複数のAPIキーを同時に使える）
+    """
+
+    def __init__(self, api_key, model_name=MODEL_NAME):
+        import google.ai.generativelanguage as glm
+        self.cache_name = model_name
+        self._model = f"models/{model_name}"
+        self._client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+
+    def generate_content(self, contents, request_options=None):
+        import google.ai.generativelanguage as glm
+        import google.generativeai as genai
+
+        # 文字列はテキスト、{"mime_type", "data"(base64)} は画像として送る
+        parts = []
+        for part in contents:
+            if isinstance(part, str):
+                parts.append(glm.Part(text=part))
+            else:
+                data = part["data"]
+                if isinstance(data, str):
+                    data = base64.b64decode(data)
+                parts.append(glm.Part(inline_data=glm.Blob(mime_type=part["mime_type"], data=data)))
+        request = glm.GenerateContentRequest(model=self._model, contents=[glm.Content(role="user", parts=parts)])
+        response = self._client.generate_content(request, **(request_options or {}))
+        # .textとusage_metadataを持つGenerativeModelと同じ形式にする
+        return genai.types.GenerateContentResponse.from_response(response)
+
+
+# 作成したGeminiのモデル {(APIキー, モデル名): _GeminiModel}
+# モデルと接続（gRPCのチャネル）を使い回して、呼び出しのたびに接続し直さないようにする
+_gemini_models = {}
+_gemini_models_lock = threading.Lock()
+
+
+def _create_gemini_model(api_key, model_name=MODEL_NAME):
+    # APIキーが空の場合は環境変数から取得する
+    api_key = api_key or os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+    if not api_key:
+        raise Exception("APIキーが設定されていません（入力するか、環境変数GEMINI_API_KEYを設定してください）")
+
+    with _gemini_models_lock:
+        model = _gemini_models.get((api_key, model_name))
+        if model is None:
+            model = _gemini_models[(api_key, model_name)] = _GeminiModel(api_key, model_name)
+        return model
 
 
-def post_image(folder_path, api_key, is_discord=False) -> list:
+def clear_model_cache():
+    """
+    使い回しているGeminiのモデルと接続をすべて破棄する関数（APIキーを無効にした場合など）
+    """
+    with _gemini_models_lock:
+        _gemini_models.clear()
+
+
+def _create_simulated_model(api_key):
+    # 負荷試験用の模擬モデル（使うときだけ読み込む）
+    import simulated_model
+    return simulated_model.SimulatedModel(api_key)
+
+
+# 解析に使うモデルのバックエンド
+# {名前: APIキーを受け取ってモデルを返す関数}
+# モデルは generate_content(contents, request_options=...) で .text を持つレスポンスを返すもの
+# （cache_name属性がある場合は、キャッシュのキーにMODEL_NAMEの代わりに使う）
+BACKENDS = {
+    "gemini": _create_gemini_model,
+    # ネットワークやAPIの利用枠を使わずに動く模擬モデル（simulated_model.py）
+    "simulated": _create_simulated_model,
+}
+
+# 使用するバックエンド（環境変数RECEIPT_MODEL_BACKENDで変更できる）
+model_backend = os.getenv("RECEIPT_MODEL_BACKEND", "gemini")
+
+
+def set_model_backend(name):
+    """
+    使用するモデルのバックエンドを変更する関数
+    以降に作成するモデルは新しいバックエンドを使う
+
+    Args:
+        name (str): BACKENDSのキー
+    """
+    global model_backend
+    if name not in BACKENDS:
+        raise Exception(f"モデルのバックエンドがありません: {name}")
+    model_backend = name
+
+
+def get_model(api_key):
+    """
+    解析に使うモデルを取得する関数
+    現在のバックエンド（set_model_backend）のモデルを返し、APIキーが複数ある場合や1分あたりの上限を指定した場合は
+    キーのプール（key_pool.py）を返す（どちらもgenerate_contentで同じように使える）
+
+    Args:
+        api_key (str): APIキー（カンマ・改行区切りで複数指定可。空の場合は環境変数から取得）
+
+    Returns:
+        モデル（generate_contentを持つオブジェクト）
+    """
+    factory = BACKENDS.get(model_backend)
+    if factory is None:
+        raise Exception(f"モデルのバックエンドがありません: {model_backend}")
+
+    # APIキーが複数ある場合や、1分あたりの上限を指定した場合は、キーのプール（key_pool.py）で振り分ける
+    api_keys = key_pool.split_keys(api_key)
+    if len(api_keys) > 1 or key_pool.DEFAULT_RPM or key_pool.DEFAULT_TPM:
+        cache_name = MODEL_NAME if model_backend == "gemini" else None
+        return key_pool.get_pool(model_backend, api_keys or [""], factory, cache_name=cache_name)
+    return factory(api_key)
+
+
+def _analyze(model, image_data_list, timeout, max_retries, backoff, batch_images):
+    # batch_imagesが1の場合は1枚ずつ、2以上の場合はまとめて解析する
+    if batch_images <= 1:
+        return [analyze_image(model, image_data, timeout=timeout, max_retries=max_retries, backoff=backoff)
+                for image_data in image_data_list]
+    return analyze_images(model, image_data_list, timeout=timeout, max_retries=max_retries, backoff=backoff,
+                          max_images=batch_images)
+
+
+def _run_groups(process, items, max_workers, batch_images) -> list:
+    # itemsをbatch_images個ずつに分け、最大max_workers個ずつ並列にprocessで処理する
+    # グループごとに結果を受け取るので、1つのグループが失敗しても他のグループの処理は中止しない
+    # 戻り値はグループごとの結果（processの戻り値、または発生した例外）のリスト（itemsと同じ順番）
+    size = max(1, int(batch_images))
+    groups = [items[i:i + size] for i in range(0, len(items), size)]
+    if not groups:
+        return []
+    max_workers = max(1, min(int(max_workers), len(groups)))
+    outcomes = [None] * len(groups)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process, group): index for index, group in enumerate(groups)}
+        for future in as_completed(futures):
+            try:
+                outcomes[futures[future]] = future.result()
+            except Exception as e:
+                outcomes[futures[future]] = e
+    return outcomes
+
+
+def _flatten_groups(outcomes) -> list:
+    # 全グループの処理が終わった後に、失敗したグループがあれば最初の例外を発生させる
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            raise outcome
+    return [response for responses in outcomes for response in responses]
+
+
+# 処理した画像の移動先（成功した画像、失敗した画像）
+SUCCESS_FOLDER = "success"
+QUARANTINE_FOLDER = "quarantine"
+
+
+def move_unique(path, folder) -> str:
+    """
+    画像をfolderに移動する関数（同じ名前のファイルがすでにある場合は、名前に番号を付ける）
+
+    Returns:
+        str: 移動先のパス
+    """
+    os.makedirs(folder, exist_ok=True)
+    base, ext = os.path.splitext(os.path.basename(path))
+    destination = os.path.join(folder, base + ext)
+    number = 1
+    while os.path.exists(destination):
+        destination = os.path.join(folder, f"{base}_{number}{ext}")
+        number += 1
+    shutil.move(path, destination)
+    return destination
+
+
+def quarantine_image(path, error, folder=QUARANTINE_FOLDER) -> str:
+    """
+    処理に失敗した画像をfolderに移動し、失敗した理由を「画像名.error.txt」に書き込む関数
+
+    Returns:
+        str: 移動先のパス
+    """
+    print(f"画像の処理に失敗したため{folder}に移動します（{path}）: {error}")
+    destination = move_unique(path, folder)
+    with open(destination + ".error.txt", "w", encoding="utf-8") as f:
+        f.write(f"{type(error).__name__}: {error}\n")
+    return destination
+
+
+def _analyze_each(model, image_data_list, timeout, max_retries, backoff, batch_images) -> list:
+    # 画像ごとの解析結果のリストを返す（失敗した画像の位置には例外が入り、他の画像の処理は続ける）
+    if batch_images > 1 and len(image_data_list) > 1:
+        try:
+            return analyze_images(model, image_data_list, timeout=timeout, max_retries=max_retries, backoff=backoff,
+                                  max_images=batch_images)
+        except Exception:
+            # どの画像が原因かわからないので、1枚ずつ解析し直す（解析できた画像はキャッシュから返る）
+            pass
+    results = []
+    for image_data in image_data_list:
+        try:
+            results.append(analyze_image(model, image_data, timeout=timeout, max_retries=max_retries, backoff=backoff))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def post_image(folder_path, api_key, is_discord=False, max_workers=1, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF, batch_images=DEFAULT_BATCH_IMAGES) -> list:
+    """
+    フォルダの画像をAIに投げて解析し、batch_images枚のグループごとにデータベースに保存する関数
+    グループごとに1つのトランザクションで保存し、保存した後に画像をsuccessフォルダに移動する
+    解析に失敗した画像と解析結果の形式が正しくない画像は、理由と一緒にquarantineフォルダに移動する
+    （1枚が失敗しても、他の画像の解析・保存は続ける）
+
+    Args:
+        folder_path (str): 画像のフォルダ（空の場合はimages）。is_discordがTrueの場合は画像1枚のパス
+        is_discord (bool): Trueの場合は画像を移動せず、失敗した場合は例外を発生させる
+
+    Returns:
+        list: 保存したレシートの解析結果のリスト（画像の順番）
+    """
 
     # フォルダパスの設定
     if folder_path == "":
         folder_path = "images"
 
-    # APIキーの設定
-    # 空の場合は環境変数から取得する
-    if api_key == "":
-        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    else:
-        genai.configure(api_key=api_key)
-
-    model = genai.GenerativeModel("gemini-2.0-flash")
+    model = get_model(api_key)
+    init_db()
 
     if is_discord:
         image_list = [folder_path]
@@ -53,64 +617,74 @@ def post_image(folder_path, api_key, is_discord=False) -> list:
         if len(image_list) == 0:
             raise Exception("画像が見つかりません")
 
-    response_list = []
+    def quarantine(path, error):
+        if is_discord:
+            raise error
+        metrics.inc("receipt_files_total", result="quarantine")
+        try:
+            quarantine_image(path, error)
+        except OSError as e:
+            print(f"画像を移動できませんでした（{path}）: {e}")
+
+    def process(image_paths):
+        image_data_list = []
+        for image_path in image_paths:
+            with metrics.timer("receipt_stage_seconds", stage="read"):
+                with open(image_path, "rb") as image_file:
+                    image_data_list.append(image_file.read())
 
-    # 画像を1枚ずつ処理する
-    for image_path in image_list:
-        with open(image_path, "rb") as image_file:
-            image_data = image_file.read()
+        responses = _analyze_each(model, image_data_list, timeout, max_retries, backoff, batch_images)
 
-        # ストラクチャアウトプット(AIにjson形式で出力させる)
-        # iso8601
-        # 小計（税抜き）
-        # 税金
-        # 合計
-        # 店名
-        # 個数
-        # 長いレシートはどうする？とりま一枚で行けるか検証
-        # 大まかなジャンルも出力するとよいかもしれない
+        saved = []
+        for image_path, response in zip(image_paths, responses):
+            if isinstance(response, Exception):
+                quarantine(image_path, response)
+            elif not bulk_insert.is_valid_response(response):
+                quarantine(image_path, Exception(f"レシートの解析結果の形式が正しくありません: {response}"))
+            else:
+                saved.append((image_path, response))
+        if not saved:
+            return []
 
-        prompt = """画像にはレシートが含まれています。レシートの内容をjson形式で出力してください\n
-                    また、genreには商品やサービスの内容から判断して、適切なジャンル名を出力してください\n
-                例：\n
-                {   
-                    "store": "店名",
-                    "genre": "ジャンル名（食品、書籍、家電etc...）",
-                    "datetime": "iso8601の日時",
-                    "total": （税込みの）合計金額,
-                    "items": [
-                        {"name": "item1", "price": 500},
-                        {"name": "item2", "price": 500}
-                    ]
-                }
-                もし画像にレシートが含まれていない場合は、その旨を出力してください\n
-                例：\n  レシートが含まれていません\n
+        # 保存が終わってから画像を移動する（保存に失敗した画像は解析し直せるようにquarantineに移動する）
+        try:
+            save_to_db([response for _, response in saved])
+        except Exception as e:
+            for image_path, _ in saved:
+                quarantine(image_path, e)
+            return []
 
-                """
+        # discordからのリクエストでない場合は、処理が成功した画像を別フォルダに移動する
+        if not is_discord:
+            for image_path, _ in saved:
+                with metrics.timer("receipt_stage_seconds", stage="move"):
+                    move_unique(image_path, SUCCESS_FOLDER)
+                metrics.inc("receipt_files_total", result="success")
+        return [response for _, response in saved]
 
-        response = model.generate_content([
-        {'mime_type': 'image/jpeg', 'data': base64.b64encode(image_data).decode('utf-8')}, 
-        prompt
-        ])
+    return _flatten_groups(_run_groups(process, image_list, max_workers, batch_images))
 
-        # レスポンスの整形
-        try:
-            json_str = response.text.strip('```json\n').strip('```')
-            print(json_str)
 
-            # レスポンスをリストに追加
-            response_list.append(json.loads(json_str))
-
-            # discordからのリクエストでない場合は画像を削除する
-            if not is_discord:
-                # 処理が成功した画像を別フォルダに移動する
-                os.makedirs("success", exist_ok=True)
-                shutil.move(image_path, "success")
-            
-        except json.JSONDecodeError:
-            raise Exception("レシートが含まれていません")
-    
-    return response_list
+def post_image_data(image_data_list, api_key, max_workers=1, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF, batch_images=DEFAULT_BATCH_IMAGES) -> list:
+    """
+    メモリ上の画像データをAIに投げて、解析結果のリストを返す関数
+    discordなど、ファイルを経由せずに画像を受け取る場合に使う
+
+    Args:
+        image_data_list (list): 画像データ(bytes)のリスト
+        api_key (str): APIキー（空の場合は環境変数から取得）
+        max_workers (int): 同時に処理するリクエストの最大数
+        batch_images (int): 1リクエストにまとめる画像の最大枚数（1の場合はまとめない）
+
+    Returns:
+        list: 解析結果のリスト（image_data_listと同じ順番）
+    """
+    model = get_model(api_key)
+
+    def process(group):
+        return _analyze(model, group, timeout, max_retries, backoff, batch_images)
+
+    return _flatten_groups(_run_groups(process, image_data_list, max_workers, batch_images))
 
 # テスト
 # post_image(R"C:\Users\hugu\Desktop\python\receipt_kanri\images\image.jpg")
@@ -119,63 +693,77 @@ def post_image(folder_path, api_key, is_discord=False) -> list:
 # 以下、データベースへの保存処理
 
 def init_db():
-    conn = sqlite3.connect('receipts.db')
-    cursor = conn.cursor()
-    
-    # レシート一覧テーブルの作成
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS receipts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            store TEXT,
-            genre TEXT,
-            datetime TEXT,
-            total REAL
-        )
-    ''')
-    
-    # 商品詳細テーブルの作成
+    # テーブルの作成・更新はdb.pyで最初に接続したときにmigrations.pyで行われる
+    db.get_connection()
+
+def insert_receipt(cursor, response) -> int:
+    """
+    レシート1件とその商品を、渡されたカーソルで挿入する関数
+    コミットは呼び出し側で行う
+
+    Args:
+        cursor: sqlite3のカーソル
+        response (dict): レシートの解析結果
+
+    Returns:
+        int: 挿入したレシートのID
+    """
+    # 店舗名・ジャンル名は正規化してIDにする（dimensions.py）
+    response = dimensions.normalize_response(response)
+    store_id = dimensions.get_ids(cursor.connection, "store", [response['store']]).get(response['store'])
+    genre_id = dimensions.get_ids(cursor.connection, "genre", [response['genre']]).get(response['genre'])
+
+    # レシート情報の保存
+    # 日付と年月は集計・検索用にdatetimeから切り出して保存する
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            receipt_id TEXT,
-            name TEXT,
-            price REAL,
-            FOREIGN KEY (receipt_id) REFERENCES receipts (id)
-        )
-    ''')
-
-    conn.commit()
-    conn.close()
-
-def save_to_db(response_list: list):
-    conn = sqlite3.connect('receipts.db')
-    cursor = conn.cursor()
+        INSERT INTO receipts (store_id, genre_id, datetime, date, month, total)
+        VALUES (?, ?, ?, substr(?, 1, 10), substr(?, 1, 7), ?)
+    ''', (store_id, genre_id, response['datetime'],
+          response['datetime'], response['datetime'], response['total']))
     
-    for response in response_list:
-        # レシート情報の保存
+    # レシートIDの取得
+    receipt_id = cursor.lastrowid
+
+    # 商品情報の保存
+    for item in response['items']:
         cursor.execute('''
-            INSERT INTO receipts (store, genre, datetime, total)
-            VALUES (?, ?, ?, ?)
-        ''', (response['store'], response['genre'], response['datetime'], response['total']))
-        
-        # レシートIDの取得
-        receipt_id = cursor.lastrowid
-
-        # 商品情報の保存
-        for item in response['items']:
-            cursor.execute('''
-                INSERT INTO items (receipt_id, name, price)
-                VALUES (?, ?, ?)
-            ''', (receipt_id, item['name'], item['price']))
-
-        print(f"レシート情報をデータベースに保存しました: {receipt_id}")
-    
-    conn.commit()
-    conn.close()
+            INSERT INTO items (receipt_id, name, price)
+            VALUES (?, ?, ?)
+        ''', (receipt_id, item['name'], item['price']))
+
+    return receipt_id
+
+
+def save_to_db(response_list: list) -> dict:
+    # executemanyでまとめて挿入する（件数が多い場合はバッチごとにコミットする）
+    # 戻り値はbulk_insert.insert_receiptsの結果（保存した件数と、最初・最後のレシートID）
+    try:
+        with metrics.timer("receipt_stage_seconds", stage="db_write"):
+            result = bulk_insert.insert_receipts(response_list)
+    except Exception as e:
+        metrics.inc("receipt_errors_total", stage="db_write", error=type(e).__name__)
+        raise
+    metrics.inc("receipts_saved_total", result["receipts"])
+    if result["receipts"] > 0:
+        print(f"レシート情報をデータベースに保存しました: {result['first_id']}〜{result['last_id']}（{result['receipts']}件）")
+    return result
+
+
+@metrics.profiled
+def main_process(folder_path, api_key, is_discord=False, max_workers=DEFAULT_MAX_WORKERS, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF, batch_images=DEFAULT_BATCH_IMAGES):
+    # 解析結果はpost_imageの中でグループごとに保存する
+    response = post_image(folder_path, api_key, is_discord=is_discord, max_workers=max_workers,
+                          max_retries=max_retries, backoff=backoff, batch_images=batch_images)
+    print(f"キャッシュ: {response_cache.get_cache_stats()}")
+    return json.dumps(response, indent=4, ensure_ascii=False)
 
 
-def main_process(folder_path, api_key, is_discord=False):
-    response = post_image(folder_path, api_key, is_discord=is_discord)
+@metrics.profiled
+def main_process_data(image_data, api_key, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF):
+    """
+    メモリ上の画像データ1枚を解析してデータベースに保存する関数（discord用）
+    """
+    response = post_image_data([image_data], api_key, max_retries=max_retries, backoff=backoff)
     init_db()
     save_to_db(response)
     return json.dumps(response, indent=4, ensure_ascii=False)
\ No newline at end of file
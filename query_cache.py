@@ -0,0 +1,116 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+import db
+import metrics
+
+# db_to_listの関数の結果をプロセス内にキャッシュする
+# キーは (データベースのパス, 関数名, 引数)
+# データの更新回数（db.get_data_version）が変わったら、古い結果は使わない
+# 別のプロセス（discord bot、ジョブのワーカーなど）が書き込んだ場合も検知できる
+
+# キャッシュの最大件数と、キャッシュする結果の行数の合計の上限（超えた分は最後に使われたのが古い順に削除）
+MAX_ENTRIES = 256
+MAX_ROWS = 100000
+# 1つの結果の行数がこれを超える場合はキャッシュしない
+MAX_ENTRY_ROWS = 10000
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+# キャッシュしている結果の行数の合計
+_total_rows = 0
+
+
+def _row_count(result):
+    # 戻り値の行数（ページの場合は (行, カーソル)、検索の場合は {"rows": 行, ...}）
+    if isinstance(result, dict):
+        result = result.get("rows", [])
+    elif isinstance(result, tuple) and result and isinstance(result[0], list):
+        result = result[0]
+    return len(result) if isinstance(result, list) else 1
+
+
+def cached(func):
+    """
+    関数の結果をキャッシュするデコレータ
+    引数はハッシュ可能なものに限る
+    戻り値はキャッシュと共有されるので、呼び出し側で変更しないこと
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        key = (db.db_path, func.__qualname__, args, tuple(sorted(kwargs.items())))
+        version = db.get_data_version()
+
+        with _lock:
+            entry = _cache.get(key)
+            if entry is not None and entry[0] == version:
+                _cache.move_to_end(key)
+                _stats["hits"] += 1
+                found = True
+            else:
+                found = False
+                _stats["misses"] += 1
+        if found:
+            metrics.observe("db_list_seconds", time.perf_counter() - start, function=func.__name__, cache="hit")
+            return entry[1]
+
+        result = func(*args, **kwargs)
+        rows = _row_count(result)
+        metrics.observe("db_list_seconds", time.perf_counter() - start, function=func.__name__, cache="miss")
+        metrics.observe("db_list_rows", rows, function=func.__name__)
+        if rows > MAX_ENTRY_ROWS:
+            return result
+
+        with _lock:
+            _put(key, (version, result, rows))
+        return result
+
+    return wrapper
+
+
+def _put(key, entry):
+    # _lockを取った状態で呼ぶ
+    global _total_rows
+    old = _cache.pop(key, None)
+    if old is not None:
+        _total_rows -= old[2]
+    _cache[key] = entry
+    _total_rows += entry[2]
+    while len(_cache) > MAX_ENTRIES or _total_rows > MAX_ROWS:
+        _total_rows -= _cache.popitem(last=False)[1][2]
+
+
+def get_cache_stats() -> dict:
+    """
+    キャッシュのヒット・ミスの回数と件数を取得する関数
+
+    Returns:
+        dict: hits, misses, hit_ratio, entries, rows（キャッシュしている行数の合計）
+    """
+    with _lock:
+        hits = _stats["hits"]
+        misses = _stats["misses"]
+        entries = len(_cache)
+        rows = _total_rows
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / total if total else 0.0,
+        "entries": entries,
+        "rows": rows,
+    }
+
+
+def clear_cache():
+    """
+    キャッシュをすべて削除する関数
+    """
+    global _total_rows
+    with _lock:
+        _cache.clear()
+        _total_rows = 0
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import sys
+import threading
+import time
+
+import bulk_insert
+import db
+
+# キャッシュの最大件数（超えた分は最後に使われたのが古い順に削除）
+MAX_ENTRIES = 10000
+# キャッシュの有効期限（日）
+MAX_AGE_DAYS = 90
+# 何回書き込むごとに削除処理を行うか
+EVICT_INTERVAL = 100
+# ヒットの記録（最終利用日時・ヒット数）をまとめて書き込む件数
+# ヒットのたびに書き込みロックを取らないように、メモリに貯めておき、
+# 保存（put_cached_response）・削除（evict）のとき、またはこの件数を超えたときにまとめて書き込む
+HIT_FLUSH_SIZE = 1000
+
+# ヒット・ミスの回数（プロセス内）
+_stats = {"hits": 0, "misses": 0}
+_lock = threading.Lock()
+_put_count = 0
+# 書き込んでいないヒットの記録 {キー: (最終利用日時, ヒット数)}
+_pending_hits = {}
+
+
+def make_cache_key(image_data, prompt, model_name) -> str:
+    """
+    画像データ・プロンプト・モデル名からキャッシュのキーを作成する関数
+    プロンプトやモデルが変わった場合は別のキーになる
+
+    Args:
+        image_data (bytes): 画像データ
+        prompt (str): AIに渡すプロンプト
+        model_name (str): モデル名
+
+    Returns:
+        str: sha256のハッシュ値
+    """
+    h = hashlib.sha256()
+    h.update(model_name.encode("utf-8"))
+    h.update(b"\0")
+    h.update(prompt.encode("utf-8"))
+    h.update(b"\0")
+    h.update(image_data)
+    return h.hexdigest()
+
+
+def get_cached_response(key):
+    """
+    キャッシュから解析結果を取得する関数
+
+    Args:
+        key (str): make_cache_keyで作成したキー
+
+    Returns:
+        dict | None: キャッシュされた解析結果（ない場合や期限切れの場合はNone）
+    """
+    now = time.time()
+    conn = db.get_connection()
+    row = conn.execute(
+        "SELECT response FROM response_cache WHERE key = ? AND created_at >= ?",
+        (key, now - MAX_AGE_DAYS * 86400)
+    ).fetchone()
+
+    if row is None:
+        with _lock:
+            _stats["misses"] += 1
+        return None
+
+    # 最終利用日時とヒット数はメモリに記録し、後でまとめて書き込む
+    with _lock:
+        _stats["hits"] += 1
+        count = _pending_hits.get(key, (now, 0))[1]
+        _pending_hits[key] = (now, count + 1)
+        need_flush = len(_pending_hits) >= HIT_FLUSH_SIZE
+    if need_flush:
+        with db.transaction() as conn:
+            _flush_hits(conn)
+    return json.loads(row[0])
+
+
+def _flush_hits(conn):
+    # 貯めておいたヒットの記録を書き込む（書き込みのトランザクションの中で呼ぶ）
+    with _lock:
+        hits = list(_pending_hits.items())
+        _pending_hits.clear()
+    if hits:
+        conn.executemany(
+            "UPDATE response_cache SET last_used_at = MAX(last_used_at, ?), hit_count = hit_count + ? WHERE key = ?",
+            [(last_used_at, count, key) for key, (last_used_at, count) in hits]
+        )
+
+
+def flush_hits():
+    """
+    貯めておいたヒットの記録（最終利用日時・ヒット数）をデータベースに書き込む関数
+    """
+    with db.transaction() as conn:
+        _flush_hits(conn)
+
+
+def put_cached_response(key, response):
+    """
+    解析結果をキャッシュに保存する関数
+    保存できる形式でない解析結果（レシートが含まれていない場合など）は保存しない（次回は解析し直す）
+
+    Args:
+        key (str): make_cache_keyで作成したキー
+        response (dict): 解析結果
+
+    Returns:
+        bool: 保存した場合はTrue
+    """
+    global _put_count
+    if not bulk_insert.is_valid_response(response):
+        return False
+
+    now = time.time()
+    with db.transaction() as conn:
+        _flush_hits(conn)
+        conn.execute(
+            "INSERT OR REPLACE INTO response_cache (key, response, created_at, last_used_at, hit_count) VALUES (?, ?, ?, ?, 0)",
+            (key, json.dumps(response, ensure_ascii=False), now, now)
+        )
+
+    # 一定回数ごとに古いキャッシュを削除する
+    with _lock:
+        _put_count += 1
+        need_evict = _put_count % EVICT_INTERVAL == 0
+    if need_evict:
+        evict()
+    return True
+
+
+def evict(max_entries=MAX_ENTRIES, max_age_days=MAX_AGE_DAYS) -> int:
+    """
+    期限切れのキャッシュと、最大件数を超えた分のキャッシュを削除する関数
+
+    Returns:
+        int: 削除した件数
+    """
+    with db.transaction() as conn:
+        # 最後に使われた日時で削除する分を決めるので、先にヒットの記録を書き込む
+        _flush_hits(conn)
+
+        # 期限切れのキャッシュを削除
+        cursor = conn.execute(
+            "DELETE FROM response_cache WHERE created_at < ?",
+            (time.time() - max_age_days * 86400,)
+        )
+        deleted = cursor.rowcount
+
+        # 最大件数を超えた分を、最後に使われたのが古い順に削除
+        cursor = conn.execute('''
+            DELETE FROM response_cache WHERE key IN (
+                SELECT key FROM response_cache
+                ORDER BY last_used_at DESC
+                LIMIT -1 OFFSET ?
+            )
+        ''', (max_entries,))
+        deleted += cursor.rowcount
+
+    return deleted
+
+
+def get_cache_stats() -> dict:
+    """
+    キャッシュのヒット・ミスの回数と件数を取得する関数
+
+    Returns:
+        dict: hits, misses, hit_ratio, entries
+    """
+    entries = db.get_connection().execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+    with _lock:
+        hits = _stats["hits"]
+        misses = _stats["misses"]
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / total if total else 0.0,
+        "entries": entries,
+    }
+
+
+def clear_cache():
+    """
+    キャッシュをすべて削除する関数
+    """
+    with _lock:
+        _pending_hits.clear()
+    with db.transaction() as conn:
+        conn.execute("DELETE FROM response_cache")
+
+
+if __name__ == "__main__":
+    # 使用例: python response_cache.py [stats|evict|clear]
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "evict":
+        print(f"{evict()}件のキャッシュを削除しました")
+    elif command == "clear":
+        clear_cache()
+        print("キャッシュをすべて削除しました")
+    else:
+        print(json.dumps(get_cache_stats(), indent=4, ensure_ascii=False))
@@ -0,0 +1,91 @@
+import sys
+import db
+
+# 集計済みの値を保存するテーブル（ロールアップ）
+# 通常はreceiptsのトリガーで差分が反映されるので、作り直す必要があるのは
+# トリガーを通さずにデータを直接書き換えた場合などに限られる
+# 店舗・ジャンルはID（stores・genresテーブル）で集計し、名前は表示するときに結合する
+# (テーブル名, キー列, receiptsからキーを求める式)
+ROLLUPS = [
+    ("rollup_store", "store_id", "store_id"),
+    ("rollup_genre", "genre_id", "genre_id"),
+    ("rollup_month", "month", "month"),
+    ("rollup_day", "date", "date"),
+    ("rollup_weekday", "weekday", "CAST(strftime('%w', date) AS INTEGER)"),
+]
+
+# rollup_weekdayのキー（0: 日曜日 ~ 6: 土曜日）に対応する曜日名
+WEEKDAY_NAMES = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"]
+
+
+def rebuild_rollups():
+    """
+    receiptsテーブルからロールアップを作り直す関数
+    """
+    with db.transaction() as conn:
+        for table, key, expression in ROLLUPS:
+            conn.execute(f"DELETE FROM {table}")
+            conn.execute(f'''
+                INSERT INTO {table} ({key}, total, count)
+                SELECT {expression}, COALESCE(SUM(total), 0), COUNT(*)
+                FROM receipts
+                WHERE {expression} IS NOT NULL
+                GROUP BY {expression}
+            ''')
+        db.bump_data_version(conn)
+
+
+def add_receipts(conn, first_id, last_id):
+    """
+    IDがfirst_id〜last_idのレシートを、まとめてロールアップに加える関数
+    挿入時のトリガーを止めてまとめて挿入した場合（bulk_insert）に、同じトランザクションの中で呼ぶ
+    """
+    for table, key, expression in ROLLUPS:
+        conn.execute(f'''
+            INSERT INTO {table} ({key}, total, count)
+            SELECT {expression}, COALESCE(SUM(total), 0), COUNT(*)
+            FROM receipts
+            WHERE id BETWEEN ? AND ? AND {expression} IS NOT NULL
+            GROUP BY {expression}
+            ON CONFLICT ({key}) DO UPDATE SET
+                total = total + excluded.total,
+                count = count + excluded.count
+        ''', (first_id, last_id))
+
+
+def get_name_summary(conn, kind) -> list:
+    """
+    店舗別・ジャンル別集計を名前の順で取得する関数（IDで集計したロールアップに名前を結合する）
+
+    Args:
+        kind (str): "store" または "genre"
+
+    Returns:
+        list: [名前, 合計金額, 件数] の二次元配列
+    """
+    table, key = {"store": ("stores", "store_id"), "genre": ("genres", "genre_id")}[kind]
+    return [list(row) for row in conn.execute(f'''
+        SELECT {table}.name, rollup_{kind}.total, rollup_{kind}.count
+        FROM rollup_{kind} JOIN {table} ON {table}.id = rollup_{kind}.{key}
+        ORDER BY {table}.name
+    ''')]
+
+
+def get_weekday_summary(conn) -> list:
+    """
+    曜日別集計を月曜日始まりの順で取得する関数
+
+    Returns:
+        list: [曜日名, 合計金額, 件数] の二次元配列
+    """
+    rows = dict((row[0], row[1:]) for row in conn.execute("SELECT weekday, total, count FROM rollup_weekday"))
+    # 月曜日 ~ 日曜日の順に並べる
+    return [[WEEKDAY_NAMES[w]] + list(rows[w]) for w in [1, 2, 3, 4, 5, 6, 0] if w in rows]
+
+
+if __name__ == "__main__":
+    # 使用例: python rollups.py [データベースのパス]
+    if len(sys.argv) > 1:
+        db.set_db_path(sys.argv[1])
+    rebuild_rollups()
+    print("集計テーブルを作り直しました")
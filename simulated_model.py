@@ -0,0 +1,214 @@
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from google.api_core import exceptions as google_exceptions
+
+import synthetic_data
+
+# Gemini APIの代わりにローカルで動く模擬モデル（負荷試験用）
+# postimage.set_model_backend("simulated") または 環境変数RECEIPT_MODEL_BACKEND=simulated で使う
+# それらしいレシートのJSONを返し、応答時間のばらつき・エラー・レート制限を再現できる
+#
+# エラーはGemini APIと同じ例外を投げるので、postimageの再試行の処理もそのまま確認できる
+#   429: google_exceptions.ResourceExhausted（レート制限を超えた場合も同じ）
+#   500: google_exceptions.InternalServerError
+#   malformed: JSONとして読めないテキストを返す
+#   （複数の画像をまとめたリクエストの場合は、配列のうち1件だけを形式の正しくない解析結果にする）
+
+# 設定の既定値（環境変数SIMULATED_MODEL_OPTIONSにJSONで指定すると上書きできる）
+# latency: 応答時間の分布
+#   {"distribution": "lognormal", "median": 秒, "sigma": ばらつき}
+#   {"distribution": "uniform", "low": 秒, "high": 秒}
+#   {"distribution": "fixed", "seconds": 秒}
+# error_rates: リクエストごとにエラーにする確率
+# rpm: 1分あたりのリクエスト数の上限（APIキーごと、0で無制限）
+# seed: 乱数のシード（Noneの場合は毎回変わる）
+DEFAULT_OPTIONS = {
+    "latency": {"distribution": "lognormal", "median": 1.5, "sigma": 0.4},
+    "error_rates": {"429": 0.0, "500": 0.0, "malformed": 0.0},
+    "rpm": 0,
+    "seed": None,
+}
+
+_options = json.loads(json.dumps(DEFAULT_OPTIONS))
+_options.update(json.loads(os.getenv("SIMULATED_MODEL_OPTIONS", "{}")))
+
+# APIキーごとの直近1分間のリクエスト時刻（レート制限用）
+_requests = {}
+# 呼び出し回数・結果ごとの回数（負荷試験の集計用）
+_stats = {"calls": 0, "ok": 0, "429": 0, "500": 0, "malformed": 0, "rate_limited": 0, "timeout": 0}
+# 作成したモデルの数（シードを指定した場合に、モデルごとに異なる乱数にするため）
+_instances = 0
+_lock = threading.Lock()
+
+
+def configure(**options):
+    """
+    模擬モデルの設定を変更する関数（DEFAULT_OPTIONSのキーを指定する）
+    以降に作成するモデルは新しい設定を使う
+    """
+    with _lock:
+        for key, value in options.items():
+            if key not in DEFAULT_OPTIONS:
+                raise Exception(f"模擬モデルの設定がありません: {key}")
+            if isinstance(value, dict):
+                _options[key] = dict(_options[key], **value)
+            else:
+                _options[key] = value
+
+
+def get_options() -> dict:
+    """
+    模擬モデルの現在の設定を取得する関数
+    """
+    with _lock:
+        return json.loads(json.dumps(_options))
+
+
+def get_stats() -> dict:
+    """
+    模擬モデルの呼び出し回数と、結果ごとの回数を取得する関数
+
+    Returns:
+        dict: calls, ok, 429, 500, malformed, rate_limited（rpmを超えたため429にした回数）,
+              timeout（応答時間がタイムアウトを超えた回数）
+    """
+    with _lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    """
+    呼び出し回数とレート制限の記録を削除する関数
+    （シードを指定した場合は、以降に作成するモデルの乱数も最初からやり直す）
+    """
+    global _instances
+    with _lock:
+        _instances = 0
+        for key in _stats:
+            _stats[key] = 0
+        _requests.clear()
+
+
+class _UsageMetadata:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class _Response:
+    # google.generativeaiのレスポンスと同じく、textで本文、usage_metadataでトークン数を返す
+    # （トークン数は画像1枚あたり258トークン + 文字数からのおおよその値）
+    def __init__(self, text, prompt_length=0, images=1):
+        self.text = text
+        self.usage_metadata = _UsageMetadata(258 * images + prompt_length // 2, max(1, len(text) // 2))
+
+
+class SimulatedModel:
+    """
+    GenerativeModelと同じ呼び出し方ができる模擬モデル
+    """
+    cache_name = "simulated"
+
+    def __init__(self, api_key=""):
+        global _instances
+        self.options = get_options()
+        self.api_key = api_key
+        with _lock:
+            _instances += 1
+            instance = _instances
+        # シードを指定した場合でも、モデルを作るたびに同じ結果が繰り返されないようにする
+        seed = self.options["seed"]
+        self._rng = random.Random(f"{seed}-{instance}" if seed is not None else None)
+        # 返すレシートはsynthetic_dataと同じ方法で作る
+        self._receipts = synthetic_data.generate_receipts(
+            10 ** 12, seed=self._rng.randrange(2 ** 32), num_stores=50
+        )
+        self._rng_lock = threading.Lock()
+
+    def _latency(self) -> float:
+        latency = self.options["latency"]
+        distribution = latency.get("distribution", "lognormal")
+        with self._rng_lock:
+            if distribution == "fixed":
+                return latency["seconds"]
+            if distribution == "uniform":
+                return self._rng.uniform(latency["low"], latency["high"])
+            return latency["median"] * math.exp(latency.get("sigma", 0) * self._rng.gauss(0, 1))
+
+    def _check_rate_limit(self) -> bool:
+        # 直近1分間のリクエスト数がrpmを超えている場合はFalse
+        rpm = self.options["rpm"]
+        if not rpm:
+            return True
+        now = time.monotonic()
+        with _lock:
+            window = _requests.setdefault(self.api_key, deque())
+            while window and window[0] <= now - 60:
+                window.popleft()
+            if len(window) >= rpm:
+                return False
+            window.append(now)
+            return True
+
+    def _count(self, outcome):
+        with _lock:
+            _stats[outcome] += 1
+
+    def generate_content(self, contents, request_options=None):
+        """
+        画像とプロンプトを受け取って、レシートのJSONを返す（画像の内容は見ない）
+        画像が複数の場合は、画像ごとのレシートにindexを付けたJSONの配列を返す
+        """
+        with _lock:
+            _stats["calls"] += 1
+
+        if not self._check_rate_limit():
+            self._count("rate_limited")
+            raise google_exceptions.ResourceExhausted("Resource has been exhausted (simulated rate limit)")
+
+        latency = self._latency()
+        timeout = (request_options or {}).get("timeout")
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            self._count("timeout")
+            raise google_exceptions.DeadlineExceeded("Deadline Exceeded (simulated)")
+        time.sleep(max(0.0, latency))
+
+        prompt_length = sum(len(part) for part in contents if isinstance(part, str))
+        images = max(1, sum(1 for part in contents if isinstance(part, dict)))
+
+        # エラーの種類をerror_ratesの確率で選ぶ
+        with self._rng_lock:
+            draw = self._rng.random()
+            receipts = [next(self._receipts) for _ in range(images)]
+            broken = self._rng.randrange(images) if images > 1 else 0
+        for outcome in ("429", "500", "malformed"):
+            rate = self.options["error_rates"].get(outcome, 0.0)
+            if draw < rate:
+                self._count(outcome)
+                if outcome == "429":
+                    raise google_exceptions.ResourceExhausted("Resource has been exhausted (simulated)")
+                if outcome == "500":
+                    raise google_exceptions.InternalServerError("Internal error (simulated)")
+                if images == 1:
+                    # JSONとして読めない応答（途中で切れたJSON）
+                    return _Response("```json\n" + json.dumps(receipts[0], ensure_ascii=False)[:40], prompt_length)
+                # 配列のうち1件だけ、保存できない形式（itemsがない）にする
+                receipts[broken] = {key: value for key, value in receipts[broken].items() if key != "items"}
+                break
+            draw -= rate
+        else:
+            self._count("ok")
+
+        if images == 1:
+            body = receipts[0]
+        else:
+            body = [dict(receipt, index=index) for index, receipt in enumerate(receipts)]
+        return _Response("```json\n" + json.dumps(body, ensure_ascii=False, indent=4) + "\n```", prompt_length, images)
@@ -0,0 +1,371 @@
+import datetime
+import json
+import math
+import sys
+from collections import Counter
+
+import db
+import dimensions
+
+# 概要タブに表示する統計（レシートの合計金額の統計量・分位点、直近7日・30日の支出、よく行く店舗・よく買う商品）
+# 保存のたびに差分だけを加えて更新し、結果はstats_stateテーブルに保存する（表示のたびに全件を読まない）
+# 保存するトランザクションの中で更新するので、ロールバックした場合は統計も元に戻る
+#
+# 統計の種類:
+#   totals: 件数・合計・平均・分散（Welfordの方法）・最小・最大
+#   sketch: 分位点の近似（DDSketch: 値を対数の幅のビンで数える。相対誤差SKETCH_ALPHA以内、ビンを足せば併合できる）
+#   days: 日ごとの支出（最新の日付からROLLING_DAYS日分だけ持つ）
+#   stores, items: 件数の多い店舗・商品（Space-Saving: TOP_CAPACITY個の候補だけを数える）
+#
+# receipts・itemsの削除・更新時はトリガーで保存した統計を削除し、次に読むときに作り直す
+# bulk_insert以外でレシートを保存する場合は、同じトランザクションの中でadd_responsesを呼ぶ
+# 数値でない金額（"1,280円"など）とISO形式でない日付（"2024年1月5日"など）は統計に含めない
+# （統計の更新はレシートを保存するトランザクションの中で行うので、保存を失敗させないように例外を発生させない）
+
+# 分位点の相対誤差
+SKETCH_ALPHA = 0.01
+# 表示する分位点
+QUANTILES = (0.5, 0.9, 0.99)
+# 直近の支出を集計する日数
+ROLLING_WINDOWS = (7, 30)
+ROLLING_DAYS = max(ROLLING_WINDOWS)
+# 店舗・商品ごとに数える候補の数（多いほど正確になる）
+TOP_CAPACITY = 100
+# 表示する店舗・商品の数
+TOP_N = 5
+# 作り直すときに一度に読み込む行数
+CHUNK_SIZE = 100000
+
+_GAMMA = (1 + SKETCH_ALPHA) / (1 - SKETCH_ALPHA)
+_LOG_GAMMA = math.log(_GAMMA)
+
+
+# SQLで数値の金額だけを対象にする条件（古いデータベースには文字列の金額が保存されている場合がある）
+NUMERIC_TOTAL_SQL = "typeof(total) IN ('integer', 'real')"
+NUMERIC_PRICE_SQL = "typeof(price) IN ('integer', 'real')"
+
+
+def _to_amount(value):
+    # 金額を数値にする（数値にできない場合や無限大・NaNの場合はNone）
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def _to_date(value):
+    # 日時の先頭10文字がISO形式の日付（YYYY-MM-DD）の場合はその日付、それ以外はNone
+    if not isinstance(value, str) or len(value) < 10:
+        return None
+    date = value[:10]
+    try:
+        return date if datetime.date.fromisoformat(date).isoformat() == date else None
+    except ValueError:
+        return None
+
+
+def _empty_state() -> dict:
+    return {
+        "totals": {"count": 0, "sum": 0.0, "mean": 0.0, "m2": 0.0, "min": None, "max": None},
+        "sketch": {"alpha": SKETCH_ALPHA, "zero": 0, "bins": {}},
+        "days": {},
+        "stores": {},
+        "items": {},
+    }
+
+
+# 以下、統計ごとの更新
+
+def _totals_add(totals, value):
+    # Welfordの方法で平均と分散（偏差の二乗和m2）を1件ずつ更新する
+    totals["count"] += 1
+    totals["sum"] += value
+    delta = value - totals["mean"]
+    totals["mean"] += delta / totals["count"]
+    totals["m2"] += delta * (value - totals["mean"])
+    totals["min"] = value if totals["min"] is None else min(totals["min"], value)
+    totals["max"] = value if totals["max"] is None else max(totals["max"], value)
+
+
+def _totals_merge(totals, count, total, mean, m2, minimum, maximum):
+    # 別に集計した統計量を併合する（Chanらの方法）
+    if count == 0:
+        return
+    n = totals["count"] + count
+    delta = mean - totals["mean"]
+    totals["m2"] += m2 + delta * delta * totals["count"] * count / n
+    totals["mean"] += delta * count / n
+    totals["count"] = n
+    totals["sum"] += total
+    totals["min"] = minimum if totals["min"] is None else min(totals["min"], minimum)
+    totals["max"] = maximum if totals["max"] is None else max(totals["max"], maximum)
+
+
+def _sketch_index(value) -> int:
+    # valueが入るビンの番号（gamma^(i-1) < value <= gamma^i）
+    return math.ceil(math.log(value) / _LOG_GAMMA)
+
+
+def _sketch_add(sketch, value, count=1):
+    if value <= 0:
+        sketch["zero"] += count
+        return
+    key = str(_sketch_index(value))
+    sketch["bins"][key] = sketch["bins"].get(key, 0) + count
+
+
+def _sketch_quantile(sketch, q, minimum=None, maximum=None):
+    # 小さい方からceil(q * 件数)番目（nearest-rank）の値が入るビンの代表値（相対誤差SKETCH_ALPHA以内）
+    # 代表値は実際の最小値・最大値の範囲に収める
+    total = sketch["zero"] + sum(sketch["bins"].values())
+    if total == 0:
+        return None
+    rank = max(1, math.ceil(q * total))
+    seen = sketch["zero"]
+    value = 0.0
+    if rank > seen:
+        for key in sorted(sketch["bins"], key=int):
+            seen += sketch["bins"][key]
+            if rank <= seen:
+                break
+        value = 2 * _GAMMA ** int(key) / (_GAMMA + 1)
+    if minimum is not None:
+        value = max(value, minimum)
+    if maximum is not None:
+        value = min(value, maximum)
+    return value
+
+
+def _days_add(days, date, amount):
+    if date is None:
+        return
+    days[date] = days.get(date, 0.0) + amount
+
+
+def _days_prune(days):
+    # ISO形式でない日付（以前に保存した統計に含まれている場合がある）と、最新の日付からROLLING_DAYS日より前の日を削除する
+    for date in [date for date in days if _to_date(date) != date]:
+        del days[date]
+    if not days:
+        return
+    start = (datetime.date.fromisoformat(max(days)) - datetime.timedelta(days=ROLLING_DAYS - 1)).isoformat()
+    for date in [date for date in days if date < start]:
+        del days[date]
+
+
+def _top_add(counters, name, amount, capacity=TOP_CAPACITY):
+    # Space-Saving: 候補がいっぱいの場合は、一番少ない候補を置き換え、その件数を誤差として引き継ぐ
+    # counters: {名前: [件数, 誤差, 金額]}（金額は候補になってからの合計）
+    if name is None:
+        return
+    counter = counters.get(name)
+    if counter is None:
+        if len(counters) < capacity:
+            counters[name] = [1, 0, amount]
+            return
+        smallest = min(counters, key=lambda key: counters[key][0])
+        minimum = counters.pop(smallest)[0]
+        counters[name] = [minimum + 1, minimum, amount]
+        return
+    counter[0] += 1
+    counter[2] += amount
+
+
+# 以下、保存と読み込み
+
+def _load(conn):
+    row = conn.execute("SELECT state FROM stats_state WHERE id = 1").fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+
+def _save(conn, state):
+    conn.execute(
+        "INSERT INTO stats_state (id, state) VALUES (1, ?) ON CONFLICT (id) DO UPDATE SET state = excluded.state",
+        (json.dumps(state, ensure_ascii=False),)
+    )
+
+
+def add_responses(conn, responses):
+    """
+    保存したレシートの解析結果を統計に加える関数
+    レシートを保存したトランザクションの中で、保存した後に呼ぶ
+
+    Args:
+        conn: トランザクション中の接続
+        responses (list): 保存したレシートの解析結果
+    """
+    state = _load(conn)
+    if state is None:
+        # 統計がない場合（初回や削除の後）は、保存したレシートも含めて作り直す
+        rebuild_stats(conn)
+        return
+
+    for response in responses:
+        # 合計金額・価格がない場合や数値でない場合は0円として数えない（件数だけ数える）
+        total = _to_amount(response.get("total"))
+        if total is not None:
+            _totals_add(state["totals"], total)
+            _sketch_add(state["sketch"], total)
+            _days_add(state["days"], _to_date(response.get("datetime")), total)
+        _top_add(state["stores"], dimensions.normalize_store(response.get("store")), total or 0.0)
+        items = response.get("items")
+        for item in items if isinstance(items, list) else []:
+            if isinstance(item, dict):
+                _top_add(state["items"], item.get("name"), _to_amount(item.get("price")) or 0.0)
+    _days_prune(state["days"])
+    _save(conn, state)
+
+
+def rebuild_stats(conn=None) -> dict:
+    """
+    receipts・itemsテーブルから統計を作り直す関数
+    合計金額の件数・平均・分散などはSQLでまとめて集計し、分位点のビンはCHUNK_SIZE行ずつ読んで数える
+    店舗・商品は正確な件数の上位TOP_CAPACITY件から始める
+
+    Returns:
+        dict: 作り直した統計
+    """
+    if conn is None:
+        with db.transaction() as conn:
+            return rebuild_stats(conn)
+
+    state = _empty_state()
+    # 合計金額がない・数値でないレシートは数えない（add_responsesと同じ）
+    count, total, mean, minimum, maximum = conn.execute(
+        f"SELECT COUNT(total), COALESCE(SUM(total), 0), AVG(total), MIN(total), MAX(total) FROM receipts WHERE {NUMERIC_TOTAL_SQL}"
+    ).fetchone()
+    if count:
+        m2 = conn.execute(f"SELECT SUM((total - ?) * (total - ?)) FROM receipts WHERE {NUMERIC_TOTAL_SQL}",
+                          (mean, mean)).fetchone()[0]
+        _totals_merge(state["totals"], count, total, mean, m2, minimum, maximum)
+
+    cursor = conn.execute(f"SELECT total FROM receipts WHERE {NUMERIC_TOTAL_SQL}")
+    bins = Counter()
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        for (value,) in rows:
+            if value <= 0:
+                state["sketch"]["zero"] += 1
+            else:
+                bins[_sketch_index(value)] += 1
+    state["sketch"]["bins"] = {str(index): count for index, count in bins.items()}
+
+    # 直近の支出は日付のインデックスを使ってreceiptsから集計する
+    # （日別のロールアップには数値でない金額も足されている場合があるので使わない。ISO形式でない日付は_days_pruneで除く）
+    iso_date_sql = "date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'"
+    latest = conn.execute(f"SELECT MAX(date) FROM receipts WHERE {iso_date_sql}").fetchone()[0]
+    if _to_date(latest) is not None:
+        start = (datetime.date.fromisoformat(latest) - datetime.timedelta(days=ROLLING_DAYS - 1)).isoformat()
+        state["days"] = dict(conn.execute(
+            f"SELECT date, SUM(total) FROM receipts WHERE date >= ? AND {iso_date_sql} AND {NUMERIC_TOTAL_SQL} GROUP BY date",
+            (start,)
+        ).fetchall())
+        _days_prune(state["days"])
+
+    for key, sql in (
+        # 店舗は店舗別のロールアップから読む（IDで集計済み）
+        ("stores", "SELECT stores.name, rollup_store.count, rollup_store.total FROM rollup_store "
+                   "JOIN stores ON stores.id = rollup_store.store_id ORDER BY rollup_store.count DESC LIMIT ?"),
+        ("items", f"SELECT name, COUNT(*), COALESCE(SUM(CASE WHEN {NUMERIC_PRICE_SQL} THEN price END), 0) FROM items "
+                  "WHERE name IS NOT NULL GROUP BY name ORDER BY COUNT(*) DESC LIMIT ?"),
+    ):
+        state[key] = {name: [count, 0, _to_amount(amount) or 0.0] for name, count, amount in conn.execute(sql, (TOP_CAPACITY,))}
+
+    _save(conn, state)
+    return state
+
+
+def get_stats(today=None) -> dict:
+    """
+    概要タブに表示する統計を取得する関数（保存した統計がない場合は作り直す）
+
+    Args:
+        today (datetime.date): 直近の支出の基準日（省略時は今日）
+
+    Returns:
+        dict: count, sum, mean, stdev, min, max, quantiles（{q: 値}）,
+              rolling（{日数: {"today": 今日までの支出, "latest": 最新のレシートの日までの支出}}）, latest_date,
+              top_stores, top_items（[名前, 件数, 誤差, 金額] のリスト、件数の多い順にTOP_N件）
+    """
+    conn = db.get_connection()
+    state = _load(conn)
+    if state is None:
+        state = rebuild_stats()
+
+    totals = state["totals"]
+    count = totals["count"]
+    today = (today or datetime.date.today()).isoformat()
+    # 以前に保存した統計にISO形式でない日付が含まれていても表示できるように除く
+    days = dict(state["days"])
+    _days_prune(days)
+    latest = max(days) if days else None
+
+    rolling = {}
+    for window in ROLLING_WINDOWS:
+        rolling[window] = {}
+        for label, end in (("today", today), ("latest", latest)):
+            if end is None:
+                rolling[window][label] = 0.0
+                continue
+            start = (datetime.date.fromisoformat(end) - datetime.timedelta(days=window - 1)).isoformat()
+            rolling[window][label] = sum(amount for date, amount in days.items() if start <= date <= end)
+
+    def top(counters):
+        rows = sorted(counters.items(), key=lambda entry: (-entry[1][0], entry[0]))[:TOP_N]
+        return [[name] + counter for name, counter in rows]
+
+    return {
+        "count": count,
+        "sum": totals["sum"],
+        "mean": totals["mean"] if count else None,
+        "stdev": math.sqrt(totals["m2"] / (count - 1)) if count > 1 else None,
+        "min": totals["min"],
+        "max": totals["max"],
+        "quantiles": {q: _sketch_quantile(state["sketch"], q, totals["min"], totals["max"]) for q in QUANTILES},
+        "rolling": rolling,
+        "latest_date": latest,
+        "top_stores": top(state["stores"]),
+        "top_items": top(state["items"]),
+    }
+
+
+def format_stats(result) -> str:
+    """
+    get_statsの結果を概要タブに表示するMarkdownにする関数
+    """
+    if result["count"] == 0:
+        return "レシートがありません"
+
+    def yen(value):
+        return "-" if value is None else f"{value:,.0f}円"
+
+    quantiles = " / ".join(f"{int(q * 100)}%: {yen(value)}" for q, value in result["quantiles"].items())
+    lines = [
+        "## 統計",
+        f"- レシート数: {result['count']:,}件　合計: {yen(result['sum'])}",
+        f"- 合計金額: 平均 {yen(result['mean'])}　標準偏差 {yen(result['stdev'])}　最小 {yen(result['min'])}　最大 {yen(result['max'])}",
+        f"- 分位点（誤差{SKETCH_ALPHA:.0%}以内）: {quantiles}",
+    ]
+    for window, spend in result["rolling"].items():
+        lines.append(f"- 直近{window}日の支出: {yen(spend['today'])}（最新のレシートの日 {result['latest_date']} まで: {yen(spend['latest'])}）")
+
+    for title, rows in (("よく行く店舗", result["top_stores"]), ("よく買う商品", result["top_items"])):
+        lines += ["", f"### {title}", "| 名前 | 件数 | 金額 |", "| --- | --- | --- |"]
+        for name, count, error, amount in rows:
+            # 誤差がある場合は、件数が最大で誤差の分だけ多く数えられている
+            count_text = f"{count:,}" if error == 0 else f"{count - error:,}～{count:,}"
+            lines.append(f"| {name} | {count_text} | {yen(amount)} |")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # 使用例: python stats.py [データベースのパス]
+    if len(sys.argv) > 1:
+        db.set_db_path(sys.argv[1])
+    rebuild_stats()
+    print(json.dumps(get_stats(), indent=4, ensure_ascii=False))
@@ -0,0 +1,177 @@
+import argparse
+import datetime
+import itertools
+import os
+import random
+import time
+
+import bulk_insert
+import db
+
+# 性能の確認（benchmark.py）用に、大量のレシートデータを作成する
+# 同じシード・件数なら毎回同じデータになる
+# 実際のレシートに近づけるため、店舗・商品の出現頻度は偏らせる（Zipf分布: 順位kの出現頻度が1/k^s に比例）
+
+# ジャンルごとの店舗と商品（名前, 基準価格）
+CATALOG = {
+    "コンビニ": (
+        ["セブンイレブン", "ファミリーマート", "ローソン", "ミニストップ", "デイリーヤマザキ"],
+        [("おにぎり", 140), ("コーヒー", 130), ("飲料水", 140), ("パン", 120), ("お菓子", 120),
+         ("サンドイッチ", 350), ("弁当", 450), ("カップ麺", 210), ("アイス", 180), ("新聞", 160)],
+    ),
+    "スーパー": (
+        ["イオン", "西友", "ライフ", "イトーヨーカドー", "業務スーパー"],
+        [("牛乳", 220), ("卵", 250), ("野菜セット", 350), ("鶏肉", 300), ("豚肉", 450),
+         ("果物", 400), ("魚", 550), ("パスタ", 180), ("調味料", 250), ("米", 2000)],
+    ),
+    "飲食": (
+        ["スターバックス", "マクドナルド", "吉野家", "すき家", "サイゼリヤ", "ドトール"],
+        [("コーヒー", 340), ("ハンバーガー", 390), ("牛丼", 490), ("フライドポテト", 250), ("ケーキ", 420),
+         ("定食", 750), ("うどん", 450), ("ラーメン", 850), ("サンドイッチ", 480), ("パフェ", 650)],
+    ),
+    "衣料品": (
+        ["ユニクロ", "GU", "しまむら"],
+        [("靴下", 790), ("Tシャツ", 1900), ("下着", 1200), ("帽子", 1600), ("スカート", 2400),
+         ("パーカー", 2900), ("ジーンズ", 3900), ("ワンピース", 3900), ("ジャケット", 4900)],
+    ),
+    "雑貨": (
+        ["無印良品", "ダイソー", "ニトリ", "ロフト"],
+        [("ペン", 120), ("ノート", 350), ("歯ブラシ", 320), ("洗剤", 480), ("タオル", 650),
+         ("シャンプー", 750), ("キッチン用品", 980), ("バスマット", 1200), ("収納ボックス", 1500)],
+    ),
+    "ドラッグストア": (
+        ["マツモトキヨシ", "ウエルシア", "スギ薬局"],
+        [("ティッシュ", 300), ("マスク", 500), ("目薬", 600), ("風邪薬", 1200), ("化粧水", 1500),
+         ("日焼け止め", 900), ("サプリメント", 1800), ("絆創膏", 400)],
+    ),
+}
+
+# 作成するデータの既定値
+DEFAULT_SEED = 42
+DEFAULT_STORES = 200
+DEFAULT_DAYS = 730
+DEFAULT_SKEW = 1.1
+# 日付の範囲の最終日（毎回同じデータにするため、現在日時は使わない）
+END_DATE = datetime.datetime(2025, 1, 1)
+
+
+def _zipf_cum_weights(n, skew):
+    # 順位kの重みを1/k^skewとした累積の重み（random.choicesのcum_weights用）
+    return list(itertools.accumulate(1 / (k ** skew) for k in range(1, n + 1)))
+
+
+def _build_stores(num_stores, rng):
+    # 実在の店舗名に支店の番号を付けて、num_stores店舗にする
+    base = [(store, genre) for genre, (stores, _) in CATALOG.items() for store in stores]
+    stores = []
+    for i in range(num_stores):
+        store, genre = base[i % len(base)]
+        stores.append((store if i < len(base) else f"{store} {i // len(base) + 1}号店", genre))
+    # 出現頻度の順位はシードで決める（特定のジャンルだけが上位にならないように）
+    rng.shuffle(stores)
+    return stores
+
+
+def generate_receipts(count, seed=DEFAULT_SEED, num_stores=DEFAULT_STORES, days=DEFAULT_DAYS, skew=DEFAULT_SKEW):
+    """
+    レシートの解析結果と同じ形式のデータを1件ずつ作るジェネレータ
+
+    Args:
+        count (int): 作成するレシートの数
+        seed (int): 乱数のシード（同じ値なら同じデータになる）
+        num_stores (int): 店舗の数
+        days (int): 日付の範囲（END_DATEまでの日数）
+        skew (float): 店舗・商品の出現頻度の偏り（Zipf分布の指数、0で一様）
+
+    Yields:
+        dict: store, genre, datetime, total, items
+    """
+    rng = random.Random(seed)
+    stores = _build_stores(num_stores, rng)
+    store_weights = _zipf_cum_weights(len(stores), skew)
+    item_weights = {genre: _zipf_cum_weights(len(items), skew) for genre, (_, items) in CATALOG.items()}
+    # 昼と夕方に多くなるように、時刻にも偏りを付ける
+    hours = list(range(7, 24))
+    hour_weights = list(itertools.accumulate([1, 2, 3, 3, 4, 8, 7, 4, 3, 3, 4, 6, 7, 5, 3, 2, 1]))
+    start = END_DATE - datetime.timedelta(days=days)
+
+    for _ in range(count):
+        store, genre = rng.choices(stores, cum_weights=store_weights)[0]
+        catalog_items = CATALOG[genre][1]
+
+        # 1~10点（少ない点数ほど多い）
+        num_items = min(1 + int(rng.expovariate(0.5)), 10)
+        items = []
+        for name, price in rng.choices(catalog_items, cum_weights=item_weights[genre], k=num_items):
+            # 価格は基準価格の前後で少しばらつかせる（10円単位）
+            items.append({"name": name, "price": float(max(10, round(price * rng.uniform(0.8, 1.2), -1)))})
+
+        receipt_datetime = start + datetime.timedelta(
+            days=rng.randrange(days),
+            hours=rng.choices(hours, cum_weights=hour_weights)[0],
+            minutes=rng.randrange(60),
+            seconds=rng.randrange(60),
+        )
+        yield {
+            "store": store,
+            "genre": genre,
+            "datetime": receipt_datetime.strftime("%Y-%m-%dT%H:%M:%S"),
+            "total": sum(item["price"] for item in items),
+            "items": items,
+        }
+
+
+def build_database(path, count, seed=DEFAULT_SEED, num_stores=DEFAULT_STORES, days=DEFAULT_DAYS,
+                   skew=DEFAULT_SKEW, overwrite=False) -> dict:
+    """
+    作成したデータで新しいデータベースを作る関数
+    以降、このプロセスではpathのデータベースを使う
+
+    Args:
+        path (str): 作成するデータベースのパス
+        count (int): 作成するレシートの数
+        overwrite (bool): Trueの場合は既存のファイルを削除して作り直す（Falseの場合、既存のファイルがあれば何もしない）
+        seed, num_stores, days, skew: generate_receiptsと同じ
+
+    Returns:
+        dict: bulk_insert.insert_receiptsの結果と、seconds（かかった秒数）
+    """
+    if os.path.exists(path):
+        if not overwrite:
+            db.set_db_path(path)
+            return {"receipts": 0, "items": 0, "first_id": None, "last_id": None, "seconds": 0.0}
+        db.close_connection()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    db.set_db_path(path)
+    start = time.perf_counter()
+    result = bulk_insert.insert_receipts(generate_receipts(count, seed, num_stores, days, skew))
+    conn = db.get_connection()
+    # 作成後の統計情報を更新する（クエリの実行計画を本番に近づけるため）
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+if __name__ == "__main__":
+    # 使用例:
+    #   python synthetic_data.py bench.db --receipts 1000000
+    #   python synthetic_data.py bench.db --receipts 10000 --seed 1 --stores 50 --overwrite
+    parser = argparse.ArgumentParser(description="性能の確認用に、大量のレシートデータでデータベースを作る")
+    parser.add_argument("path", help="作成するデータベースのパス")
+    parser.add_argument("--receipts", type=int, default=1000, help="作成するレシートの数")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--stores", type=int, default=DEFAULT_STORES, help="店舗の数")
+    parser.add_argument("--days", type=int, default=DEFAULT_DAYS, help="日付の範囲（日数）")
+    parser.add_argument("--skew", type=float, default=DEFAULT_SKEW, help="店舗・商品の出現頻度の偏り（0で一様）")
+    parser.add_argument("--overwrite", action="store_true", help="既存のファイルを削除して作り直す")
+    args = parser.parse_args()
+
+    result = build_database(args.path, args.receipts, args.seed, args.stores, args.days, args.skew, args.overwrite)
+    if result["receipts"] == 0:
+        print(f"{args.path} はすでにあります（作り直す場合は --overwrite）")
+    else:
+        print(f"レシート{result['receipts']:,}件・商品{result['items']:,}件を作成しました（{result['seconds']:.1f}秒）")
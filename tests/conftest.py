@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+# リポジトリ直下のモジュールをimportできるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import query_cache  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    # テストごとに新しいデータベースを使う
+    original = db.db_path
+    path = str(tmp_path / "receipts.db")
+    db.set_db_path(path)
+    # データの更新回数はデータベースごとに数えるので、前のテストのキャッシュを使わないように消す
+    query_cache.clear_cache()
+    yield path
+    db.close_connection()
+    db.set_db_path(original)
+
+
+def make_response(store="コンビニ", genre="食品", datetime="2024-01-15 12:00", total=500, items=None):
+    return {
+        "store": store,
+        "genre": genre,
+        "datetime": datetime,
+        "total": total,
+        "items": items if items is not None else [{"name": "おにぎり", "price": total}],
+    }
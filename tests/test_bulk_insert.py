@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+import bulk_insert
+import db
+from conftest import make_response
+
+
+@pytest.mark.parametrize("response", [
+    make_response(),
+    make_response(total=None, items=[{"name": "値札なし", "price": None}]),
+    make_response(total=1280.5, items=[]),
+])
+def test_is_valid_response_accepts_receipts(response):
+    assert bulk_insert.is_valid_response(response)
+
+
+@pytest.mark.parametrize("response", [
+    None,
+    [],
+    {"error": "レシートが含まれていません"},
+    dict(make_response(), items=None),
+    make_response(items="おにぎり"),
+    make_response(items=["おにぎり"]),
+    make_response(items=[{"name": "おにぎり"}]),
+    make_response(total="1,280円"),
+    make_response(total=True),
+    make_response(items=[{"name": "おにぎり", "price": "150円"}]),
+])
+def test_is_valid_response_rejects_malformed_receipts(response):
+    assert not bulk_insert.is_valid_response(response)
+
+
+def test_read_responses_skips_malformed_lines(tmp_path):
+    path = tmp_path / "responses.jsonl"
+    lines = [
+        json.dumps(make_response(total=500)),
+        "{壊れたJSON",
+        json.dumps(make_response(total="1,280円")),
+        json.dumps(dict(make_response(), items=None)),
+        json.dumps([make_response(total=300), make_response(total=200)]),
+    ]
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    assert [response["total"] for response in bulk_insert.read_responses(str(path))] == [500, 300, 200]
+
+
+def test_insert_receipts_saves_every_batch(db_path):
+    responses = [make_response(total=100 * i, items=[{"name": f"商品{i}", "price": 100 * i}]) for i in range(1, 8)]
+
+    result = bulk_insert.insert_receipts(iter(responses), batch_size=3)
+
+    assert (result["receipts"], result["items"]) == (7, 7)
+    conn = db.get_connection()
+    assert conn.execute("SELECT COUNT(*), SUM(total) FROM receipts").fetchone() == (7, 2800)
+    assert conn.execute("SELECT total, count FROM rollup_store").fetchone() == (2800, 7)
+    assert conn.execute("SELECT COUNT(*) FROM items_fts").fetchone()[0] == 7
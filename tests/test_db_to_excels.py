@@ -0,0 +1,34 @@
+import zipfile
+
+import bulk_insert
+import db_to_excels
+from conftest import make_response
+
+
+def _sheet_names(path):
+    with zipfile.ZipFile(path) as xlsx:
+        workbook = xlsx.read("xl/workbook.xml").decode("utf-8")
+    return [part.split('"')[0] for part in workbook.split('<sheet name="')[1:]]
+
+
+def _row_count(path, sheet_number):
+    with zipfile.ZipFile(path) as xlsx:
+        return xlsx.read(f"xl/worksheets/sheet{sheet_number}.xml").decode("utf-8").count("<row ")
+
+
+def test_export_continues_on_new_sheet_at_row_limit(db_path, tmp_path, monkeypatch):
+    # 見出しを含めて1シート4行（データは3行）にする
+    monkeypatch.setattr(db_to_excels, "MAX_SHEET_ROWS", 4)
+    monkeypatch.setattr(db_to_excels, "CHUNK_SIZE", 2)
+    bulk_insert.insert_receipts([make_response(total=100 * i) for i in range(1, 8)])
+    done = []
+    output_path = str(tmp_path / "receipts.xlsx")
+
+    db_to_excels.export_database_to_excel(output_path, progress=done.append)
+
+    assert _sheet_names(output_path)[:6] == [
+        "レシート一覧", "レシート一覧 (2)", "レシート一覧 (3)", "商品詳細", "商品詳細 (2)", "商品詳細 (3)"
+    ]
+    # 見出しを含む行数（レシート7件 = 3 + 3 + 1）
+    assert [_row_count(output_path, number) for number in (1, 2, 3)] == [4, 4, 2]
+    assert sum(done) == 14
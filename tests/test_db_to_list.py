@@ -0,0 +1,63 @@
+import pytest
+
+import bulk_insert
+import db_to_list
+from conftest import make_response
+
+# 並び替えの値が同じ行やNULLの行を含むデータ
+TOTALS = [500, None, 300, 500, 800, None, 300, 500, 100, 800, 500]
+
+
+@pytest.fixture
+def receipts(db_path):
+    responses = [
+        make_response(store="コンビニ" if i % 2 else "書店", datetime=f"2024-01-{i + 1:02d} 12:00", total=total,
+                      items=[{"name": f"商品{i}", "price": total}, {"name": "袋", "price": None}])
+        for i, total in enumerate(TOTALS)
+    ]
+    bulk_insert.insert_receipts(responses)
+    return responses
+
+
+def _all_pages(get_page, limit, **kwargs):
+    rows = []
+    cursor = None
+    while True:
+        page, cursor = get_page(cursor=cursor, limit=limit, **kwargs)
+        assert len(page) <= limit
+        rows += page
+        if cursor is None:
+            return rows
+
+
+def _expected_order(rows, key, descending):
+    # SQLiteと同じく、NULLは昇順で先頭、降順で末尾に並べ、同じ値はIDの順にする
+    def sort_key(row):
+        value = row[key]
+        return (value is not None, value if value is not None else 0, row[0])
+    return sorted(rows, key=sort_key, reverse=descending)
+
+
+@pytest.mark.parametrize("sort, column", [("ID", 0), ("日時", 3), ("合計金額", 4)])
+@pytest.mark.parametrize("descending", [False, True])
+@pytest.mark.parametrize("limit", [1, 3, 20])
+def test_receipts_pages_cover_every_row_once_in_order(receipts, sort, column, descending, limit):
+    rows = _all_pages(db_to_list.get_receipts_page, limit, sort=sort, descending=descending)
+
+    assert [row[0] for row in rows] == [row[0] for row in _expected_order(rows, column, descending)]
+    assert sorted(row[0] for row in rows) == list(range(1, len(TOTALS) + 1))
+
+
+@pytest.mark.parametrize("descending", [False, True])
+def test_items_pages_with_null_prices(receipts, descending):
+    rows = _all_pages(db_to_list.get_items_page, 4, sort="価格", descending=descending)
+
+    assert [row[0] for row in rows] == [row[0] for row in _expected_order(rows, 3, descending)]
+    assert len(rows) == len({row[0] for row in rows}) == db_to_list.count_items() == 2 * len(TOTALS)
+
+
+def test_receipts_pages_with_filters(receipts):
+    rows = _all_pages(db_to_list.get_receipts_page, 2, store="コンビニ", min_total=300, date_to="2024-01-08")
+
+    assert [(row[0], row[1], row[4]) for row in rows] == [(4, "コンビニ", 500), (8, "コンビニ", 500)]
+    assert db_to_list.count_receipts(store="コンビニ", min_total=300, date_to="2024-01-08") == 2
@@ -0,0 +1,25 @@
+import bulk_insert
+import db
+import dimensions
+from conftest import make_response
+
+
+def test_normalize_name():
+    assert dimensions.normalize_store("  ＡＢＣ　　ｽﾄｱ ") == "ABC ストア"
+    assert dimensions.normalize_genre("食料品") == "食品"
+    assert dimensions.normalize_genre(" ") is None
+    assert dimensions.normalize_store(None) is None
+
+
+def test_receipts_share_ids_for_normalized_names(db_path):
+    bulk_insert.insert_receipts([
+        make_response(store="ＡＢＣストア", genre="食料品"),
+        make_response(store="ABCストア", genre="食品"),
+        make_response(store=" ", genre=None),
+    ])
+
+    conn = db.get_connection()
+    assert conn.execute("SELECT name FROM stores").fetchall() == [("ABCストア",)]
+    assert conn.execute("SELECT name FROM genres").fetchall() == [("食品",)]
+    assert conn.execute("SELECT store_id, genre_id FROM receipts ORDER BY id").fetchall() == [(1, 1), (1, 1), (None, None)]
+    assert conn.execute("SELECT store_id, count FROM rollup_store").fetchall() == [(1, 2)]
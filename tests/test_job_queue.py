@@ -0,0 +1,88 @@
+import json
+import os
+
+import db
+import job_queue
+import postimage
+from conftest import make_response
+
+
+def _add_job(image_path="images/a.jpg"):
+    with db.transaction() as conn:
+        conn.execute(
+            "INSERT INTO jobs (image_path, image_hash, created_at, updated_at) VALUES (?, ?, 0, 0)",
+            (image_path, image_path)
+        )
+
+
+def _receipt_count():
+    return db.get_connection().execute("SELECT COUNT(*) FROM receipts").fetchone()[0]
+
+
+def test_claim_job_does_not_claim_running_job_twice(db_path):
+    _add_job()
+    assert job_queue.claim_job("worker-1") is not None
+    assert job_queue.claim_job("worker-2") is None
+
+
+def test_complete_job_saves_receipt(db_path):
+    _add_job()
+    job_id, _ = job_queue.claim_job("worker-1")
+
+    receipt_id = job_queue.complete_job(job_id, make_response(), "worker-1")
+
+    assert receipt_id is not None
+    state, saved_id, result = db.get_connection().execute(
+        "SELECT state, receipt_id, result FROM jobs WHERE id = ?", (job_id,)
+    ).fetchone()
+    assert (state, saved_id) == ("done", receipt_id)
+    assert json.loads(result)["store"] == "コンビニ"
+    assert _receipt_count() == 1
+
+
+def test_complete_job_ignores_worker_that_lost_its_lease(db_path):
+    _add_job()
+    job_id, _ = job_queue.claim_job("worker-1")
+    # 期限切れで別のワーカーに再取得される
+    assert job_queue.claim_job("worker-2", lease_seconds=-1) == (job_id, "images/a.jpg")
+
+    assert job_queue.complete_job(job_id, make_response(), "worker-1") is None
+    assert job_queue.complete_job(job_id, make_response(), "worker-2") is not None
+    assert _receipt_count() == 1
+
+
+def test_complete_job_does_not_save_done_job_twice(db_path):
+    _add_job()
+    job_id, _ = job_queue.claim_job("worker-1")
+    assert job_queue.complete_job(job_id, make_response(), "worker-1") is not None
+
+    assert job_queue.complete_job(job_id, make_response(), "worker-1") is None
+    assert _receipt_count() == 1
+
+
+def test_fail_job_ignores_worker_that_lost_its_lease(db_path):
+    _add_job()
+    job_id, _ = job_queue.claim_job("worker-1")
+    job_queue.claim_job("worker-2", lease_seconds=-1)
+
+    job_queue.fail_job(job_id, "timeout", "worker-1")
+
+    state, worker = db.get_connection().execute("SELECT state, worker FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    assert (state, worker) == ("running", "worker-2")
+
+
+def test_run_worker_keeps_going_when_success_has_same_name(db_path, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(postimage, "model_backend", "simulated")
+    monkeypatch.setattr(postimage, "analyze_image", lambda model, image_data: make_response())
+    (tmp_path / "images").mkdir()
+    (tmp_path / "success").mkdir()
+    for name in ("a.jpg", "b.jpg"):
+        (tmp_path / "images" / name).write_bytes(name.encode())
+    (tmp_path / "success" / "a.jpg").write_bytes(b"old")
+    job_queue.enqueue_folder("images")
+
+    assert job_queue.run_worker(worker_id="worker-1") == 2
+
+    assert sorted(os.listdir(tmp_path / "success")) == ["a.jpg", "a_1.jpg", "b.jpg"]
+    assert job_queue.get_job_status()["done"] == 2
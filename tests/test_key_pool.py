@@ -0,0 +1,54 @@
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+import key_pool
+
+
+class _FakeModel:
+    def __init__(self, api_key, quota_error=False):
+        self.api_key = api_key
+        self.quota_error = quota_error
+        self.calls = 0
+
+    def generate_content(self, contents, request_options=None):
+        self.calls += 1
+        if self.quota_error:
+            raise google_exceptions.ResourceExhausted("quota")
+        return self.api_key
+
+
+def test_split_and_mask_keys(monkeypatch):
+    monkeypatch.delenv("GEMINI_API_KEYS", raising=False)
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+
+    assert key_pool.split_keys(" key-a,\nkey-b, key-a ,") == ["key-a", "key-b"]
+    assert key_pool.split_keys("") == []
+    assert key_pool.mask_key("abcdefghijkl") == "abcd...ijkl"
+    assert key_pool.mask_key("short") == "*****"
+
+
+def test_pool_spreads_requests_across_keys():
+    models = {}
+    pool = key_pool.KeyPool(["key-a", "key-b"], lambda key: models.setdefault(key, _FakeModel(key)), rpm=10, tpm=0)
+
+    answered = [pool.generate_content(["prompt"]) for _ in range(4)]
+
+    assert sorted(answered) == ["key-a", "key-a", "key-b", "key-b"]
+    assert [usage["requests"] for usage in pool.get_usage()] == [2, 2]
+
+
+def test_pool_moves_to_another_key_on_quota_error():
+    models = {"key-a": _FakeModel("key-a", quota_error=True), "key-b": _FakeModel("key-b")}
+    pool = key_pool.KeyPool(["key-a", "key-b"], models.get, rpm=0, tpm=0)
+
+    assert [pool.generate_content(["prompt"]) for _ in range(3)] == ["key-b"] * 3
+    # 429を返したキーはクールダウン中は使わない
+    assert models["key-a"].calls == 1
+    assert [usage["cooldown"] > 0 for usage in pool.get_usage()] == [True, False]
+
+
+def test_pool_raises_when_every_key_is_exhausted():
+    pool = key_pool.KeyPool(["key-a"], lambda key: _FakeModel(key, quota_error=True), rpm=0, tpm=0)
+
+    with pytest.raises(google_exceptions.ResourceExhausted):
+        pool.generate_content(["prompt"])
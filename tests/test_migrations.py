@@ -0,0 +1,73 @@
+import sqlite3
+
+import db
+import dimensions
+import migrations
+
+
+def _tables(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def test_migrate_empty_db(db_path):
+    conn = db.get_connection()
+
+    assert migrations.get_version(conn) == migrations.MIGRATIONS[-1][0]
+    assert {"receipts", "items", "stores", "genres", "jobs", "response_cache", "stats_state"} <= _tables(conn)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(receipts)")}
+    assert {"store_id", "genre_id", "date", "month"} <= columns
+    assert "store" not in columns
+
+
+def test_migrate_baseline_db(db_path):
+    # 以前のinit_dbで作成したデータベース（migration 1と同じスキーマ）
+    baseline = sqlite3.connect(db_path)
+    migrations._migration_1_create_tables(baseline.cursor())
+    baseline.executemany(
+        "INSERT INTO receipts (id, store, genre, datetime, total) VALUES (?, ?, ?, ?, ?)",
+        [
+            (1, "ＡＢＣ　ストア", "食料品", "2024-01-15 12:00", 500),
+            (2, "ABC  ストア", "食品", "2024-01-16 18:30", 1200),
+            (3, "本屋", "本", "2024-02-01 10:00", 800),
+            (5, None, None, "2024-02-02 09:00", None),
+        ]
+    )
+    baseline.executemany(
+        "INSERT INTO items (receipt_id, name, price) VALUES (?, ?, ?)",
+        [("1", "おにぎり", 150), ("1", "お茶", 350), ("2", "弁当", 1200), ("3", "雑誌", 800)]
+    )
+    baseline.commit()
+    baseline.close()
+
+    conn = db.get_connection()
+
+    assert migrations.get_version(conn) == migrations.MIGRATIONS[-1][0]
+    rows = conn.execute(f'''
+        SELECT receipts.id, stores.name, genres.name, receipts.date, receipts.month, receipts.total
+        FROM receipts {dimensions.NAMES_JOIN_SQL}
+        ORDER BY receipts.id
+    ''').fetchall()
+    assert rows == [
+        (1, "ABC ストア", "食品", "2024-01-15", "2024-01", 500),
+        (2, "ABC ストア", "食品", "2024-01-16", "2024-01", 1200),
+        (3, "本屋", "書籍", "2024-02-01", "2024-02", 800),
+        (5, None, None, "2024-02-02", "2024-02", None),
+    ]
+    # 表記揺れは同じIDにまとまる
+    assert conn.execute("SELECT COUNT(*) FROM stores").fetchone()[0] == 2
+    assert conn.execute("SELECT COUNT(*) FROM genres").fetchone()[0] == 2
+
+    # ロールアップは移行したデータと一致する
+    assert conn.execute('''
+        SELECT stores.name, rollup_store.total, rollup_store.count
+        FROM rollup_store JOIN stores ON stores.id = rollup_store.store_id ORDER BY stores.name
+    ''').fetchall() == [("ABC ストア", 1700, 2), ("本屋", 800, 1)]
+    assert conn.execute("SELECT month, total, count FROM rollup_month ORDER BY month").fetchall() == [
+        ("2024-01", 1700, 2), ("2024-02", 800, 2)
+    ]
+
+    # 削除済みのIDは使わない（AUTOINCREMENTの値を引き継ぐ）
+    with db.transaction() as conn:
+        cursor = conn.execute("INSERT INTO receipts (datetime, total) VALUES ('2024-03-01 12:00', 100)")
+    assert cursor.lastrowid == 6
+
@@ -0,0 +1,61 @@
+import base64
+import json
+
+import key_pool
+import postimage
+import simulated_model
+from conftest import make_response
+
+
+def test_get_model_uses_selected_backend(monkeypatch):
+    monkeypatch.setattr(postimage, "model_backend", "simulated")
+    monkeypatch.setattr(key_pool, "DEFAULT_RPM", 0)
+    monkeypatch.setattr(key_pool, "DEFAULT_TPM", 0)
+
+    assert isinstance(postimage.get_model("key-1"), simulated_model.SimulatedModel)
+    # APIキーが複数ある場合はキーのプールで振り分ける
+    assert isinstance(postimage.get_model("key-1,key-2"), key_pool.KeyPool)
+
+
+class _FakeResponse:
+    def __init__(self, body):
+        self.text = "```json\n" + json.dumps(body, ensure_ascii=False) + "\n```"
+
+
+class _FakeModel:
+    """
+    画像の内容を店舗名にした解析結果を返すモデル
+    まとめたリクエストでは、broken（画像の内容）の画像だけ保存できない形式にする
+    """
+
+    def __init__(self, broken=None):
+        self.broken = broken
+        self.calls = []
+
+    def generate_content(self, contents, request_options=None):
+        names = [base64.b64decode(part["data"]).decode() for part in contents if isinstance(part, dict)]
+        self.calls.append(names)
+        if len(names) == 1:
+            return _FakeResponse(make_response(store=names[0]))
+        return _FakeResponse([
+            dict(make_response(store=name), index=index, items=None if name == self.broken else [])
+            for index, name in enumerate(names)
+        ])
+
+
+def test_plan_batches_limits_images_and_bytes():
+    assert postimage._plan_batches([1, 1, 1, 1, 1], 2, 100) == [[0, 1], [2, 3], [4]]
+    # 1枚で上限を超える画像は1枚で送る
+    assert postimage._plan_batches([60, 50, 200, 10], 4, 100) == [[0], [1], [2], [3]]
+    assert postimage._plan_batches([], 4, 100) == []
+
+
+def test_analyze_images_batches_and_retries_invalid_entries_one_by_one():
+    model = _FakeModel(broken="c")
+    images = [name.encode() for name in "abcde"]
+
+    results = postimage.analyze_images(model, images, max_retries=0, use_cache=False, preprocess=False, max_images=3)
+
+    assert [result["store"] for result in results] == list("abcde")
+    # まとめたリクエスト2回と、形式が正しくなかった画像の1枚ずつのリクエスト
+    assert model.calls == [["a", "b", "c"], ["d", "e"], ["c"]]
@@ -0,0 +1,19 @@
+import db
+import response_cache
+from conftest import make_response
+
+
+def test_invalid_response_is_not_cached(db_path):
+    assert response_cache.put_cached_response("key", {"error": "レシートが含まれていません"}) is False
+    assert response_cache.get_cached_response("key") is None
+
+
+def test_hits_are_written_on_flush(db_path):
+    assert response_cache.put_cached_response("key", make_response()) is True
+
+    for _ in range(3):
+        assert response_cache.get_cached_response("key")["store"] == "コンビニ"
+    response_cache.flush_hits()
+
+    hit_count = db.get_connection().execute("SELECT hit_count FROM response_cache WHERE key = 'key'").fetchone()[0]
+    assert hit_count == 3
@@ -0,0 +1,35 @@
+import pytest
+
+import bulk_insert
+import db_to_list
+from conftest import make_response
+
+
+@pytest.fixture
+def receipts(db_path):
+    bulk_insert.insert_receipts([
+        make_response(store="カフェ", items=[{"name": "ブレンドコーヒー", "price": 400}, {"name": "100%ジュース", "price": 300}]),
+        make_response(store="コンビニ", items=[{"name": "缶コーヒー", "price": 150}, {"name": "おにぎり", "price": 120}]),
+        make_response(store="コーヒー専門店", items=[{"name": "豆", "price": 1500}]),
+    ])
+
+
+def test_search_uses_full_text_index_for_long_queries(receipts):
+    result = db_to_list.search_items("コーヒー")
+
+    # 店舗名が一致する商品も含む
+    assert sorted(row[2] for row in result["rows"]) == ["ブレンドコーヒー", "缶コーヒー", "豆"]
+    assert (result["count"], result["total"]) == (3, 2050)
+
+
+def test_search_prefix_matches_only_item_names(receipts):
+    result = db_to_list.search_items("缶コーヒー", prefix=True)
+
+    assert [row[2] for row in result["rows"]] == ["缶コーヒー"]
+
+
+def test_search_short_queries_and_like_wildcards(receipts):
+    assert [row[2] for row in db_to_list.search_items("豆")["rows"]] == ["豆"]
+    # %や_は文字として検索する
+    assert [row[2] for row in db_to_list.search_items("0%")["rows"]] == ["100%ジュース"]
+    assert db_to_list.search_items("  ")["count"] == 0
@@ -0,0 +1,112 @@
+import datetime
+import math
+import random
+
+import pytest
+
+import bulk_insert
+import db
+import stats
+from conftest import make_response
+
+
+def _exact_quantile(values, q):
+    # nearest-rank（小さい方からceil(q * 件数)番目）
+    values = sorted(values)
+    return values[max(1, math.ceil(q * len(values))) - 1]
+
+
+@pytest.mark.parametrize("q", [0.01, 0.5, 0.9, 0.99, 1.0])
+def test_sketch_quantile_matches_exact_quantile(q):
+    rng = random.Random(0)
+    values = [round(rng.lognormvariate(7, 1)) for _ in range(5000)]
+    sketch = stats._empty_state()["sketch"]
+    for value in values:
+        stats._sketch_add(sketch, value)
+
+    estimate = stats._sketch_quantile(sketch, q, min(values), max(values))
+
+    exact = _exact_quantile(values, q)
+    assert abs(estimate - exact) <= exact * stats.SKETCH_ALPHA
+
+
+def test_sketch_quantile_is_clamped_to_min_and_max():
+    sketch = stats._empty_state()["sketch"]
+    stats._sketch_add(sketch, 1000)
+
+    assert stats._sketch_quantile(sketch, 0.5, 1000, 1000) == 1000
+    assert stats._sketch_quantile(stats._empty_state()["sketch"], 0.5) is None
+
+
+def test_add_responses_skips_missing_totals(db_path):
+    with db.transaction() as conn:
+        stats.rebuild_stats(conn)
+        stats.add_responses(conn, [
+            make_response(total=500),
+            make_response(total=None, items=[{"name": "値札なし", "price": None}]),
+            make_response(total=1200),
+        ])
+
+    result = stats.get_stats()
+
+    assert result["count"] == 2
+    assert result["sum"] == 1700
+    assert result["min"] == 500
+    assert result["max"] == 1200
+    assert [row[:2] for row in result["top_stores"]] == [["コンビニ", 3]]
+
+
+def test_add_responses_skips_non_numeric_totals_and_non_iso_dates(db_path):
+    with db.transaction() as conn:
+        stats.rebuild_stats(conn)
+        stats.add_responses(conn, [
+            make_response(total="1,280円", items=[{"name": "弁当", "price": "980円"}]),
+            make_response(datetime="2024年1月5日 12:00", total=300),
+            make_response(datetime="2024-01-10 09:00", total="700"),
+        ])
+
+    result = stats.get_stats(today=datetime.date(2024, 1, 10))
+
+    assert result["count"] == 2
+    assert result["sum"] == 1000
+    assert result["latest_date"] == "2024-01-10"
+    assert result["rolling"][7] == {"today": 700, "latest": 700}
+
+
+def test_rebuild_stats_ignores_text_totals_and_non_iso_dates(db_path):
+    # 古いデータベースには、文字列の金額やISO形式でない日付が保存されている場合がある
+    with db.transaction() as conn:
+        conn.executemany(
+            "INSERT INTO receipts (datetime, date, month, total) VALUES (?, substr(?, 1, 10), substr(?, 1, 7), ?)",
+            [(value, value, value, total) for value, total in [
+                ("2024-01-05 12:00", 500),
+                ("2024-01-06 12:00", "1,280円"),
+                ("2024年1月7日", 800),
+            ]]
+        )
+        conn.execute("DELETE FROM stats_state")
+
+    result = stats.get_stats(today=datetime.date(2024, 1, 6))
+
+    assert result["count"] == 2
+    assert (result["min"], result["max"]) == (500, 800)
+    assert result["latest_date"] == "2024-01-05"
+    assert result["rolling"][7]["today"] == 500
+
+    # 統計がない状態で保存しても失敗しない（保存の中で統計を作り直す）
+    with db.transaction() as conn:
+        conn.execute("DELETE FROM stats_state")
+    bulk_insert.insert_receipts([make_response(total=1000)])
+    assert stats.get_stats()["count"] == 3
+
+
+def test_get_stats_ignores_non_iso_days_in_saved_state(db_path):
+    with db.transaction() as conn:
+        state = stats._empty_state()
+        state["days"] = {"2024-01-05": 500.0, "2024年1月5日": 300.0}
+        stats._save(conn, state)
+
+    result = stats.get_stats(today=datetime.date(2024, 1, 5))
+
+    assert result["latest_date"] == "2024-01-05"
+    assert result["rolling"][7]["today"] == 500
@@ -1,11 +1,98 @@
 import gradio as gr
+from datetime import datetime
+from typing import Optional
 from fastapi import FastAPI
-from postimage import main_process
-from db_to_excels import export_database_to_excel
+from fastapi.responses import PlainTextResponse
+from postimage import main_process, DEFAULT_MAX_WORKERS, DEFAULT_BATCH_IMAGES
+from db_to_excels import start_export_job, get_export_job
+from stats import get_stats, format_stats
 import db_to_list as dbl
+import query_cache
+import metrics
+import api
 import uvicorn
 
 app = FastAPI()
+# 画像のアップロードとデータの取得ができるREST API（/api）
+app.include_router(api.router)
+
+# Runボタンから呼ばれる処理
+@metrics.profiled
+def run_main_process(folder_path, api_key, max_workers, batch_images=DEFAULT_BATCH_IMAGES):
+    return main_process(folder_path, api_key, max_workers=int(max_workers), batch_images=int(batch_images))
+
+# ページ送り
+# stateには {"pages": 表示中までの各ページのカーソル, "next": 次のページのカーソル} を保存する
+def _browse(get_page, count, filters, sort, order, state, move):
+    if move == "first" or not state:
+        pages = [None]
+    else:
+        pages = list(state["pages"])
+        if move == "next" and state["next"] is not None:
+            pages.append(state["next"])
+        elif move == "prev" and len(pages) > 1:
+            pages.pop()
+
+    rows, next_cursor = get_page(**filters, sort=sort, descending=(order == "降順"), cursor=pages[-1])
+    total = count(**filters)
+
+    start = (len(pages) - 1) * dbl.PAGE_SIZE
+    if rows:
+        info = f"{start + 1}〜{start + len(rows)}件目 / 全{total}件"
+    else:
+        info = f"該当するデータがありません / 全{total}件"
+    return rows, info, {"pages": pages, "next": next_cursor}
+
+@metrics.profiled
+def browse_receipts(move, store, genre, date_from, date_to, min_total, max_total, receipt_id, sort, order, state):
+    filters = dict(store=store, genre=genre, date_from=date_from, date_to=date_to,
+                   min_total=min_total, max_total=max_total, receipt_id=receipt_id)
+    return _browse(dbl.get_receipts_page, dbl.count_receipts, filters, sort, order, state, move)
+
+@metrics.profiled
+def browse_items(move, receipt_id, store, genre, date_from, date_to, min_price, max_price, sort, order, state):
+    filters = dict(receipt_id=receipt_id, store=store, genre=genre, date_from=date_from, date_to=date_to,
+                   min_price=min_price, max_price=max_price)
+    return _browse(dbl.get_items_page, dbl.count_items, filters, sort, order, state, move)
+
+# 店舗・ジャンルの選択肢を読み込む
+def load_filter_choices():
+    return gr.update(choices=[""] + dbl.get_store_names()), gr.update(choices=[""] + dbl.get_genre_names())
+
+# 商品名・店舗名で検索する
+@metrics.profiled
+def search_items(query, mode):
+    result = dbl.search_items(query, prefix=(mode == "前方一致"))
+    info = f"{result['count']:,}件 / 合計 {result['total']:,.0f}円"
+    if result["count"] > len(result["rows"]):
+        info += f"（上位{len(result['rows'])}件を表示）"
+    return result["rows"], info
+
+# キャッシュのヒット率を表示する
+def get_cache_info():
+    stats = query_cache.get_cache_stats()
+    return f"一覧・集計のキャッシュ: ヒット率 {stats['hit_ratio']:.1%}（ヒット {stats['hits']}回 / ミス {stats['misses']}回 / {stats['entries']}件）"
+
+# 概要タブの統計（保存した統計を読むだけなので、全件は読まない）
+def get_overview_stats():
+    return format_stats(get_stats())
+
+# Excelへの出力をバックグラウンドで開始する
+def start_excel_export(output_path):
+    job_id = start_export_job(output_path)
+    return job_id, "出力を開始しました", None, gr.Timer(active=True)
+
+# Excelへの出力の進捗を確認する
+def check_excel_export(job_id):
+    job = get_export_job(job_id)
+    if job is None:
+        return "", None, gr.Timer(active=False)
+    if job["state"] == "running":
+        percent = job["done"] / job["total"] if job["total"] else 0
+        return f"出力中: {job['done']:,} / {job['total']:,} 行（{percent:.0%}）", None, gr.Timer(active=True)
+    # 完了したら確認を止め、成功した場合はダウンロードできるようにする
+    file = job["output_path"] if job["state"] == "done" else None
+    return job["message"], file, gr.Timer(active=False)
 
 # gradioインターフェースの定義
 def gradio_interface():
@@ -13,35 +100,109 @@ def gradio_interface():
         with gr.Tab("レシート登録"):
             gr.Markdown("# Receipt Kanri")
             gr.Markdown("## API Key")
-            gr.Markdown("入力が空の場合は環境変数（GEMINI_API_KEY）から取得します")
+            gr.Markdown("入力が空の場合は環境変数（GEMINI_API_KEYS または GEMINI_API_KEY）から取得します。複数のキーはカンマ区切りで入力すると、上限に余裕のあるキーから順に使います")
             text_box_apikey = gr.Textbox(lines=1, label="Your API Key")
 
             gr.Markdown("## Image")
             gr.Markdown("入力が空の場合はimagesフォルダ内の画像を使用します")
             image_folder_path = gr.Textbox(lines=1, label="Image Folder Path")
+
+            gr.Markdown("## 同時実行数")
+            gr.Markdown("AIに同時に送信する画像の最大枚数です。レート制限（429）が頻発する場合は小さくしてください")
+            max_workers = gr.Slider(minimum=1, maximum=16, step=1, value=DEFAULT_MAX_WORKERS, label="Max Workers")
+
+            gr.Markdown("## 1リクエストあたりの画像数")
+            gr.Markdown("複数の画像を1回のリクエストでまとめて解析します。リクエスト数とトークン数を減らせますが、1回の応答は遅くなります（1でまとめない）")
+            batch_images = gr.Slider(minimum=1, maximum=16, step=1, value=DEFAULT_BATCH_IMAGES, label="Images per Request")
             run_btn = gr.Button("Run")
 
             gr.Markdown("## Output")
             output = gr.Textbox(lines=10, label="Output")
 
-            run_btn.click(fn=main_process,
-                        inputs=(image_folder_path, text_box_apikey),
+            run_btn.click(fn=run_main_process,
+                        inputs=(image_folder_path, text_box_apikey, max_workers, batch_images),
                         outputs=output
                         )
             
             
         with gr.Tab("データベース表示"):
-            with gr.Tab("概要"):
+            with gr.Tab("概要") as tab_overview:
                 gr.Markdown("# データベース表示")
                 gr.Markdown("このタブでは、レシートの分析が可能です。各タブを選択して詳細データを表示します。")
+                overview_stats = gr.Markdown()
+                cache_info = gr.Markdown()
+                tab_overview.select(fn=get_overview_stats, outputs=overview_stats)
+                tab_overview.select(fn=get_cache_info, outputs=cache_info)
 
             with gr.Tab("レシート一覧") as tab_receipts_list:
-                df_receipts_list = gr.Dataframe(headers=['ID', '店舗', 'ジャンル', '日時(ISO8601)', '合計金額', '日時(表示用)'], show_search="filter", interactive=False)
-                tab_receipts_list.select(fn=dbl.get_receipts_list, outputs=df_receipts_list)
+                with gr.Row():
+                    receipts_store = gr.Dropdown(label="店舗", choices=[], allow_custom_value=True)
+                    receipts_genre = gr.Dropdown(label="ジャンル", choices=[], allow_custom_value=True)
+                    receipts_date_from = gr.Textbox(label="日付（から）", placeholder="YYYY-MM-DD")
+                    receipts_date_to = gr.Textbox(label="日付（まで）", placeholder="YYYY-MM-DD")
+                with gr.Row():
+                    receipts_min_total = gr.Number(label="合計金額（以上）", value=None)
+                    receipts_max_total = gr.Number(label="合計金額（以下）", value=None)
+                    receipts_id = gr.Number(label="レシートID", value=None, precision=0)
+                    receipts_sort = gr.Dropdown(label="並び替え", choices=list(dbl.RECEIPT_SORTS), value="ID")
+                    receipts_order = gr.Radio(label="順序", choices=["昇順", "降順"], value="降順")
+                with gr.Row():
+                    receipts_search_btn = gr.Button("検索")
+                    receipts_prev_btn = gr.Button("前のページ")
+                    receipts_next_btn = gr.Button("次のページ")
+                receipts_page_info = gr.Markdown()
+                receipts_page_state = gr.State()
+                df_receipts_list = gr.Dataframe(headers=['ID', '店舗', 'ジャンル', '日時(ISO8601)', '合計金額', '日時(表示用)'], interactive=False)
+
+                receipts_inputs = [receipts_store, receipts_genre, receipts_date_from, receipts_date_to,
+                                   receipts_min_total, receipts_max_total, receipts_id,
+                                   receipts_sort, receipts_order, receipts_page_state]
+                receipts_outputs = [df_receipts_list, receipts_page_info, receipts_page_state]
+                tab_receipts_list.select(fn=load_filter_choices, outputs=[receipts_store, receipts_genre])
+                tab_receipts_list.select(fn=lambda *args: browse_receipts("first", *args), inputs=receipts_inputs, outputs=receipts_outputs)
+                receipts_search_btn.click(fn=lambda *args: browse_receipts("first", *args), inputs=receipts_inputs, outputs=receipts_outputs)
+                receipts_prev_btn.click(fn=lambda *args: browse_receipts("prev", *args), inputs=receipts_inputs, outputs=receipts_outputs)
+                receipts_next_btn.click(fn=lambda *args: browse_receipts("next", *args), inputs=receipts_inputs, outputs=receipts_outputs)
 
             with gr.Tab("商品詳細") as tab_items_detail:
-                df_items_detail = gr.Dataframe(headers=['ID', 'レシートID', '商品名', '価格'], show_search="filter", interactive=False)
-                tab_items_detail.select(fn=dbl.get_items_detail, outputs=df_items_detail)
+                with gr.Row():
+                    items_receipt_id = gr.Number(label="レシートID", value=None, precision=0)
+                    items_store = gr.Dropdown(label="店舗", choices=[], allow_custom_value=True)
+                    items_genre = gr.Dropdown(label="ジャンル", choices=[], allow_custom_value=True)
+                    items_date_from = gr.Textbox(label="日付（から）", placeholder="YYYY-MM-DD")
+                    items_date_to = gr.Textbox(label="日付（まで）", placeholder="YYYY-MM-DD")
+                with gr.Row():
+                    items_min_price = gr.Number(label="価格（以上）", value=None)
+                    items_max_price = gr.Number(label="価格（以下）", value=None)
+                    items_sort = gr.Dropdown(label="並び替え", choices=list(dbl.ITEM_SORTS), value="ID")
+                    items_order = gr.Radio(label="順序", choices=["昇順", "降順"], value="降順")
+                with gr.Row():
+                    items_search_btn = gr.Button("検索")
+                    items_prev_btn = gr.Button("前のページ")
+                    items_next_btn = gr.Button("次のページ")
+                items_page_info = gr.Markdown()
+                items_page_state = gr.State()
+                df_items_detail = gr.Dataframe(headers=['ID', 'レシートID', '商品名', '価格'], interactive=False)
+
+                items_inputs = [items_receipt_id, items_store, items_genre, items_date_from, items_date_to,
+                                items_min_price, items_max_price,
+                                items_sort, items_order, items_page_state]
+                items_outputs = [df_items_detail, items_page_info, items_page_state]
+                tab_items_detail.select(fn=load_filter_choices, outputs=[items_store, items_genre])
+                tab_items_detail.select(fn=lambda *args: browse_items("first", *args), inputs=items_inputs, outputs=items_outputs)
+                items_search_btn.click(fn=lambda *args: browse_items("first", *args), inputs=items_inputs, outputs=items_outputs)
+                items_prev_btn.click(fn=lambda *args: browse_items("prev", *args), inputs=items_inputs, outputs=items_outputs)
+                items_next_btn.click(fn=lambda *args: browse_items("next", *args), inputs=items_inputs, outputs=items_outputs)
+
+            with gr.Tab("商品検索"):
+                with gr.Row():
+                    search_query = gr.Textbox(label="商品名・店舗名", placeholder="例: コーヒー")
+                    search_mode = gr.Radio(label="検索方法", choices=["部分一致", "前方一致"], value="部分一致")
+                    search_btn = gr.Button("検索")
+                search_info = gr.Markdown()
+                df_search = gr.Dataframe(headers=['ID', 'レシートID', '商品名', '価格', '店舗', '日時(ISO8601)'], interactive=False)
+                search_btn.click(fn=search_items, inputs=[search_query, search_mode], outputs=[df_search, search_info])
+                search_query.submit(fn=search_items, inputs=[search_query, search_mode], outputs=[df_search, search_info])
 
             with gr.Tab("店舗別集計") as tab_store_summary:
                 df_store_summary = gr.Dataframe(headers=['店舗', '合計金額', '領収書数'], show_search="filter", interactive=False)
@@ -64,15 +225,41 @@ def gradio_interface():
             excel_output_path = gr.Textbox(lines=1, label=" Excel Output Path")
             excel_btn = gr.Button("Export")
             excel_result = gr.Textbox(lines=1, label="Result")
+            excel_file = gr.File(label="Download")
+            excel_job_id = gr.State()
+            # 出力はバックグラウンドで行い、1秒ごとに進捗を確認する
+            excel_timer = gr.Timer(1, active=False)
 
-            excel_btn.click(fn=export_database_to_excel,
+            excel_btn.click(fn=start_excel_export,
                             inputs=excel_output_path,
-                            outputs=excel_result
+                            outputs=(excel_job_id, excel_result, excel_file, excel_timer)
+                        )
+            excel_timer.tick(fn=check_excel_export,
+                             inputs=excel_job_id,
+                             outputs=(excel_result, excel_file, excel_timer)
                         )
 
     return demo
 
 # GradioアプリをFastAPIにマウント
+# Prometheus形式の計測値
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# プロファイル（cProfile）の結果を表示する
+# ?enabled=1 で有効、?enabled=0 で無効にする（実行中に切り替えられる）
+@app.get("/debug/profile")
+def get_profile(enabled: Optional[bool] = None):
+    if enabled is not None:
+        metrics.set_profiling(enabled)
+    lines = [f"profiling: {'on' if metrics.is_profiling() else 'off'}", ""]
+    for profile in metrics.get_profiles():
+        started_at = datetime.fromtimestamp(profile["started_at"]).isoformat(timespec="seconds")
+        lines.append(f"=== {profile['name']} {started_at} ({profile['seconds']:.3f}s) ===")
+        lines.append(profile["stats"])
+    return PlainTextResponse("\n".join(lines))
+
 app = gr.mount_gradio_app(app, gradio_interface(), path="/")
 
 # アプリケーション起動処理
@@ -83,5 +270,5 @@ if __name__ == "__main__":
 # TODO: Discordとの連携 ←制作中
 # TODO: DBの内容をCSVに出力、html形式でwebuiに表示　(CSV経由しなくてもよくね？)
 # →gradioでdataframeを表示する方法があるので、それを使う OK
-# TODO: 検索機能の拡充（IDによる商品詳細の絞りこみなど）
-# TODO: 概要に統計データを表示
+# TODO: 検索機能の拡充（IDによる商品詳細の絞りこみなど） ←OK（一覧はページ単位で表示）
+# TODO: 概要に統計データを表示 ←OK（stats.py）